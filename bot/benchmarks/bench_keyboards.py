@@ -0,0 +1,98 @@
+"""
+Micro-benchmark: category/subcategory keyboard construction
+
+Compares building keyboards from scratch on every call (the old approach)
+with catalog-version templates, cold (new expense id each call) and warm
+(repeated "Назад" taps on the same expense). Expect cold builds to be on
+par with the naive ones (InlineKeyboardButton construction dominates); the
+templates pay off on the warm path.
+
+    python bot/benchmarks/bench_keyboards.py [iterations]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup  # noqa: E402
+
+import keyboards  # noqa: E402
+from callback_router import encode_callback  # noqa: E402
+from catalog import Catalog, CategoryEntry, SubcategoryEntry  # noqa: E402
+from config import CallbackAction  # noqa: E402
+
+
+def make_catalog() -> Catalog:
+    categories = [CategoryEntry(i, code, f"Category {i}") for i, code in enumerate(keyboards.CATEGORY_EMOJIS, 1)]
+    subcategories = []
+    for n, code in enumerate(keyboards.SUBCATEGORY_EMOJIS, 1):
+        category_id = categories[(n - 1) % len(categories)].id
+        subcategories.append(SubcategoryEntry(n, category_id, code, f"Subcategory {n}"))
+    return Catalog(1, "bench", categories, subcategories)
+
+
+def naive_categories(catalog: Catalog, expense_id: int) -> InlineKeyboardMarkup:
+    keyboard, row = [], []
+    for cat in catalog.categories:
+        emoji = keyboards.CATEGORY_EMOJIS.get(cat.code, "📂")
+        row.append(InlineKeyboardButton(
+            f"{emoji} {cat.name}",
+            callback_data=encode_callback(CallbackAction.CATEGORY, cat.id, expense_id)
+        ))
+        if len(row) == 2:
+            keyboard.append(row)
+            row = []
+    if row:
+        keyboard.append(row)
+    return InlineKeyboardMarkup(keyboard)
+
+
+def naive_subcategories(catalog: Catalog, category_id: int, expense_id: int) -> InlineKeyboardMarkup:
+    keyboard, row = [], []
+    for sub in catalog.subcategories_of(category_id):
+        emoji = keyboards.SUBCATEGORY_EMOJIS.get(sub.code, "📌")
+        row.append(InlineKeyboardButton(
+            f"{emoji} {sub.name}",
+            callback_data=encode_callback(CallbackAction.SUBCATEGORY, sub.id, expense_id)
+        ))
+        if len(row) == 2:
+            keyboard.append(row)
+            row = []
+    if row:
+        keyboard.append(row)
+    keyboard.append([InlineKeyboardButton("⬅️ Назад", callback_data=encode_callback(CallbackAction.BACK, expense_id))])
+    return InlineKeyboardMarkup(keyboard)
+
+
+def bench(name: str, fn, iterations: int):
+    started = time.perf_counter()
+    for i in range(iterations):
+        fn(i)
+    elapsed = time.perf_counter() - started
+    print(f"{name:<32} {elapsed * 1e6 / iterations:8.1f} us/op")
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    catalog = make_catalog()
+    category_id = catalog.categories[0].id
+
+    # Same output from both builders
+    assert naive_categories(catalog, 7).to_dict() == keyboards.get_categories_keyboard(catalog, 7).to_dict()
+    assert (naive_subcategories(catalog, category_id, 7).to_dict()
+            == keyboards.get_subcategories_keyboard(catalog, category_id, 7).to_dict())
+
+    print(f"{iterations} iterations")
+    bench("categories naive", lambda i: naive_categories(catalog, i), iterations)
+    bench("categories template (cold)", lambda i: keyboards.get_categories_keyboard(catalog, 10 ** 6 + i), iterations)
+    bench("categories template (warm)", lambda i: keyboards.get_categories_keyboard(catalog, i % 16), iterations)
+    bench("subcategories naive", lambda i: naive_subcategories(catalog, category_id, i), iterations)
+    bench("subcategories template (cold)",
+          lambda i: keyboards.get_subcategories_keyboard(catalog, category_id, 10 ** 6 + i), iterations)
+    bench("subcategories template (warm)",
+          lambda i: keyboards.get_subcategories_keyboard(catalog, category_id, i % 16), iterations)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+Offline benchmark: subcategory suggestions (naive Bayes, suggestions.py)
+
+Replays expenses in confirmation order the way the bot sees them: each one
+is first predicted, then learned from. Reports accuracy of all predictions,
+coverage and accuracy of the ones confident enough to be shown
+(SUGGESTION_MIN_PROBABILITY), and inference latency.
+
+    python bot/benchmarks/bench_suggestions.py            # synthetic expenses
+    python bot/benchmarks/bench_suggestions.py --db       # confirmed expenses from DATABASE_URL
+"""
+import os
+import random
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from config import config  # noqa: E402
+from suggestions import CategorySuggester, expense_text  # noqa: E402
+
+# Typical descriptions per subcategory code, with filler words and amounts mixed in
+SYNTHETIC = {
+    "CALL_FUEL": ["бензин", "заправка", "дизель", "топливо", "бензина на заправке"],
+    "CALL_REPAIR": ["ремонт машины", "шиномонтаж", "замена масла", "ремонт авто"],
+    "CALL_INSURANCE": ["страховка", "страховка машины", "каско"],
+    "CALL_SALARY": ["зарплата водителю", "выезд оплата мастеру"],
+    "JVK_RENT": ["аренда", "аренда офиса", "оплата аренды"],
+    "JVK_ELECTRIC": ["электричество", "свет", "счёт за электричество"],
+    "JVK_PARTS": ["запчасти", "детали", "подшипники"],
+    "HQ_EQUIPMENT": ["ноутбук", "монитор", "принтер", "оборудование"],
+    "HQ_PURCHASES": ["канцелярия", "бумага", "вода в офис", "кофе"],
+    "FS_SUBSCRIPTIONS": ["подписка", "dropbox", "интернет", "телефон"],
+}
+FILLER = ["оплатил", "за", "сегодня", "евро", "кэшем", "картой", ""]
+
+
+def synthetic_rows(count: int, seed: int = 1):
+    rng = random.Random(seed)
+    labels = list(SYNTHETIC)
+    rows = []
+    for _ in range(count):
+        label = rng.choice(labels)
+        words = [rng.choice(SYNTHETIC[label]), rng.choice(FILLER), str(rng.randint(5, 500))]
+        rng.shuffle(words)
+        rows.append(SimpleNamespace(
+            description=" ".join(w for w in words if w), original_text=None, transcription=None,
+            subcategory_id=labels.index(label) + 1,
+        ))
+    return rows
+
+
+def db_rows():
+    from bot import get_db
+    from database import Expense, ExpenseStatus
+
+    session = get_db()
+    try:
+        return session.query(
+            Expense.description, Expense.original_text, Expense.transcription, Expense.subcategory_id
+        ).filter(
+            Expense.status == ExpenseStatus.CONFIRMED,
+            Expense.subcategory_id.isnot(None),
+        ).order_by(Expense.confirmed_at, Expense.id).all()
+    finally:
+        session.close()
+
+
+def main():
+    rows = db_rows() if "--db" in sys.argv else synthetic_rows(5000)
+    threshold = config.SUGGESTION_MIN_PROBABILITY
+    suggester = CategorySuggester()
+
+    predicted = correct = shown = shown_correct = 0
+    latencies = []
+    for row in rows:
+        text = expense_text(row)
+        if suggester.examples >= config.SUGGESTION_MIN_EXAMPLES:
+            started = time.perf_counter()
+            suggestion = suggester.suggest(text)
+            latencies.append(time.perf_counter() - started)
+            if suggestion:
+                predicted += 1
+                hit = suggestion.subcategory_id == row.subcategory_id
+                correct += hit
+                if suggestion.probability >= threshold:
+                    shown += 1
+                    shown_correct += hit
+        suggester.learn(text, row.subcategory_id)
+
+    evaluated = len(latencies)
+    print(f"{len(rows)} expenses, {evaluated} predicted after the first {config.SUGGESTION_MIN_EXAMPLES}")
+    if not evaluated:
+        return
+    latencies.sort()
+    print(f"top-1 accuracy            {correct / evaluated:6.1%}  (no known words: {evaluated - predicted})")
+    print(f"shown (p >= {threshold:.2f})       {shown / evaluated:6.1%}  of expenses")
+    if shown:
+        print(f"accuracy when shown       {shown_correct / shown:6.1%}  (one confirming tap)")
+    print(f"inference p50 / p99       {latencies[len(latencies) // 2] * 1e6:6.1f} / "
+          f"{latencies[int(len(latencies) * 0.99)] * 1e6:.1f} us")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""
+Collect Telegram albums (media groups) into one batch
+
+Telegram delivers every photo of an album as a separate update with the same
+media_group_id. The collector buffers them until no new item has arrived for
+config.ALBUM_WINDOW_SECONDS and then hands the whole album over at once.
+"""
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Dict, List
+
+from telegram import Update
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+AlbumCallback = Callable[[List[Update]], Awaitable[None]]
+
+
+class _Album:
+    __slots__ = ("updates", "last_added", "on_complete")
+
+    def __init__(self, on_complete: AlbumCallback):
+        self.updates: List[Update] = []
+        self.last_added = time.monotonic()
+        self.on_complete = on_complete
+
+
+class AlbumCollector:
+    """Buffer media group updates and flush each group once it is complete"""
+
+    def __init__(self, window: float):
+        self.window = window
+        self._albums: Dict[str, _Album] = {}
+
+    def is_collecting(self, media_group_id: str) -> bool:
+        return media_group_id in self._albums
+
+    def add(self, update: Update, on_complete: AlbumCallback = None) -> bool:
+        """
+        Add album item. The first item of a group must pass on_complete,
+        it starts the group and returns True
+        """
+        media_group_id = update.message.media_group_id
+        album = self._albums.get(media_group_id)
+        started = album is None
+
+        if started:
+            album = self._albums[media_group_id] = _Album(on_complete)
+            asyncio.create_task(self._flush_when_complete(media_group_id))
+
+        album.updates.append(update)
+        album.last_added = time.monotonic()
+        return started
+
+    async def _flush_when_complete(self, media_group_id: str):
+        album = self._albums[media_group_id]
+        while True:
+            remaining = album.last_added + self.window - time.monotonic()
+            if remaining <= 0:
+                break
+            await asyncio.sleep(remaining)
+
+        del self._albums[media_group_id]
+        updates = sorted(album.updates, key=lambda u: u.message.message_id)
+        logger.info(f"[Album] {media_group_id}: {len(updates)} items")
+
+        try:
+            await album.on_complete(updates)
+        except Exception as e:
+            logger.error(f"[Album] {media_group_id} processing error: {e}", exc_info=True)
+
+
+album_collector = AlbumCollector(config.ALBUM_WINDOW_SECONDS)
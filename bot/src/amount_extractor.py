@@ -1,14 +1,20 @@
 """
 Amount extraction service using OpenAI GPT and Vision API
 """
+import asyncio
 import base64
 import json
+import logging
 import re
-from typing import Optional, Tuple, List, Dict
-import httpx
+from typing import AsyncIterator, Optional, Tuple, List, Dict
 from config import config
+import openai_client
+import tracing
 
+logger = logging.getLogger(__name__)
 
+
+@tracing.traced("openai.extract_text")
 async def extract_expense_info(text: str) -> Tuple[Optional[float], Optional[str], Optional[str]]:
     """
     Extract amount, currency and description from text using GPT
@@ -35,58 +41,141 @@ async def extract_expense_info(text: str) -> Tuple[Optional[float], Optional[str
 Текст: """ + text
 
     try:
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.post(
-                "https://api.openai.com/v1/chat/completions",
-                headers={
-                    "Authorization": f"Bearer {config.OPENAI_API_KEY}",
-                    "Content-Type": "application/json"
-                },
-                json={
-                    "model": "gpt-4o-mini",
-                    "messages": [
-                        {"role": "user", "content": prompt}
-                    ],
-                    "temperature": 0,
-                    "max_tokens": 150
-                }
-            )
-
-            if response.status_code == 200:
-                result = response.json()
-                content = result["choices"][0]["message"]["content"]
-
-                json_match = re.search(r'\{[^}]+\}', content)
-                if json_match:
-                    data = json.loads(json_match.group())
-                    amount = data.get("amount")
-                    currency = data.get("currency", "EUR")
-                    description = data.get("description")
-                    if amount is not None:
-                        return float(amount), currency, description
-                    return None, None, description
+        client = openai_client.get_client()
+        response = await client.post(
+            "https://api.openai.com/v1/chat/completions",
+            timeout=30.0,
+            headers={
+                "Authorization": f"Bearer {config.OPENAI_API_KEY}",
+                "Content-Type": "application/json"
+            },
+            json={
+                "model": "gpt-4o-mini",
+                "messages": [
+                    {"role": "user", "content": prompt}
+                ],
+                "temperature": 0,
+                "max_tokens": 150
+            }
+        )
+
+        if response.status_code == 200:
+            result = response.json()
+            content = result["choices"][0]["message"]["content"]
+
+            json_match = re.search(r'\{[^}]+\}', content)
+            if json_match:
+                data = json.loads(json_match.group())
+                amount = data.get("amount")
+                currency = data.get("currency", "EUR")
+                description = data.get("description")
+                if amount is not None:
+                    return float(amount), currency, description
+                return None, None, description
 
-            return None, None, None
+        return None, None, None
 
     except Exception as e:
-        print(f"Amount extraction error: {e}")
+        logger.error(f"Amount extraction error: {e}")
         return None, None, None
 
 
 # Backward compatibility
+CURRENCY_SYMBOLS = {"€": "EUR", "$": "USD", "£": "GBP", "₽": "RUB", "₴": "UAH"}
+
+_TYPED_AMOUNT = re.compile(r"\s*([€$£₽₴])?\s*(\d+(?:[.,]\d{1,2})?)\s*([€$£₽₴]|[A-Za-z]{3})?\s*")
+
+
+def parse_amount(text: str) -> Optional[Tuple[float, Optional[str]]]:
+    """Amount typed by the user ("12.50", "12,5 usd", "€12"), None if the text is not just an amount"""
+    match = _TYPED_AMOUNT.fullmatch(text or "")
+    if not match:
+        return None
+    symbol, number, suffix = match.groups()
+    currency = symbol or suffix
+    currency = CURRENCY_SYMBOLS.get(currency, currency.upper() if currency else None)
+    return float(number.replace(",", ".")), currency
+
+
 async def extract_amount_from_text(text: str) -> Tuple[Optional[float], Optional[str]]:
     """Legacy function - returns only amount and currency"""
     amount, currency, _ = await extract_expense_info(text)
     return amount, currency
 
 
-async def extract_multiple_expenses(text: str) -> List[Dict]:
+class JSONArrayStream:
     """
-    Extract MULTIPLE expenses from text using GPT.
-    Returns list of expenses: [{"amount": 200, "currency": "EUR", "description": "Окно", "payment_method": "cash"}, ...]
+    Incremental parser for a JSON array of objects arriving in pieces:
+    feed() returns the objects completed by the new text. Anything before
+    the array (e.g. a ```json fence) and after it is ignored
+    """
+
+    def __init__(self):
+        self._started = False
+        self._finished = False
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._current: List[str] = []
+
+    def feed(self, text: str) -> List:
+        objects = []
+        for ch in text:
+            if self._finished:
+                break
+            if not self._started:
+                if ch == "[":
+                    self._started = True
+                    self._depth = 1
+                continue
+
+            if self._depth >= 2:
+                self._current.append(ch)
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == '"':
+                self._in_string = True
+            elif ch in "[{":
+                self._depth += 1
+                if self._depth == 2:
+                    self._current = [ch]
+            elif ch in "]}":
+                self._depth -= 1
+                if self._depth == 1 and ch == "}":
+                    try:
+                        objects.append(json.loads("".join(self._current)))
+                    except json.JSONDecodeError:
+                        pass
+                elif self._depth == 0:
+                    self._finished = True
+        return objects
+
+
+def _clean_expense(item) -> Optional[Dict]:
+    """Validated expense dict from a parsed array item, None if it has no amount"""
+    if not isinstance(item, dict) or item.get("amount") is None:
+        return None
+    return {
+        "amount": float(item.get("amount")),
+        "currency": item.get("currency", "EUR"),
+        "description": item.get("description"),
+        "payment_method": item.get("payment_method")
+    }
+
+
+async def stream_multiple_expenses(text: str) -> AsyncIterator[Dict]:
+    """
+    Extract MULTIPLE expenses from text using GPT, yielding each expense as
+    soon as its JSON object is complete in the streamed response.
+    Items: {"amount": 200, "currency": "EUR", "description": "Окно", "payment_method": "cash"}
     """
     if not config.OPENAI_API_KEY:
-        return []
+        return
 
     prompt = """Извлеки ВСЕ расходы из текста. Верни JSON массив.
 
@@ -106,52 +195,51 @@ async def extract_multiple_expenses(text: str) -> List[Dict]:
 
 Текст: """ + text
 
+    parser = JSONArrayStream()
+    # Not the current span: the consumer runs between yields
+    span = tracing.start_span("openai.extract_expenses")
+    items = 0
     try:
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.post(
-                "https://api.openai.com/v1/chat/completions",
-                headers={
-                    "Authorization": f"Bearer {config.OPENAI_API_KEY}",
-                    "Content-Type": "application/json"
-                },
-                json={
-                    "model": "gpt-4o-mini",
-                    "messages": [
-                        {"role": "user", "content": prompt}
-                    ],
-                    "temperature": 0,
-                    "max_tokens": 500
-                }
-            )
-
-            if response.status_code == 200:
-                result = response.json()
-                content = result["choices"][0]["message"]["content"]
-
-                # Find JSON array in response
-                json_match = re.search(r'\[.*\]', content, re.DOTALL)
-                if json_match:
-                    data = json.loads(json_match.group())
-                    if isinstance(data, list):
-                        # Validate and clean data
-                        expenses = []
-                        for item in data:
-                            if isinstance(item, dict) and item.get("amount") is not None:
-                                expenses.append({
-                                    "amount": float(item.get("amount")),
-                                    "currency": item.get("currency", "EUR"),
-                                    "description": item.get("description"),
-                                    "payment_method": item.get("payment_method")
-                                })
-                        return expenses
-
-            return []
+        async for delta in openai_client.stream_chat_completion(
+            {
+                "model": "gpt-4o-mini",
+                "messages": [
+                    {"role": "user", "content": prompt}
+                ],
+                "temperature": 0,
+                "max_tokens": 500
+            },
+            timeout=30.0,
+        ):
+            for item in parser.feed(delta):
+                expense = _clean_expense(item)
+                if expense:
+                    items += 1
+                    yield expense
 
     except Exception as e:
-        print(f"Multiple expenses extraction error: {e}")
-        return []
+        # Expenses yielded before the error are kept
+        span.set(error=str(e)[:200])
+        logger.error(f"Multiple expenses extraction error: {e}")
+    finally:
+        span.set(items=items)
+        span.finish()
 
 
+async def extract_multiple_expenses(text: str) -> List[Dict]:
+    """
+    Extract MULTIPLE expenses from text using GPT.
+    Returns list of expenses: [{"amount": 200, "currency": "EUR", "description": "Окно", "payment_method": "cash"}, ...]
+    """
+    return [expense async for expense in stream_multiple_expenses(text)]
+
+
+def _read_base64(path: str) -> str:
+    with open(path, "rb") as f:
+        return base64.b64encode(f.read()).decode("utf-8")
+
+
+@tracing.traced("openai.extract_image")
 async def extract_from_image(image_path: str) -> Tuple[Optional[float], Optional[str], Optional[str]]:
     """
     Extract amount, currency and description from image using GPT-4 Vision
@@ -163,8 +251,8 @@ async def extract_from_image(image_path: str) -> Tuple[Optional[float], Optional
         return None, None, None
 
     try:
-        with open(image_path, "rb") as f:
-            image_data = base64.b64encode(f.read()).decode("utf-8")
+        # Reading and encoding a large photo would block the event loop
+        image_data = await asyncio.to_thread(_read_base64, image_path)
 
         if image_path.lower().endswith(".png"):
             mime_type = "image/png"
@@ -173,22 +261,23 @@ async def extract_from_image(image_path: str) -> Tuple[Optional[float], Optional
         else:
             mime_type = "image/jpeg"
 
-        async with httpx.AsyncClient(timeout=60.0) as client:
-            response = await client.post(
-                "https://api.openai.com/v1/chat/completions",
-                headers={
-                    "Authorization": f"Bearer {config.OPENAI_API_KEY}",
-                    "Content-Type": "application/json"
-                },
-                json={
-                    "model": "gpt-4o-mini",
-                    "messages": [
-                        {
-                            "role": "user",
-                            "content": [
-                                {
-                                    "type": "text",
-                                    "text": """Проанализируй изображение (чек, счёт, квитанция).
+        client = openai_client.get_client()
+        response = await client.post(
+            "https://api.openai.com/v1/chat/completions",
+            timeout=60.0,
+            headers={
+                "Authorization": f"Bearer {config.OPENAI_API_KEY}",
+                "Content-Type": "application/json"
+            },
+            json={
+                "model": "gpt-4o-mini",
+                "messages": [
+                    {
+                        "role": "user",
+                        "content": [
+                            {
+                                "type": "text",
+                                "text": """Проанализируй изображение (чек, счёт, квитанция).
 Верни JSON:
 - amount: итоговая сумма (Total/Итого)
 - currency: валюта (EUR/USD/RUB)
@@ -196,38 +285,38 @@ async def extract_from_image(image_path: str) -> Tuple[Optional[float], Optional
 
 Пример: {"amount": 25.50, "currency": "EUR", "description": "Кофе и выпечка"}
 Если не найдено: {"amount": null, "currency": null, "description": null}"""
-                                },
-                                {
-                                    "type": "image_url",
-                                    "image_url": {
-                                        "url": f"data:{mime_type};base64,{image_data}"
-                                    }
+                            },
+                            {
+                                "type": "image_url",
+                                "image_url": {
+                                    "url": f"data:{mime_type};base64,{image_data}"
                                 }
-                            ]
-                        }
-                    ],
-                    "max_tokens": 150
-                }
-            )
-
-            if response.status_code == 200:
-                result = response.json()
-                content = result["choices"][0]["message"]["content"]
-
-                json_match = re.search(r'\{[^}]+\}', content)
-                if json_match:
-                    data = json.loads(json_match.group())
-                    amount = data.get("amount")
-                    currency = data.get("currency", "EUR")
-                    description = data.get("description")
-                    if amount is not None:
-                        return float(amount), currency, description
-                    return None, None, description
+                            }
+                        ]
+                    }
+                ],
+                "max_tokens": 150
+            }
+        )
+
+        if response.status_code == 200:
+            result = response.json()
+            content = result["choices"][0]["message"]["content"]
+
+            json_match = re.search(r'\{[^}]+\}', content)
+            if json_match:
+                data = json.loads(json_match.group())
+                amount = data.get("amount")
+                currency = data.get("currency", "EUR")
+                description = data.get("description")
+                if amount is not None:
+                    return float(amount), currency, description
+                return None, None, description
 
-            return None, None, None
+        return None, None, None
 
     except Exception as e:
-        print(f"Image extraction error: {e}")
+        logger.error(f"Image extraction error: {e}")
         return None, None, None
 
 
@@ -238,29 +327,36 @@ async def extract_amount_from_image(image_path: str) -> Tuple[Optional[float], O
     return amount, currency
 
 
+def _pdf_text(pdf_path: str, max_pages: int = 5) -> str:
+    import pdfplumber
+
+    text_content = ""
+    with pdfplumber.open(pdf_path) as pdf:
+        for page in pdf.pages[:max_pages]:
+            page_text = page.extract_text()
+            if page_text:
+                text_content += page_text + "\n"
+    return text_content
+
+
+@tracing.traced("pdf.extract")
 async def extract_from_pdf(pdf_path: str) -> Tuple[Optional[float], Optional[str], Optional[str]]:
     """
     Extract amount, currency and description from PDF
     """
     try:
-        import pdfplumber
-
-        text_content = ""
-        with pdfplumber.open(pdf_path) as pdf:
-            for page in pdf.pages[:5]:
-                page_text = page.extract_text()
-                if page_text:
-                    text_content += page_text + "\n"
+        # PDF parsing is CPU-bound, keep it off the event loop
+        text_content = await asyncio.to_thread(_pdf_text, pdf_path)
 
         if not text_content.strip():
-            print("PDF: No text extracted")
+            logger.warning("PDF: No text extracted")
             return None, None, None
 
         text_content = text_content[:3000]
         return await extract_expense_info(text_content)
 
     except Exception as e:
-        print(f"PDF extraction error: {e}")
+        logger.error(f"PDF extraction error: {e}")
         return None, None, None
 
 
@@ -0,0 +1,70 @@
+"""
+Backfill the Dropbox upload index for expenses uploaded before it existed
+
+For every expense with a dropbox_url but no dropbox_hash, asks Dropbox for
+the content_hash and path of the shared file, stores the hash on the
+expense and adds the file to payme_dropbox_uploads, so later uploads of the
+same file reuse it. Safe to run again: handled expenses are skipped.
+
+    python src/backfill_dropbox_hashes.py
+"""
+import asyncio
+import logging
+import sys
+
+import httpx
+from sqlalchemy.orm import sessionmaker
+
+from config import config
+from database import Expense, init_db
+from dropbox_service import find_upload, record_upload, shared_file_hash
+import logging_setup
+
+logging_setup.setup(log_format="text")
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 200
+
+
+async def backfill(session) -> int:
+    """Hash uploaded expenses batch by batch (keyset on id), returns how many were hashed"""
+    hashed = 0
+    last_id = 0
+    async with httpx.AsyncClient(timeout=30.0) as client:
+        while True:
+            expenses = session.query(Expense).filter(
+                Expense.id > last_id,
+                Expense.dropbox_url.isnot(None),
+                Expense.dropbox_hash.is_(None),
+            ).order_by(Expense.id).limit(BATCH_SIZE).all()
+            if not expenses:
+                return hashed
+
+            for expense in expenses:
+                shared = await shared_file_hash(client, expense.dropbox_url)
+                if shared is None:
+                    logger.warning(f"Expense {expense.id}: {expense.dropbox_url} not found in Dropbox, skipped")
+                    continue
+                path, content_hash = shared
+                expense.dropbox_hash = content_hash
+                if find_upload(session, content_hash) is None:
+                    record_upload(session, content_hash, path, expense.dropbox_url)
+                hashed += 1
+
+            last_id = expenses[-1].id
+            session.commit()
+            logger.info(f"Hashed {hashed} uploads (up to expense {last_id})")
+
+
+def main():
+    session = sessionmaker(bind=init_db(config.DATABASE_URL))()
+    try:
+        hashed = asyncio.run(backfill(session))
+    finally:
+        session.close()
+    print(f"Done: {hashed} uploads hashed")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,114 @@
+"""
+Batches of pending expenses handled with one message (albums, multi-expense inputs)
+
+A batch is stored as a PendingAction row (action_type="batch") whose data
+holds the expense ids and title as JSON, so it survives bot restarts.
+Bulk actions apply to the selected pending expenses; the selection is a
+draft kept in chat_data (persisted write-behind, see persistence.py), so
+toggling items doesn't write to the database.
+"""
+import json
+from typing import List, MutableMapping, Optional
+
+from database import PendingAction, Expense, ExpenseStatus
+
+BATCH_ACTION = "batch"
+SELECTION_DRAFTS = "batch_selection"
+
+
+def create_batch(session, telegram_id: int, expense_ids: List[int], title: str) -> PendingAction:
+    """Add batch to session (committed by the caller)"""
+    batch = PendingAction(
+        telegram_id=telegram_id,
+        action_type=BATCH_ACTION,
+        data=json.dumps({"expense_ids": expense_ids, "title": title}, ensure_ascii=False),
+    )
+    session.add(batch)
+    session.flush()
+    return batch
+
+
+def get_batch(session, batch_id: int, telegram_id: int) -> Optional[PendingAction]:
+    """Batch owned by the given user"""
+    return session.query(PendingAction).filter_by(
+        id=batch_id, telegram_id=telegram_id, action_type=BATCH_ACTION
+    ).first()
+
+
+def batch_expense_ids(batch: PendingAction) -> List[int]:
+    return json.loads(batch.data or "{}").get("expense_ids", [])
+
+
+def batch_title(batch: PendingAction) -> str:
+    return json.loads(batch.data or "{}").get("title", "")
+
+
+def batch_selection(drafts: MutableMapping, batch: PendingAction, pending: List[Expense]) -> List[int]:
+    """Selected pending expense ids (all pending ones if nothing stored)"""
+    pending_ids = [e.id for e in pending]
+    selected = drafts.get(SELECTION_DRAFTS, {}).get(str(batch.id))
+    if selected is None:
+        return pending_ids
+    return [i for i in pending_ids if i in selected]
+
+
+def focused_item(drafts: MutableMapping, batch: PendingAction, expenses: List[Expense]) -> Optional[int]:
+    """
+    Number (1-based) of the item being categorized one by one: exactly one of
+    several pending items is selected. None in bulk mode
+    """
+    pending = [e for e in expenses if e.status == ExpenseStatus.PENDING]
+    selected = batch_selection(drafts, batch, pending)
+    if len(pending) < 2 or len(selected) != 1:
+        return None
+    return next(n for n, e in enumerate(expenses, start=1) if e.id == selected[0])
+
+
+def next_pending_item(expenses: List[Expense], after: int, exclude: List[int] = ()) -> Optional[Expense]:
+    """First pending expense after item number `after` (wrapping around), skipping exclude ids"""
+    ordered = expenses[after:] + expenses[:after]
+    return next((e for e in ordered if e.status == ExpenseStatus.PENDING and e.id not in exclude), None)
+
+
+def set_batch_selection(drafts: MutableMapping, batch: PendingAction, selected: Optional[List[int]]):
+    """Store selection draft (None = all pending)"""
+    selections = drafts.setdefault(SELECTION_DRAFTS, {})
+    if selected is None:
+        selections.pop(str(batch.id), None)
+        if not selections:
+            del drafts[SELECTION_DRAFTS]
+    else:
+        selections[str(batch.id)] = list(selected)
+
+
+def get_batch_expenses(session, batch: PendingAction, pending_only: bool = False) -> List[Expense]:
+    """Batch expenses in batch order"""
+    ids = batch_expense_ids(batch)
+    if not ids:
+        return []
+    query = session.query(Expense).filter(Expense.id.in_(ids))
+    if pending_only:
+        query = query.filter(Expense.status == ExpenseStatus.PENDING)
+    by_id = {e.id: e for e in query.all()}
+    return [by_id[i] for i in ids if i in by_id]
+
+
+def format_batch_item(index: int, expense: Expense, focused: bool = False) -> str:
+    """One line of the batch summary (plain text)"""
+    desc = expense.description or "—"
+    amount = f" — {expense.amount} {expense.currency}" if expense.amount is not None else ""
+    if expense.status == ExpenseStatus.CONFIRMED:
+        mark = "✅ "
+    elif expense.status == ExpenseStatus.CANCELLED:
+        mark = "❌ "
+    elif focused:
+        mark = "👉 "
+    else:
+        mark = ""
+    return f"{index}. {mark}{desc}{amount}"
+
+
+def format_batch_summary(expenses: List[Expense], title: str, focus: int = None) -> str:
+    """Batch title followed by one line per expense, focus marks the current item number"""
+    lines = [format_batch_item(i, e, focused=i == focus) for i, e in enumerate(expenses, start=1)]
+    return f"{title}\n\n" + "\n".join(lines)
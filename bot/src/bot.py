@@ -2,24 +2,29 @@
 Main Telegram Bot for Expense Tracking
 """
 import os
+import asyncio
 import logging
 from datetime import datetime
+from decimal import Decimal
+from typing import Optional
+from functools import partial
 from telegram import Update, BotCommand, MenuButtonCommands
 from telegram.ext import (
     Application,
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
+    TypeHandler,
     ContextTypes,
     filters,
 )
 
-from config import config, CallbackPrefix, Messages
+from config import config, CallbackAction, Messages
 import secrets
 import string
 from database import (
     init_db, get_session, seed_categories,
-    User, Category, Subcategory, Expense, PendingAction, InviteCode,
+    User, Category, Expense, PendingAction, InviteCode,
     InputType, ExpenseStatus, PaymentType
 )
 
@@ -32,20 +37,53 @@ def generate_invite_code(length=8):
 from keyboards import (
     get_transcription_confirmation_keyboard,
     get_categories_keyboard,
+    get_media_categories_keyboard,
     get_payment_type_keyboard,
     get_subcategories_keyboard,
-    get_amount_confirmation_keyboard,
     get_voice_with_amount_keyboard,
+    get_batch_categories_keyboard,
+    get_batch_subcategories_keyboard,
+    get_batch_payment_type_keyboard,
+    get_amount_input_keyboard,
+    with_suggestion,
+    with_shortcuts,
+    with_amount_edit,
 )
 from whisper_service import transcribe_telegram_voice
-from amount_extractor import extract_expense_info, extract_from_image, extract_from_pdf, extract_multiple_expenses
-from dropbox_service import upload_to_dropbox
+from amount_extractor import (
+    extract_expense_info, extract_from_image, extract_from_pdf, stream_multiple_expenses, parse_amount
+)
+from dropbox_service import (
+    upload_to_dropbox, upload_batch, BatchFile, dropbox_file_hash, token_manager as dropbox_tokens,
+)
+from concurrency import ChatOrderedUpdateProcessor
+from rate_limiter import create_rate_limiter
+from persistence import create_persistence
+from timings import StepTimer
+import openai_client
+import perf
+import tracing
+import logging_setup
+from dedup import (
+    skip_duplicate_update, mark_update_processed, handle_error, processed_updates, file_hashes, find_duplicate_expense, known_file_ids, DuplicateFile, FileHashes,
+)
+from media_queue import media_queue, JobPriority, QueueFull
+import file_store
+from file_store import upload_store
+from reconcile import reconciler
+from profiling import profiler, MODES as PROFILE_MODES
+from albums import album_collector
+from callback_router import callback_router, CallbackContext
+from catalog import get_catalog
+from suggestions import suggest_subcategory, expense_text, learn as learn_suggestions, load as load_suggestions
+from shortcuts import record_choice, top_choices, PAYMENT_CODES, PAYMENT_BY_CODE
+from batches import (
+    create_batch, get_batch_expenses, batch_title, batch_selection,
+    set_batch_selection, format_batch_summary, focused_item, next_pending_item,
+)
 
 # Setup logging
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
+logging_setup.setup()
 logger = logging.getLogger(__name__)
 
 # Database
@@ -58,6 +96,7 @@ def get_db():
     global engine, Session
     if engine is None:
         engine = init_db(config.DATABASE_URL)
+        tracing.instrument_engine(engine)
         from sqlalchemy.orm import sessionmaker
         Session = sessionmaker(bind=engine)
         # Seed categories
@@ -225,6 +264,58 @@ async def users_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         session.close()
 
 
+async def reconcile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle /reconcile command (admin only): upload missing Dropbox files now"""
+    if update.effective_user.id not in config.admin_ids_list:
+        await update.message.reply_text(Messages.NOT_AUTHORIZED)
+        return
+    if reconciler.running:
+        await update.message.reply_text(Messages.RECONCILE_RUNNING)
+        return
+
+    status_msg = await update.message.reply_text(Messages.RECONCILE_STARTED)
+
+    async def report(progress):
+        await status_msg.edit_text(Messages.RECONCILE_PROGRESS.format(**vars(progress)))
+
+    async def run():
+        progress = await reconciler.run(get_db, on_progress=report)
+        if progress is None:
+            await status_msg.edit_text(Messages.RECONCILE_UNAVAILABLE)
+        else:
+            await status_msg.edit_text(Messages.RECONCILE_DONE.format(**vars(progress)))
+
+    # May take a while, the chat stays free meanwhile
+    context.application.create_task(run(), update=update)
+
+
+async def perf_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle /perf command (admin only): live latency percentiles"""
+    if update.effective_user.id not in config.admin_ids_list:
+        await update.message.reply_text(Messages.NOT_AUTHORIZED)
+        return
+    await update.message.reply_text(perf.report(), parse_mode='HTML')
+
+
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle /profile command (admin only): /profile [on [percent] [stack|cprofile] | off]"""
+    if update.effective_user.id not in config.admin_ids_list:
+        await update.message.reply_text(Messages.NOT_AUTHORIZED)
+        return
+
+    args = context.args or []
+    if args:
+        switch, options = args[0].lower(), [a.lower() for a in args[1:]]
+        percent = next((a.rstrip('%') for a in options if a.rstrip('%').replace('.', '', 1).isdigit()), None)
+        mode = next((a for a in options if a in PROFILE_MODES), None)
+        if switch not in ('on', 'off') or len(options) != (percent is not None) + (mode is not None):
+            await update.message.reply_text(Messages.PROFILE_USAGE)
+            return
+        profiler.configure(switch == 'on', percent=float(percent) if percent else None, mode=mode)
+
+    await update.message.reply_text(profiler.status(), parse_mode='HTML')
+
+
 async def invite_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /invite command (admin only) - generate invite code"""
     session = get_db()
@@ -331,8 +422,26 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         text = update.message.text
 
+        # A draft waiting for its amount takes the message if it is just one
+        typed = parse_amount(text) if AMOUNT_INPUT in context.user_data else None
+        if typed and await _apply_typed_amount(context, session, *typed):
+            return
+
+        # Expenses are listed as they stream in; the preview message becomes the final reply
+        preview_msg = None
+
+        async def preview(items):
+            nonlocal preview_msg
+            summary = _streamed_summary(Messages.TEXT_BATCH_TITLE.format(count=len(items)), items)
+            if preview_msg is None:
+                preview_msg = asyncio.ensure_future(update.message.reply_text(summary))
+                await preview_msg
+            else:
+                await (await preview_msg).edit_text(summary)
+
         # Extract MULTIPLE expenses from text
-        expenses_data = await extract_multiple_expenses(text)
+        expenses_data = await _stream_expenses(text, preview)
+        status_msg = await preview_msg if preview_msg else None
 
         # If no expenses found, fallback to single extraction
         if not expenses_data:
@@ -354,7 +463,26 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 "payment_method": None
             }]
 
-        categories = session.query(Category).filter_by(is_active=True).order_by(Category.order_num).all()
+        # Several expenses - one message with bulk actions
+        if len(expenses_data) > 1:
+            expenses = [
+                Expense(
+                    user_id=db_user.id,
+                    input_type=InputType.TEXT,
+                    original_text=text,
+                    amount=exp_data.get("amount"),
+                    currency=exp_data.get("currency", "EUR"),
+                    description=exp_data.get("description"),
+                    payment_type=_payment_type_from_method(exp_data.get("payment_method")),
+                    status=ExpenseStatus.PENDING
+                )
+                for exp_data in expenses_data
+            ]
+            title = Messages.TEXT_BATCH_TITLE.format(count=len(expenses))
+            await _reply_with_batch(
+                update.message, session, context.chat_data, user.id, expenses, title, status_msg=status_msg
+            )
+            return
 
         # Create expense records and send messages for each
         for exp_data in expenses_data:
@@ -374,10 +502,11 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
             desc_line = f"📝 *{exp_data.get('description')}*\n" if exp_data.get('description') else ""
             amount_line = f"💰 *{exp_data.get('amount')} {exp_data.get('currency', 'EUR')}*\n" if exp_data.get('amount') else ""
 
-            await update.message.reply_text(
+            send = status_msg.edit_text if status_msg else update.message.reply_text
+            await send(
                 f"{desc_line}{amount_line}\n" + Messages.SELECT_CATEGORY,
                 parse_mode='Markdown',
-                reply_markup=get_categories_keyboard(categories, expense.id)
+                reply_markup=_categories_keyboard(session, expense, context.user_data)
             )
     finally:
         session.close()
@@ -395,212 +524,832 @@ def _format_payment_method(method: str) -> str:
     return methods.get(method.lower(), method)
 
 
-async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handle photo messages - payment_type=BANK by default"""
+def _payment_type_from_method(method: str):
+    """Map extracted payment_method (cash/card/transfer) to PaymentType"""
+    if not method:
+        return None
+    if method.lower() == "cash":
+        return PaymentType.CASH
+    if method.lower() in ("card", "transfer"):
+        return PaymentType.BANK
+    return None
+
+
+def _categories_keyboard(session, expense, user_data=None, markup=None):
+    """
+    Category keyboard of an expense with one-tap rows on top: the user's
+    frequent choices, then the suggested subcategory unless it is one of them
+    """
+    catalog = get_catalog(session)
+    markup = markup or get_categories_keyboard(catalog, expense.id)
+
+    subcategory = suggest_subcategory(catalog, expense)
+    shortcuts = []
+    if user_data is not None:
+        # Media expenses are always paid by bank
+        payment_type = PaymentType.BANK if expense.input_type in MEDIA_INPUT_TYPES else None
+        for subcategory_id, choice_payment in top_choices(user_data, config.FREQUENT_SHORTCUTS, payment_type):
+            entry = catalog.subcategory(subcategory_id)
+            if entry:
+                shortcuts.append((entry, PAYMENT_CODES.get(choice_payment, 0)))
+
+    if subcategory and all(entry.id != subcategory.id for entry, _ in shortcuts):
+        markup = with_suggestion(markup, catalog, subcategory, CallbackAction.SUBCATEGORY, expense.id)
+    if shortcuts:
+        markup = with_shortcuts(markup, shortcuts, expense.id)
+    return markup
+
+
+def _streamed_summary(title: str, items: list) -> str:
+    """Batch-style list of the expenses extracted so far"""
+    expenses = [
+        Expense(
+            # Shown like a stored Numeric(10, 2) amount
+            amount=Decimal(str(item["amount"])).quantize(Decimal("0.01")) if item.get("amount") is not None else None,
+            currency=item.get("currency", "EUR"),
+            description=item.get("description"),
+            status=ExpenseStatus.PENDING
+        )
+        for item in items
+    ]
+    return format_batch_summary(expenses, title) + "\n\n" + Messages.EXTRACTING_MORE
+
+
+async def _stream_expenses(text: str, preview) -> list:
+    """
+    Extract expenses from text, calling preview(items so far) as each one arrives.
+    Previews run as tasks, so a throttled message edit doesn't hold up the stream
+    """
+    items, previews = [], []
+    async for item in stream_multiple_expenses(text):
+        items.append(item)
+        previews.append(asyncio.ensure_future(preview(list(items))))
+
+    for result in await asyncio.gather(*previews, return_exceptions=True):
+        if isinstance(result, Exception):
+            logger.debug(f"[Stream] preview failed: {result}")
+    return items
+
+
+def _batch_view(session, batch, drafts, note: str = None):
+    """Batch summary with selection toggles and category keyboard"""
+    expenses = get_batch_expenses(session, batch)
+    pending = [e for e in expenses if e.status == ExpenseStatus.PENDING]
+    selected = batch_selection(drafts, batch, pending)
+    selection = [
+        (number, e.id in selected)
+        for number, e in enumerate(expenses, start=1)
+        if e.status == ExpenseStatus.PENDING
+    ]
+
+    focus = focused_item(drafts, batch, expenses)
+    if focus:
+        prompt = Messages.BATCH_SELECT_ITEM_CATEGORY.format(number=focus, pending=len(pending))
+    else:
+        prompt = Messages.BATCH_SELECT_CATEGORY.format(selected=len(selected), pending=len(pending))
+    text = format_batch_summary(expenses, batch_title(batch), focus) + f"\n\n{note or prompt}"
+
+    catalog = get_catalog(session)
+    keyboard = get_batch_categories_keyboard(catalog, batch.id, selection)
+    if focus:
+        # One by one: the focused item's suggested subcategory is one tap away
+        subcategory = suggest_subcategory(catalog, expenses[focus - 1])
+        if subcategory:
+            keyboard = with_suggestion(keyboard, catalog, subcategory, CallbackAction.BATCH_SUBCATEGORY, batch.id)
+    return text, keyboard
+
+
+async def _reply_with_batch(message, session, drafts, telegram_id: int, expenses: list, title: str, status_msg=None):
+    """Insert expenses and their batch in one transaction, reply with one batch message"""
+    session.add_all(expenses)
+    session.flush()
+    batch = create_batch(session, telegram_id, [e.id for e in expenses], title)
+    session.commit()
+
+    text, keyboard = _batch_view(session, batch, drafts)
+    if status_msg:
+        await status_msg.edit_text(text, reply_markup=keyboard)
+    else:
+        await message.reply_text(text, reply_markup=keyboard)
+
+
+class _OrderedStatus:
+    """
+    Status message edited from several tasks (queue position, status, streamed
+    preview, final reply): edits are applied one at a time in call order, one
+    superseded before it started is dropped, unchanged text is not resent
+    """
+
+    def __init__(self, message):
+        self.message = message
+        self._lock = asyncio.Lock()
+        self._requested = 0
+        self._text = None
+
+    async def edit_text(self, text: str, **kwargs):
+        self._requested += 1
+        number = self._requested
+        async with self._lock:
+            if number != self._requested or (text == self._text and not kwargs):
+                return
+            await self.message.edit_text(text, **kwargs)
+            self._text = text
+
+
+def _queue_status_updater(status_msg, text: str):
+    """Show the job's queue position in its status message"""
+    async def on_position(position: int):
+        if position:
+            await status_msg.edit_text(f"{text}\n" + Messages.QUEUE_POSITION.format(position=position))
+        else:
+            await status_msg.edit_text(text)
+    return on_position
+
+
+async def _submit_media_job(
+    user_id: int, priority: JobPriority, job, status_msg, status_text: str = None, on_position=None
+):
+    """
+    Run job through the media queue.
+    Returns job result, or None if the job was rejected (status message explains why)
+    """
+    try:
+        return await media_queue.submit(
+            user_id, priority, job,
+            on_position=on_position or _queue_status_updater(status_msg, status_text)
+        )
+    except QueueFull as e:
+        logger.info(f"[Queue] Rejected {priority.name.lower()} job for user {user_id}: {e}")
+        await status_msg.edit_text(Messages.QUEUE_USER_FULL if e.per_user else Messages.QUEUE_FULL)
+        return None
+
+
+async def _stored_file_hash(db_user_id: int, file_path: str) -> FileHashes:
+    """
+    Content hashes of a downloaded file.
+    Raises DuplicateFile (and drops the new copy) if the user already sent this file
+    """
+    hashes = await file_hashes(file_path)
     session = get_db()
     try:
-        user = update.effective_user
+        existing = find_duplicate_expense(session, db_user_id, content_hash=hashes.content_hash)
+        if existing is None:
+            return hashes
+        existing_id, existing_path = existing.id, existing.file_path
+    finally:
+        session.close()
 
-        if not is_authorized(user.id, session):
-            await update.message.reply_text(Messages.NOT_AUTHORIZED)
-            return
+    if os.path.abspath(existing_path or "") != os.path.abspath(file_path):
+        os.remove(file_path)
+    raise DuplicateFile(existing_id)
 
-        db_user = get_or_create_user(
-            user.id, user.username, user.first_name, user.last_name, session
-        )
 
-        status_msg = await update.message.reply_text("⏳ Обрабатываю фото")
+async def _show_duplicate(status_msg, expense_id: int):
+    """Point a resent file to its existing expense instead of processing it again"""
+    session = get_db()
+    try:
+        expense = session.query(Expense).filter_by(id=expense_id).first()
+        desc_line = f"📝 {expense.description}\n" if expense.description else ""
+        amount_line = f"💰 {expense.amount} {expense.currency}\n" if expense.amount is not None else ""
+        text = f"{Messages.DUPLICATE_FILE}\n{desc_line}{amount_line}\n"
+
+        if expense.status == ExpenseStatus.CONFIRMED:
+            await status_msg.edit_text(text + Messages.DUPLICATE_SAVED)
+        else:
+            await status_msg.edit_text(
+                text + Messages.SELECT_CATEGORY,
+                reply_markup=get_categories_keyboard(get_catalog(session), expense.id)
+            )
+    finally:
+        session.close()
+
 
-        # Get the largest photo
-        photo = update.message.photo[-1]
+MEDIA_INPUT_TYPES = (InputType.PHOTO, InputType.DOCUMENT)
 
-        # Save file
-        os.makedirs(config.UPLOAD_DIR, exist_ok=True)
-        file = await context.bot.get_file(photo.file_id)
-        file_path = os.path.join(config.UPLOAD_DIR, f"photo_{photo.file_id}.jpg")
-        await file.download_to_drive(file_path)
+# user_data key: media draft whose amount the user is typing, {"expense_id", "chat_id", "message_id"}
+AMOUNT_INPUT = "amount_input"
 
-        # Extract amount and description from image
-        amount, currency, description = await extract_from_image(file_path)
 
-        # Create expense record with payment_type=BANK
+def _media_draft_view(session, expense, note: str = None, user_data=None):
+    """
+    Text and keyboard of a photo/document expense.
+    The keyboard is sent before extraction finishes (file_path is still empty
+    then), the header fills in with the amount once it does and the amount
+    can be edited from then on.
+    """
+    lines = [f"📄 {expense.file_name}"] if expense.file_name else []
+    if expense.file_path is None:
+        lines.append(note or Messages.MEDIA_EXTRACTING)
+    else:
+        if expense.description:
+            lines.append(f"📝 {expense.description}")
+        if expense.amount is not None:
+            lines.append(f"💰 Сумма: {expense.amount} {expense.currency}")
+        else:
+            lines.append(Messages.AMOUNT_NOT_FOUND)
+    lines.append("💳 Оплата: Bank")
+    header = "\n".join(lines) + "\n\n"
+
+    catalog = get_catalog(session)
+    if expense.subcategory_id:
+        category = catalog.category(expense.category_id)
+        subcategory = catalog.subcategory(expense.subcategory_id)
+        header += f"📂 {category.name if category else '—'} → {subcategory.name if subcategory else '—'}\n"
+        if expense.file_path is None:
+            # Picked while extraction was running, saved when it finishes
+            return header + Messages.MEDIA_SAVE_PENDING, None
+        # Extraction found no amount for the picked subcategory: ask for it before saving
+        return (
+            header + Messages.ENTER_AMOUNT,
+            get_amount_input_keyboard(expense.id, expense.amount, expense.currency),
+        )
+    if expense.category_id:
+        markup = get_subcategories_keyboard(catalog, expense.category_id, expense.id)
+        text = header + Messages.SELECT_SUBCATEGORY
+    else:
+        markup = _categories_keyboard(session, expense, user_data, get_media_categories_keyboard(catalog, expense.id))
+        text = header + Messages.SELECT_CATEGORY
+    if expense.file_path is not None:
+        markup = with_amount_edit(markup, expense.id)
+    return text, markup
+
+
+def _create_media_draft(
+    db_user_id: int, input_type: InputType, file_id: str, file_unique_id: str, file_name=None, user_data=None
+):
+    """
+    Pending expense for a photo/document before its extraction (blocking, run in a thread).
+    Returns (duplicate expense id, None) for a resent file, else (None, (expense id, text, keyboard))
+    """
+    session = get_db()
+    try:
+        duplicate = find_duplicate_expense(session, db_user_id, file_unique_id=file_unique_id)
+        if duplicate:
+            return duplicate.id, None
+
         expense = Expense(
-            user_id=db_user.id,
-            input_type=InputType.PHOTO,
-            file_id=photo.file_id,
-            file_path=file_path,
-            amount=amount,
-            currency=currency or 'EUR',
+            user_id=db_user_id,
+            input_type=input_type,
+            file_id=file_id,
+            file_unique_id=file_unique_id,
+            file_name=file_name,
+            currency='EUR',
             payment_type=PaymentType.BANK,
             status=ExpenseStatus.PENDING
         )
         session.add(expense)
         session.commit()
+        text, markup = _media_draft_view(session, expense, user_data=user_data)
+        return None, (expense.id, text, markup)
+    finally:
+        session.close()
 
-        # Delete status message
-        await status_msg.delete()
 
-        # Show amount confirmation
-        if amount:
-            desc_line = f"📝 *{description}*\n" if description else ""
-            await update.message.reply_text(
-                f"{desc_line}"
-                f"💰 Сумма: *{amount} {currency}*\n"
-                f"💳 Оплата: *Bank*\n\n"
-                f"Всё верно?",
-                parse_mode='Markdown',
-                reply_markup=get_amount_confirmation_keyboard(expense.id, amount, currency)
-            )
-        else:
-            # No amount found, go to categories
-            desc_line = f"📝 {description}\n\n" if description else ""
-            categories = session.query(Category).filter_by(is_active=True).order_by(Category.order_num).all()
-            await update.message.reply_text(
-                f"{desc_line}Сумма не найдена\n💳 Оплата: *Bank*\n\n" + Messages.SELECT_CATEGORY,
-                parse_mode='Markdown',
-                reply_markup=get_categories_keyboard(categories, expense.id)
-            )
+def _cancel_media_draft(expense_id: int):
+    session = get_db()
+    try:
+        session.query(Expense).filter_by(id=expense_id, status=ExpenseStatus.PENDING).update(
+            {Expense.status: ExpenseStatus.CANCELLED}, synchronize_session=False
+        )
+        session.commit()
     finally:
         session.close()
 
 
-async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handle document messages (PDF, etc.) - payment_type=BANK by default"""
+def _load_media_draft_view(expense_id: int, note: str = None, user_data=None):
+    """Text and keyboard of a pending media draft, None if it is no longer pending (blocking, run in a thread)"""
     session = get_db()
-    status_msg = None
     try:
-        user = update.effective_user
-        logger.info(f"[Document] Received from user {user.id}")
+        expense = session.query(Expense).filter_by(id=expense_id).first()
+        if expense is None or expense.status != ExpenseStatus.PENDING:
+            return None
+        return _media_draft_view(session, expense, note, user_data)
+    finally:
+        session.close()
+
+
+async def _refresh_media_draft(status_msg, expense_id: int, note: str = None, user_data=None):
+    """Re-render a media draft message from its current state (e.g. with the queue position)"""
+    view = await asyncio.to_thread(_load_media_draft_view, expense_id, note, user_data)
+    if view is not None:
+        text, markup = view
+        await status_msg.edit_text(text, reply_markup=markup)
+
+
+# Held while a media draft's extraction result or category pick is committed and read back
+_media_draft_lock = asyncio.Lock()
 
+
+def _merge_media_result(session, expense_id: int, file_path: str, hashes, amount, currency, description):
+    """Store the extracted columns of a media draft, returns the draft (blocking, run in a thread)"""
+    # Only the extracted columns, so category taps committed meanwhile aren't overwritten
+    session.query(Expense).filter_by(id=expense_id).update({
+        Expense.file_path: file_path,
+        Expense.content_hash: hashes.content_hash,
+        Expense.dropbox_hash: hashes.dropbox_hash,
+        Expense.amount: amount,
+        Expense.currency: currency or 'EUR',
+        Expense.description: description,
+    }, synchronize_session=False)
+    session.commit()
+    return session.query(Expense).filter_by(id=expense_id).first()
+
+
+async def _complete_media_draft(
+    user_id: int, priority: JobPriority, job, status_msg, expense_id: int, user_data=None
+):
+    """
+    Run the extraction job of a media draft and merge its result into the draft.
+    Category taps made meanwhile are kept; a subcategory picked already saves the
+    expense now if an amount was found, else the user is asked for the amount.
+    """
+    queued = False
+
+    async def on_position(position: int):
+        nonlocal queued
+        queued = queued or position > 0
+        if queued:
+            note = Messages.QUEUE_POSITION.format(position=position) if position else None
+            await _refresh_media_draft(status_msg, expense_id, note, user_data)
+
+    try:
+        result = await _submit_media_job(user_id, priority, job, status_msg, on_position=on_position)
+    except DuplicateFile as e:
+        await asyncio.to_thread(_cancel_media_draft, expense_id)
+        await _show_duplicate(status_msg, e.expense_id)
+        return
+    except Exception as e:
+        logger.error(f"[Media] Extraction for expense {expense_id} failed: {e}", exc_info=True)
+        await asyncio.to_thread(_cancel_media_draft, expense_id)
+        await status_msg.edit_text(Messages.ERROR)
+        return
+    if result is None:
+        await asyncio.to_thread(_cancel_media_draft, expense_id)
+        return
+
+    session = get_db()
+    try:
+        # on_subcategory / on_shortcut commit a pick and read file_path back under the same lock,
+        # so exactly one side sees both the subcategory and the extraction result and saves
+        async with _media_draft_lock:
+            expense = await asyncio.to_thread(_merge_media_result, session, expense_id, *result)
+        if expense is None or expense.status != ExpenseStatus.PENDING:
+            return
+        if expense.subcategory_id and expense.amount is not None:
+            await _save_expense(status_msg.edit_text, session, expense, user_data)
+            return
+        if expense.subcategory_id and user_data is not None:
+            _await_amount(user_data, expense.id, status_msg)
+        text, markup = await asyncio.to_thread(_media_draft_view, session, expense, None, user_data)
+    finally:
+        session.close()
+    await status_msg.edit_text(text, reply_markup=markup)
+
+
+def _await_amount(user_data, expense_id: int, message):
+    """Take the user's next text message as the amount of this draft (see _apply_typed_amount)"""
+    user_data[AMOUNT_INPUT] = {"expense_id": expense_id, "chat_id": message.chat_id, "message_id": message.message_id}
+
+
+async def _apply_typed_amount(context: ContextTypes.DEFAULT_TYPE, session, amount: float, currency) -> bool:
+    """
+    Amount the user typed for a media draft awaiting it: update the draft
+    message, saving the expense if its subcategory is picked already.
+    Returns False if the draft is gone (cancelled, saved)
+    """
+    awaited = context.user_data.pop(AMOUNT_INPUT)
+    expense = session.query(Expense).filter_by(id=awaited["expense_id"]).first()
+    if expense is None or expense.status != ExpenseStatus.PENDING:
+        return False
+    expense.amount = amount
+    expense.currency = currency or expense.currency or 'EUR'
+    session.commit()
+
+    edit = partial(context.bot.edit_message_text, chat_id=awaited["chat_id"], message_id=awaited["message_id"])
+    if expense.subcategory_id:
+        await _save_expense(edit, session, expense, context.user_data)
+        return True
+    text, markup = _media_draft_view(session, expense, user_data=context.user_data)
+    await edit(text, reply_markup=markup)
+    return True
+
+
+def _authorize_user(user) -> Optional[int]:
+    """DB user id of an authorized Telegram user, None if not authorized (blocking, run in a thread)"""
+    session = get_db()
+    try:
         if not is_authorized(user.id, session):
+            return None
+        return get_or_create_user(user.id, user.username, user.first_name, user.last_name, session).id
+    finally:
+        session.close()
+
+
+def _check_authorized(telegram_id: int) -> bool:
+    """is_authorized with its own session (blocking, run in a thread)"""
+    session = get_db()
+    try:
+        return is_authorized(telegram_id, session)
+    finally:
+        session.close()
+
+
+def _user_row_id(user) -> int:
+    """DB user id of a Telegram user, created on first use (blocking, run in a thread)"""
+    session = get_db()
+    try:
+        return get_or_create_user(user.id, user.username, user.first_name, user.last_name, session).id
+    finally:
+        session.close()
+
+
+async def _start_media_update(update: Update, steps: StepTimer, status_text: str):
+    """
+    Authorize the sender, then send the status reply and look up the user row together.
+    Returns (status message, DB user id), None if the sender is not authorized (told so)
+    """
+    user = update.effective_user
+    if not await steps.run("auth", asyncio.to_thread(_check_authorized, user.id)):
+        await update.message.reply_text(Messages.NOT_AUTHORIZED)
+        return None
+    return await asyncio.gather(
+        steps.run("status", update.message.reply_text(status_text)),
+        steps.run("user", asyncio.to_thread(_user_row_id, user)),
+    )
+
+
+def _warm_catalog():
+    """Load the category catalog ahead of the keyboard that needs it (blocking, run in a thread)"""
+    session = get_db()
+    try:
+        get_catalog(session)
+    finally:
+        session.close()
+
+
+async def _log_steps(update: Update, steps: StepTimer, coro):
+    """
+    Run a handler's background part and log its step timings.
+    The update counts as processed only once this part succeeded (see dedup.py)
+    """
+    try:
+        result = await profiler.background(coro)
+    except BaseException:
+        processed_updates.failed(update.update_id)
+        raise
+    finally:
+        steps.log()
+        await processed_updates.finish(update.update_id)
+    return result
+
+
+def _continue_in_background(update: Update, context: ContextTypes.DEFAULT_TYPE, steps: StepTimer, coro):
+    """Hand the rest of a media update to a task, the chat stays free meanwhile"""
+    processed_updates.hand_off(update.update_id)
+    context.application.create_task(_log_steps(update, steps, coro), update=update)
+
+
+def _find_file_duplicate(db_user_id: int, file_unique_id: str):
+    """Id of the user's existing expense for this Telegram file, if any"""
+    session = get_db()
+    try:
+        existing = find_duplicate_expense(session, db_user_id, file_unique_id=file_unique_id)
+        return existing.id if existing else None
+    finally:
+        session.close()
+
+
+async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle photo messages - payment_type=BANK by default"""
+    media_group_id = update.message.media_group_id
+
+    # Further album items join the album started by its first item
+    if media_group_id and album_collector.is_collecting(media_group_id):
+        album_collector.add(update)
+        return
+
+    if media_group_id:
+        db_user_id = await asyncio.to_thread(_authorize_user, update.effective_user)
+        if db_user_id is None:
             await update.message.reply_text(Messages.NOT_AUTHORIZED)
             return
+        album_collector.add(update, partial(_process_album, context, db_user_id))
+        return
 
-        db_user = get_or_create_user(
-            user.id, user.username, user.first_name, user.last_name, session
-        )
+    steps = StepTimer("photo")
+    started = await _start_media_update(update, steps, "⏳ Обрабатываю фото")
+    if started is None:
+        return
+    status_msg, db_user_id = started
 
-        status_msg = await update.message.reply_text("⏳ Обрабатываю документ")
+    # Extraction waits in the media queue, the chat stays free meanwhile
+    _continue_in_background(update, context, steps, _process_photo(update, context, db_user_id, status_msg, steps))
 
-        document = update.message.document
-        logger.info(f"[Document] file_name={document.file_name}, mime_type={document.mime_type}")
 
-        # Save file
-        os.makedirs(config.UPLOAD_DIR, exist_ok=True)
-        file = await context.bot.get_file(document.file_id)
-        file_path = os.path.join(config.UPLOAD_DIR, f"doc_{document.file_id}_{document.file_name}")
-        await file.download_to_drive(file_path)
-        logger.info(f"[Document] Saved to {file_path}")
+async def _process_photo(
+    update: Update, context: ContextTypes.DEFAULT_TYPE, db_user_id: int, status_msg, steps: StepTimer
+):
+    """Send the category keyboard right away, extract the photo in the media queue meanwhile"""
+    # Get the largest photo
+    photo = update.message.photo[-1]
 
-        # Try to extract amount and description based on file type
-        amount, currency, description = None, None, None
-        try:
-            if document.mime_type and document.mime_type.startswith('image/'):
-                logger.info("[Document] Extracting from image...")
-                amount, currency, description = await extract_from_image(file_path)
-            elif document.mime_type == 'application/pdf' or file_path.lower().endswith('.pdf'):
-                logger.info("[Document] Extracting from PDF...")
-                amount, currency, description = await extract_from_pdf(file_path)
-            logger.info(f"[Document] Extracted: amount={amount}, currency={currency}, desc={description}")
-        except Exception as e:
-            logger.error(f"[Document] Extraction error: {e}")
+    # The keyboard needs only the draft expense, file metadata and OpenAI connection load meanwhile
+    file_task = asyncio.ensure_future(steps.run("get_file", context.bot.get_file(photo.file_id)))
+    prewarm_task = asyncio.ensure_future(steps.run("prewarm", openai_client.prewarm()))
+    expense_id = None
+    try:
+        duplicate_id, draft = await steps.run("draft", asyncio.to_thread(
+            _create_media_draft, db_user_id, InputType.PHOTO, photo.file_id, photo.file_unique_id,
+            None, context.user_data
+        ))
+        if duplicate_id:
+            await _show_duplicate(status_msg, duplicate_id)
+            return
+        expense_id, text, markup = draft
+        await steps.run("keyboard", status_msg.edit_text(text, reply_markup=markup))
 
-        # Create expense record with payment_type=BANK
-        expense = Expense(
-            user_id=db_user.id,
-            input_type=InputType.DOCUMENT,
-            file_id=document.file_id,
-            file_path=file_path,
-            file_name=document.file_name,
-            amount=amount,
-            currency=currency or 'EUR',
-            payment_type=PaymentType.BANK,
-            status=ExpenseStatus.PENDING
+        async def job():
+            file, _ = await asyncio.gather(file_task, prewarm_task)
+
+            # Save file
+            file_path = await steps.run("download", file_store.download(file, "photo", ".jpg"))
+            hashes = await steps.run("hash", _stored_file_hash(db_user_id, file_path))
+
+            # Extract amount and description from image
+            amount, currency, description = await steps.run("extract", extract_from_image(file_path))
+            return file_path, hashes, amount, currency, description
+
+        await _complete_media_draft(
+            update.effective_user.id, JobPriority.PHOTO, job, status_msg, expense_id, context.user_data
         )
-        session.add(expense)
-        session.commit()
-        logger.info(f"[Document] Expense saved with id={expense.id}")
 
+    except Exception as e:
+        logger.error(f"[Photo] Error: {e}", exc_info=True)
+        await _fail_media_draft(update, status_msg, expense_id, f"❌ Ошибка обработки фото: {e}")
+    finally:
+        _drop_tasks(file_task, prewarm_task)
+
+
+def _drop_tasks(*tasks):
+    """Cancel helper tasks nobody awaits anymore, retrieving the errors of finished ones"""
+    for task in tasks:
+        if not task.done():
+            task.cancel()
+        elif not task.cancelled():
+            task.exception()
+
+
+async def _fail_media_draft(update: Update, status_msg, expense_id: Optional[int], text: str):
+    """Photo/document handling failed: drop the draft, replace the status message by the error"""
+    if expense_id is not None:
+        await asyncio.to_thread(_cancel_media_draft, expense_id)
+    try:
         await status_msg.delete()
-        status_msg = None
-
-        # Escape markdown special characters
-        def escape_md(text):
-            if not text:
-                return text
-            for char in ['_', '*', '[', ']', '(', ')', '~', '`', '>', '#', '+', '-', '=', '|', '{', '}', '.', '!']:
-                text = str(text).replace(char, '\\' + char)
-            return text
-
-        safe_filename = escape_md(document.file_name)
-        safe_desc = escape_md(description)
-
-        # Show result
-        if amount:
-            desc_line = f"📝 {safe_desc}\n" if safe_desc else ""
-            await update.message.reply_text(
-                f"📄 {safe_filename}\n"
-                f"{desc_line}"
-                f"💰 Сумма: *{amount} {currency}*\n"
-                f"💳 Оплата: *Bank*\n\n"
-                f"Всё верно?",
-                parse_mode='Markdown',
-                reply_markup=get_amount_confirmation_keyboard(expense.id, amount, currency)
-            )
-        else:
-            desc_line = f"📝 {safe_desc}\n\n" if safe_desc else ""
-            categories = session.query(Category).filter_by(is_active=True).order_by(Category.order_num).all()
-            await update.message.reply_text(
-                f"📄 {safe_filename}\n{desc_line}💳 Оплата: *Bank*\n\n" + Messages.SELECT_CATEGORY,
-                parse_mode='Markdown',
-                reply_markup=get_categories_keyboard(categories, expense.id)
-            )
-        logger.info("[Document] Response sent successfully")
+    except Exception:
+        pass
+    await update.message.reply_text(text)
 
-    except Exception as e:
-        logger.error(f"[Document] Error: {e}", exc_info=True)
-        if status_msg:
-            try:
-                await status_msg.delete()
-            except:
-                pass
-        await update.message.reply_text(f"❌ Ошибка обработки документа: {e}")
+
+def _known_album_files(db_user_id: int, file_unique_ids: list) -> set:
+    session = get_db()
+    try:
+        return known_file_ids(session, db_user_id, file_unique_ids)
     finally:
         session.close()
 
 
-async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handle voice messages - supports multiple expenses in one message"""
+def _album_failure_text(rejections: list, duplicates: int) -> str:
+    """Status of an album none of whose photos became an expense, by why they were rejected"""
+    if not rejections:
+        return Messages.ALBUM_ALL_DUPLICATES
+    if all(isinstance(e, QueueFull) for e in rejections):
+        per_user = any(e.per_user for e in rejections)
+        text = Messages.QUEUE_USER_FULL if per_user else Messages.QUEUE_FULL
+    elif any(isinstance(e, QueueFull) for e in rejections):
+        # Some waited for the queue, some failed: the photos are worth sending again
+        text = Messages.ALBUM_REJECTED.format(count=len(rejections))
+    else:
+        text = Messages.ERROR
+    if duplicates:
+        text += "\n" + Messages.ALBUM_DUPLICATES.format(count=duplicates)
+    return text
+
+
+async def _process_album(context: ContextTypes.DEFAULT_TYPE, db_user_id: int, updates: list):
+    """Extract all photos of an album concurrently and reply with one batch message"""
+    first = updates[0]
+    telegram_id = first.effective_user.id
+    photos = [u.message.photo[-1] for u in updates]
+
+    status_text = Messages.ALBUM_PROCESSING.format(count=len(photos))
+    status_msg, known, _ = await asyncio.gather(
+        first.message.reply_text(status_text),
+        asyncio.to_thread(_known_album_files, db_user_id, [p.file_unique_id for p in photos]),
+        openai_client.prewarm(),
+    )
+    duplicates = sum(1 for p in photos if p.file_unique_id in known)
+    photos = [p for p in photos if p.file_unique_id not in known]
+
+    # Each photo's job reports its queue position, the status shows the last photo's
+    status_msg = _OrderedStatus(status_msg)
+    show_position = _queue_status_updater(status_msg, status_text)
+    positions = {}
+    # Why photos were not extracted: QueueFull or an error
+    rejections = []
+
+    async def extract(photo):
+        nonlocal duplicates
+
+        async def on_position(position: int):
+            positions[photo.file_unique_id] = position
+            await show_position(max(positions.values()))
+
+        async def job():
+            file = await context.bot.get_file(photo.file_id)
+            file_path = await file_store.download(file, "photo", ".jpg")
+            hashes = await _stored_file_hash(db_user_id, file_path)
+
+            amount, currency, description = await extract_from_image(file_path)
+            return file_path, hashes, amount, currency, description
+
+        try:
+            return await media_queue.submit(telegram_id, JobPriority.PHOTO, job, on_position=on_position)
+        except QueueFull as e:
+            rejections.append(e)
+            return None
+        except DuplicateFile:
+            duplicates += 1
+            return None
+        except Exception as e:
+            logger.error(f"[Album] Photo {photo.file_id} error: {e}")
+            rejections.append(e)
+            return None
+        finally:
+            positions.pop(photo.file_unique_id, None)
+
+    results = await asyncio.gather(*(extract(photo) for photo in photos))
+
     session = get_db()
     try:
-        user = update.effective_user
+        # All expenses and the batch in one transaction
+        expenses = []
+        for photo, result in zip(photos, results):
+            if result is None:
+                continue
+            file_path, hashes, amount, currency, description = result
+            expenses.append(Expense(
+                user_id=db_user_id,
+                input_type=InputType.PHOTO,
+                file_id=photo.file_id,
+                file_unique_id=photo.file_unique_id,
+                content_hash=hashes.content_hash,
+                dropbox_hash=hashes.dropbox_hash,
+                file_path=file_path,
+                amount=amount,
+                currency=currency or 'EUR',
+                description=description,
+                payment_type=PaymentType.BANK,
+                status=ExpenseStatus.PENDING
+            ))
 
-        if not is_authorized(user.id, session):
-            await update.message.reply_text(Messages.NOT_AUTHORIZED)
+        rejected = len(rejections)
+        if not expenses:
+            await status_msg.edit_text(_album_failure_text(rejections, duplicates))
             return
 
-        db_user = get_or_create_user(
-            user.id, user.username, user.first_name, user.last_name, session
+        title = Messages.ALBUM_TITLE.format(count=len(expenses))
+        if rejected:
+            title += "\n" + Messages.ALBUM_REJECTED.format(count=rejected)
+        if duplicates:
+            title += "\n" + Messages.ALBUM_DUPLICATES.format(count=duplicates)
+
+        await _reply_with_batch(
+            first.message, session, context.chat_data, telegram_id, expenses, title, status_msg=status_msg
         )
+    finally:
+        session.close()
 
-        status_msg = await update.message.reply_text("⏳ Распознаю голосовое")
 
-        voice = update.message.voice
+async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle document messages (PDF, etc.) - payment_type=BANK by default"""
+    logger.info(f"[Document] Received from user {update.effective_user.id}")
 
-        # Transcribe voice
-        transcription, file_path = await transcribe_telegram_voice(context.bot, voice.file_id)
+    steps = StepTimer("document")
+    started = await _start_media_update(update, steps, "⏳ Обрабатываю документ")
+    if started is None:
+        return
+    status_msg, db_user_id = started
 
-        if not transcription:
-            await status_msg.delete()
-            await update.message.reply_text(
-                "Не удалось распознать голосовое сообщение. Попробуйте ещё раз."
-            )
+    # Extraction waits in the media queue, the chat stays free meanwhile
+    _continue_in_background(update, context, steps, _process_document(update, context, db_user_id, status_msg, steps))
+
+
+async def _process_document(
+    update: Update, context: ContextTypes.DEFAULT_TYPE, db_user_id: int, status_msg, steps: StepTimer
+):
+    """Send the category keyboard right away, extract the document in the media queue meanwhile"""
+    document = update.message.document
+    logger.info(f"[Document] file_name={document.file_name}, mime_type={document.mime_type}")
+
+    # The keyboard needs only the draft expense, file metadata and OpenAI connection load meanwhile
+    file_task = asyncio.ensure_future(steps.run("get_file", context.bot.get_file(document.file_id)))
+    prewarm_task = asyncio.ensure_future(steps.run("prewarm", openai_client.prewarm()))
+    expense_id = None
+    try:
+        duplicate_id, draft = await steps.run("draft", asyncio.to_thread(
+            _create_media_draft, db_user_id, InputType.DOCUMENT,
+            document.file_id, document.file_unique_id, document.file_name, context.user_data
+        ))
+        if duplicate_id:
+            await _show_duplicate(status_msg, duplicate_id)
             return
+        expense_id, text, markup = draft
+        await steps.run("keyboard", status_msg.edit_text(text, reply_markup=markup))
+        logger.info(f"[Document] Draft expense id={expense_id}")
+
+        async def job():
+            file, _ = await asyncio.gather(file_task, prewarm_task)
+
+            # Save file
+            ext = os.path.splitext(document.file_name or "")[1]
+            file_path = await steps.run("download", file_store.download(file, "doc", ext))
+            logger.info(f"[Document] Saved to {file_path}")
+            hashes = await steps.run("hash", _stored_file_hash(db_user_id, file_path))
+
+            # Try to extract amount and description based on file type
+            amount, currency, description = None, None, None
+            try:
+                if document.mime_type and document.mime_type.startswith('image/'):
+                    logger.info("[Document] Extracting from image...")
+                    amount, currency, description = await steps.run("extract", extract_from_image(file_path))
+                elif document.mime_type == 'application/pdf' or file_path.lower().endswith('.pdf'):
+                    logger.info("[Document] Extracting from PDF...")
+                    amount, currency, description = await steps.run("extract", extract_from_pdf(file_path))
+                logger.info(f"[Document] Extracted: amount={amount}, currency={currency}, desc={description}")
+            except Exception as e:
+                logger.error(f"[Document] Extraction error: {e}")
+            return file_path, hashes, amount, currency, description
+
+        await _complete_media_draft(
+            update.effective_user.id, JobPriority.DOCUMENT, job, status_msg, expense_id, context.user_data
+        )
+
+    except Exception as e:
+        logger.error(f"[Document] Error: {e}", exc_info=True)
+        await _fail_media_draft(update, status_msg, expense_id, f"❌ Ошибка обработки документа: {e}")
+    finally:
+        _drop_tasks(file_task, prewarm_task)
+
+
+async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle voice messages - supports multiple expenses in one message"""
+    steps = StepTimer("voice")
+    started = await _start_media_update(update, steps, "⏳ Распознаю голосовое")
+    if started is None:
+        return
+    status_msg, db_user_id = started
+
+    # Transcription waits in the media queue, the chat stays free meanwhile
+    _continue_in_background(update, context, steps, _process_voice(update, context, db_user_id, status_msg, steps))
+
+
+async def _process_voice(
+    update: Update, context: ContextTypes.DEFAULT_TYPE, db_user_id: int, status_msg, steps: StepTimer
+):
+    """Transcribe and extract voice message in the media queue, then create expenses"""
+    voice = update.message.voice
+    # Queue position, status and preview edits overlap, the last one must win
+    status_msg = _OrderedStatus(status_msg)
+
+    # Independent lookups together: duplicate check, file metadata, catalog, OpenAI connection
+    duplicate_id, file, _, _ = await asyncio.gather(
+        steps.run("dedup", asyncio.to_thread(_find_file_duplicate, db_user_id, voice.file_unique_id)),
+        steps.run("get_file", context.bot.get_file(voice.file_id)),
+        steps.run("catalog", asyncio.to_thread(_warm_catalog)),
+        steps.run("prewarm", openai_client.prewarm()),
+    )
+    if duplicate_id:
+        await _show_duplicate(status_msg, duplicate_id)
+        return
 
-        await status_msg.edit_text("⏳ Анализирую расходы")
+    async def job():
+        # Download and transcribe voice
+        transcription, file_path = await steps.run(
+            "transcribe", transcribe_telegram_voice(context.bot, voice.file_id, file)
+        )
+        if not transcription:
+            return None, file_path, []
 
-        # Extract MULTIPLE expenses from transcription
-        expenses_data = await extract_multiple_expenses(transcription)
+        # Status edit doesn't need to hold up the extraction
+        status_edit = asyncio.ensure_future(status_msg.edit_text("⏳ Анализирую расходы"))
+
+        async def preview(items):
+            title = Messages.VOICE_BATCH_TITLE.format(transcription=transcription)
+            await status_msg.edit_text(_streamed_summary(title, items))
+
+        # Extract MULTIPLE expenses from transcription, listing them as they arrive
+        expenses_data = await steps.run("extract", _stream_expenses(transcription, preview))
+        await status_edit
 
         # If no expenses found, fallback to single extraction
         if not expenses_data:
@@ -612,15 +1361,29 @@ async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     "description": description,
                     "payment_method": None
                 }]
+        return transcription, file_path, expenses_data
 
-        await status_msg.delete()
+    result = await _submit_media_job(
+        update.effective_user.id, JobPriority.VOICE, job, status_msg, "⏳ Распознаю голосовое"
+    )
+    if result is None:
+        return
+    transcription, file_path, expenses_data = result
 
+    if not transcription:
+        await status_msg.edit_text("Не удалось распознать голосовое сообщение. Попробуйте ещё раз.")
+        return
+
+    # Status message is reused for the reply: one edit instead of delete + send
+    session = get_db()
+    try:
         # If still nothing found
         if not expenses_data:
             expense = Expense(
-                user_id=db_user.id,
+                user_id=db_user_id,
                 input_type=InputType.VOICE,
                 file_id=voice.file_id,
+                file_unique_id=voice.file_unique_id,
                 file_path=file_path,
                 transcription=transcription,
                 status=ExpenseStatus.PENDING
@@ -628,7 +1391,7 @@ async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
             session.add(expense)
             session.commit()
 
-            await update.message.reply_text(
+            await status_msg.edit_text(
                 f"🎤 _{transcription}_\n\n"
                 f"Сумма не найдена\n\n"
                 f"Всё верно?",
@@ -637,20 +1400,38 @@ async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return
 
-        categories = session.query(Category).filter_by(is_active=True).order_by(Category.order_num).all()
-
-        # Show transcription first
-        await update.message.reply_text(
-            f"🎤 _{transcription}_",
-            parse_mode='Markdown'
-        )
+        # Several expenses - one message with bulk actions
+        if len(expenses_data) > 1:
+            expenses = [
+                Expense(
+                    user_id=db_user_id,
+                    input_type=InputType.VOICE,
+                    file_id=voice.file_id,
+                    file_unique_id=voice.file_unique_id,
+                    file_path=file_path,
+                    transcription=transcription,
+                    amount=exp_data.get("amount"),
+                    currency=exp_data.get("currency", "EUR"),
+                    description=exp_data.get("description"),
+                    payment_type=_payment_type_from_method(exp_data.get("payment_method")),
+                    status=ExpenseStatus.PENDING
+                )
+                for exp_data in expenses_data
+            ]
+            title = Messages.VOICE_BATCH_TITLE.format(transcription=transcription)
+            await _reply_with_batch(
+                update.message, session, context.chat_data, update.effective_user.id, expenses, title,
+                status_msg=status_msg
+            )
+            return
 
-        # Create expense records and send messages for each
+        # Transcription and the expense in one message
         for exp_data in expenses_data:
             expense = Expense(
-                user_id=db_user.id,
+                user_id=db_user_id,
                 input_type=InputType.VOICE,
                 file_id=voice.file_id,
+                file_unique_id=voice.file_unique_id,
                 file_path=file_path,
                 transcription=transcription,
                 amount=exp_data.get("amount"),
@@ -665,23 +1446,40 @@ async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
             desc_line = f"📝 *{exp_data.get('description')}*\n" if exp_data.get('description') else ""
             amount_line = f"💰 *{exp_data.get('amount')} {exp_data.get('currency', 'EUR')}*\n" if exp_data.get('amount') else ""
 
-            await update.message.reply_text(
-                f"{desc_line}{amount_line}\n" + Messages.SELECT_CATEGORY,
+            await status_msg.edit_text(
+                f"🎤 _{transcription}_\n\n{desc_line}{amount_line}\n" + Messages.SELECT_CATEGORY,
                 parse_mode='Markdown',
-                reply_markup=get_categories_keyboard(categories, expense.id)
+                reply_markup=_categories_keyboard(session, expense, context.user_data)
             )
     finally:
         session.close()
 
 
-async def _save_expense(query, session, expense):
-    """Save expense and show confirmation"""
+def _load_for_save(session, expense):
+    """Catalog, with the expense's attributes expired by earlier commits loaded (blocking, run in a thread)"""
+    session.refresh(expense)
+    return get_catalog(session)
+
+
+def _commit_expense(session, expense):
+    """Commit and load the expense back (blocking, run in a thread)"""
+    session.commit()
+    session.refresh(expense)
+
+
+async def _save_expense(edit, session, expense, user_data=None):
+    """
+    Save expense and show confirmation (edit: query.edit_message_text or message.edit_text).
+    user_data: the user's state, its frequent choices count this one.
+    Callers commit their changes first; database work runs in threads
+    """
+    # Get category info for Dropbox folder
+    catalog = await asyncio.to_thread(_load_for_save, session, expense)
     expense.status = ExpenseStatus.CONFIRMED
     expense.confirmed_at = datetime.utcnow()
 
-    # Get category info for Dropbox folder
-    category = session.query(Category).filter_by(id=expense.category_id).first()
-    subcategory = session.query(Subcategory).filter_by(id=expense.subcategory_id).first()
+    category = catalog.category(expense.category_id)
+    subcategory = catalog.subcategory(expense.subcategory_id)
 
     # Upload to Dropbox if there's a file
     dropbox_url = None
@@ -692,11 +1490,16 @@ async def _save_expense(query, session, expense):
         logger.info(f"[Dropbox] file_exists={file_exists}")
 
         if file_exists:
+            # Voice files and older expenses are hashed here, photos and documents on download
+            if not expense.dropbox_hash:
+                expense.dropbox_hash = await dropbox_file_hash(expense.file_path)
             dropbox_url = await upload_to_dropbox(
                 expense.file_path,
                 category.code if category else "UNCATEGORIZED",
                 subcategory.code if subcategory else "",
-                expense.id
+                expense.id,
+                content_hash=expense.dropbox_hash,
+                session=session
             )
             logger.info(f"[Dropbox] upload result: {dropbox_url}")
 
@@ -709,7 +1512,10 @@ async def _save_expense(query, session, expense):
     else:
         logger.info(f"[Dropbox] No file_path for expense {expense.id} (input_type={expense.input_type})")
 
-    session.commit()
+    await asyncio.to_thread(_commit_expense, session, expense)
+    learn_suggestions([(expense_text(expense), expense.subcategory_id)])
+    if user_data is not None and expense.subcategory_id:
+        record_choice(user_data, expense.subcategory_id, expense.payment_type)
 
     payment_type_names = {
         PaymentType.CASH: "💵 Cash",
@@ -721,7 +1527,7 @@ async def _save_expense(query, session, expense):
     payment_str = f"\n💳 {payment_type_names.get(expense.payment_type, '—')}" if expense.payment_type else ""
     dropbox_str = f"\n📎 [Dropbox]({dropbox_url})" if dropbox_url else ""
 
-    await query.edit_message_text(
+    await edit(
         f"✅ *Сохранено*\n"
         f"\n📂 {category.name if category else '—'} → {subcategory.name if subcategory else '—'}"
         f"{amount_str}"
@@ -732,13 +1538,105 @@ async def _save_expense(query, session, expense):
     )
 
 
+def _load_batch_for_save(session, batch):
+    """Batch expenses and the catalog (blocking, run in a thread)"""
+    return get_batch_expenses(session, batch), get_catalog(session)
+
+
+def _confirm_batch(session, batch, ids, values):
+    """One UPDATE for the selected pending expenses, returns them reloaded (blocking, run in a thread)"""
+    session.query(Expense).filter(
+        Expense.id.in_(ids),
+        Expense.status == ExpenseStatus.PENDING
+    ).update(values, synchronize_session=False)
+    session.commit()
+    session.refresh(batch)
+    return session.query(Expense).filter(Expense.id.in_(ids)).all()
+
+
+def _batch_saved_view(session, batch, drafts, saved: str) -> tuple:
+    """Message after saving part of a batch: the remaining items, or the final summary (blocking, run in a thread)"""
+    if get_batch_expenses(session, batch, pending_only=True):
+        # Continue with the remaining items in the same message
+        text, keyboard = _batch_view(session, batch, drafts)
+        return f"{saved}\n\n{text}", keyboard
+    summary = format_batch_summary(get_batch_expenses(session, batch), batch_title(batch))
+    return f"{summary}\n\n{saved}", None
+
+
+async def _save_batch(query, session, drafts, batch, subcategory, payment_type=None, user_data=None):
+    """Confirm selected batch expenses with one UPDATE and one message edit (database work in threads)"""
+    all_expenses, catalog = await asyncio.to_thread(_load_batch_for_save, session, batch)
+    pending = [e for e in all_expenses if e.status == ExpenseStatus.PENDING]
+    selected_ids = batch_selection(drafts, batch, pending)
+    expenses = [e for e in pending if e.id in selected_ids]
+    if not expenses or not subcategory:
+        await query.edit_message_text(Messages.BATCH_NOT_FOUND)
+        return
+
+    category = catalog.category(subcategory.category_id)
+    ids = [e.id for e in expenses]
+
+    values = {
+        Expense.category_id: subcategory.category_id,
+        Expense.subcategory_id: subcategory.id,
+        Expense.status: ExpenseStatus.CONFIRMED,
+        Expense.confirmed_at: datetime.utcnow(),
+    }
+    if payment_type:
+        values[Expense.payment_type] = payment_type
+
+    # One by one: move on to the next pending item, otherwise all remaining ones are selected
+    focus = focused_item(drafts, batch, all_expenses)
+    following = next_pending_item(all_expenses, focus, exclude=ids) if focus else None
+
+    examples = [(expense_text(e), subcategory.id) for e in expenses]
+    payment_types = [payment_type or e.payment_type for e in expenses]
+    expenses = await asyncio.to_thread(_confirm_batch, session, batch, ids, values)
+    learn_suggestions(examples)
+    if user_data is not None:
+        for expense_payment in payment_types:
+            record_choice(user_data, subcategory.id, expense_payment)
+    set_batch_selection(drafts, batch, [following.id] if following else None)
+
+    # Upload files to Dropbox: concurrently, one commit for the batch
+    with_files = [e for e in expenses if e.file_path and os.path.exists(e.file_path)]
+    # Files of one voice message are shared by its expenses: uploaded once, then reused
+    unhashed = [e for e in with_files if not e.dropbox_hash]
+    for expense, dropbox_hash in zip(
+        unhashed, await asyncio.gather(*(dropbox_file_hash(e.file_path) for e in unhashed))
+    ):
+        expense.dropbox_hash = dropbox_hash
+    urls = await upload_batch([
+        BatchFile(e.id, e.file_path, category.code if category else "UNCATEGORIZED", e.dropbox_hash)
+        for e in with_files
+    ], session)
+    for expense in with_files:
+        if expense.id in urls:
+            expense.dropbox_url = urls[expense.id]
+        else:
+            logger.warning(f"[Dropbox] No upload for expense {expense.id}")
+    await asyncio.to_thread(session.commit)
+    uploaded = len(urls)
+
+    saved = Messages.BATCH_SAVED.format(
+        count=len(ids),
+        category=category.name if category else '—',
+        subcategory=subcategory.name
+    )
+    if uploaded:
+        saved += f"\n📎 Dropbox: {uploaded}"
+
+    text, keyboard = await asyncio.to_thread(_batch_saved_view, session, batch, drafts, saved)
+    await query.edit_message_text(text, reply_markup=keyboard)
+
+
 # Callback handlers
 async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle inline button callbacks"""
     query = update.callback_query
     await query.answer()
 
-    data = query.data
     session = get_db()
 
     try:
@@ -746,186 +1644,367 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await query.edit_message_text(Messages.NOT_AUTHORIZED)
             return
 
-        # Parse callback data
-        parts = data.split(":")
+        await callback_router.dispatch(CallbackContext(update, context, session))
+    finally:
+        session.close()
 
-        if data.startswith(CallbackPrefix.CONFIRM_TRANSCRIPTION):
-            # Confirm transcription, show categories
-            expense_id = int(parts[1])
-            categories = session.query(Category).filter_by(is_active=True).order_by(Category.order_num).all()
 
-            await query.edit_message_text(
-                Messages.TRANSCRIPTION_CONFIRMED,
-                reply_markup=get_categories_keyboard(categories, expense_id)
-            )
+@callback_router.route(CallbackAction.CONFIRM_TRANSCRIPTION, "expense_id", load_expense=True)
+async def on_confirm_transcription(ctx: CallbackContext):
+    """Confirm transcription, show categories"""
+    if ctx.expense:
+        keyboard = _categories_keyboard(ctx.session, ctx.expense, ctx.user_data)
+    else:
+        keyboard = get_categories_keyboard(get_catalog(ctx.session), ctx.args["expense_id"])
+    await ctx.query.edit_message_text(Messages.TRANSCRIPTION_CONFIRMED, reply_markup=keyboard)
+
+
+@callback_router.route(CallbackAction.RETRY_TRANSCRIPTION, "expense_id", load_expense=True)
+async def on_retry_transcription(ctx: CallbackContext):
+    """User wants to re-record - cancel current expense"""
+    if ctx.expense:
+        ctx.expense.status = ExpenseStatus.CANCELLED
+        ctx.session.commit()
+
+    await ctx.query.edit_message_text(Messages.TRANSCRIPTION_RETRY)
+
+
+@callback_router.route(CallbackAction.CONFIRM_AMOUNT, "expense_id", load_expense=True)
+async def on_confirm_amount(ctx: CallbackContext):
+    """Amount kept as it is (or none): media drafts go on where they were, others show categories"""
+    expense = ctx.expense
+    if expense and expense.input_type in MEDIA_INPUT_TYPES:
+        if (ctx.user_data.get(AMOUNT_INPUT) or {}).get("expense_id") == expense.id:
+            del ctx.user_data[AMOUNT_INPUT]
+        if expense.status != ExpenseStatus.PENDING:
+            await ctx.query.edit_message_text(Messages.ERROR)
+        elif expense.subcategory_id:
+            await _save_expense(ctx.query.edit_message_text, ctx.session, expense, ctx.user_data)
+        else:
+            text, markup = _media_draft_view(ctx.session, expense, user_data=ctx.user_data)
+            await ctx.query.edit_message_text(text, reply_markup=markup)
+        return
 
-        elif data.startswith(CallbackPrefix.RETRY_TRANSCRIPTION):
-            # User wants to re-record
-            expense_id = int(parts[1])
-
-            # Cancel current expense
-            expense = session.query(Expense).filter_by(id=expense_id).first()
-            if expense:
-                expense.status = ExpenseStatus.CANCELLED
-                session.commit()
-
-            await query.edit_message_text(Messages.TRANSCRIPTION_RETRY)
-
-        elif data.startswith(CallbackPrefix.CONFIRM_AMOUNT):
-            # Amount confirmed, show categories
-            expense_id = int(parts[1])
-
-            # Check if "no amount" option
-            if len(parts) > 2 and parts[2] == "no":
-                expense = session.query(Expense).filter_by(id=expense_id).first()
-                if expense:
-                    expense.amount = None
-                    session.commit()
-
-            categories = session.query(Category).filter_by(is_active=True).order_by(Category.order_num).all()
-            await query.edit_message_text(
-                Messages.SELECT_CATEGORY,
-                reply_markup=get_categories_keyboard(categories, expense_id)
-            )
+    await ctx.query.edit_message_text(
+        Messages.SELECT_CATEGORY,
+        reply_markup=get_categories_keyboard(get_catalog(ctx.session), ctx.args["expense_id"])
+    )
 
-        elif data.startswith(CallbackPrefix.EDIT_AMOUNT):
-            # User wants to edit amount - for now just skip amount
-            expense_id = int(parts[1])
-            expense = session.query(Expense).filter_by(id=expense_id).first()
-            if expense:
-                expense.amount = None
-                session.commit()
-
-            categories = session.query(Category).filter_by(is_active=True).order_by(Category.order_num).all()
-            await query.edit_message_text(
-                "Сумма пропущена\n\n" + Messages.SELECT_CATEGORY,
-                reply_markup=get_categories_keyboard(categories, expense_id)
-            )
 
-        elif data.startswith(CallbackPrefix.PAYMENT_CASH):
-            # Set payment type to CASH and save
-            expense_id = int(parts[1])
-            expense = session.query(Expense).filter_by(id=expense_id).first()
-            if expense:
-                try:
-                    expense.payment_type = PaymentType.CASH
-                    session.commit()
-                    await _save_expense(query, session, expense)
-                except Exception as e:
-                    logger.error(f"Error saving expense (CASH): {e}")
-                    await query.edit_message_text(f"Ошибка сохранения: {e}")
-            else:
-                await query.edit_message_text("Расход не найден")
-
-        elif data.startswith(CallbackPrefix.PAYMENT_BANK):
-            # Set payment type to BANK and save
-            expense_id = int(parts[1])
-            expense = session.query(Expense).filter_by(id=expense_id).first()
-            if expense:
-                try:
-                    expense.payment_type = PaymentType.BANK
-                    session.commit()
-                    await _save_expense(query, session, expense)
-                except Exception as e:
-                    logger.error(f"Error saving expense (BANK): {e}")
-                    await query.edit_message_text(f"Ошибка сохранения: {e}")
-            else:
-                await query.edit_message_text("Расход не найден")
-
-        elif data.startswith(CallbackPrefix.CATEGORY):
-            # Category selected, show subcategories
-            category_id = int(parts[1])
-            expense_id = int(parts[2])
-
-            # Update expense with category
-            expense = session.query(Expense).filter_by(id=expense_id).first()
-            if expense:
-                expense.category_id = category_id
-                session.commit()
-
-            # Get subcategories
-            subcategories = session.query(Subcategory).filter_by(
-                category_id=category_id, is_active=True
-            ).order_by(Subcategory.order_num).all()
-
-            await query.edit_message_text(
-                Messages.SELECT_SUBCATEGORY,
-                reply_markup=get_subcategories_keyboard(subcategories, category_id, expense_id)
-            )
+@callback_router.route(CallbackAction.EDIT_AMOUNT, "expense_id", load_expense=True)
+async def on_edit_amount(ctx: CallbackContext):
+    """Ask for the amount, the next text message sets it (see handle_text)"""
+    expense = ctx.expense
+    if not expense or expense.status != ExpenseStatus.PENDING:
+        await ctx.query.edit_message_text(Messages.ERROR)
+        return
 
-        elif data.startswith(CallbackPrefix.SUBCATEGORY):
-            # Subcategory selected, show payment type selection
-            subcategory_id = int(parts[1])
-            expense_id = int(parts[2])
-
-            # Update expense with subcategory
-            expense = session.query(Expense).filter_by(id=expense_id).first()
-            if expense:
-                expense.subcategory_id = subcategory_id
-                session.commit()
-
-                # For PHOTO/DOCUMENT - payment_type already set to BANK, save directly
-                if expense.input_type in [InputType.PHOTO, InputType.DOCUMENT]:
-                    await _save_expense(query, session, expense)
-                else:
-                    # For TEXT/VOICE - ask for payment type
-                    subcategory = session.query(Subcategory).filter_by(id=subcategory_id).first()
-                    await query.edit_message_text(
-                        f"📝 *{expense.description or '—'}*\n"
-                        f"💰 *{expense.amount} {expense.currency}*\n"
-                        f"📂 {subcategory.name if subcategory else '—'}\n\n"
-                        f"Выберите способ оплаты:",
-                        parse_mode='Markdown',
-                        reply_markup=get_payment_type_keyboard(expense_id)
-                    )
-            else:
-                await query.edit_message_text(Messages.ERROR)
+    _await_amount(ctx.user_data, expense.id, ctx.query.message)
+    await ctx.query.edit_message_text(
+        Messages.ENTER_AMOUNT,
+        reply_markup=get_amount_input_keyboard(expense.id, expense.amount, expense.currency)
+    )
 
-        elif data.startswith(CallbackPrefix.BACK_TO_SUBCATEGORY):
-            # Go back to subcategory selection from payment type
-            expense_id = int(parts[1])
-            expense = session.query(Expense).filter_by(id=expense_id).first()
 
-            if expense and expense.category_id:
-                subcategories = session.query(Subcategory).filter_by(
-                    category_id=expense.category_id, is_active=True
-                ).order_by(Subcategory.order_num).all()
+async def _set_payment_and_save(ctx: CallbackContext, payment_type: PaymentType):
+    """Set payment type and save"""
+    if not ctx.expense:
+        await ctx.query.edit_message_text("Расход не найден")
+        return
 
-                await query.edit_message_text(
-                    Messages.SELECT_SUBCATEGORY,
-                    reply_markup=get_subcategories_keyboard(subcategories, expense.category_id, expense_id)
-                )
-            else:
-                # Fallback to categories if no category selected
-                categories = session.query(Category).filter_by(is_active=True).order_by(Category.order_num).all()
-                await query.edit_message_text(
-                    Messages.SELECT_CATEGORY,
-                    reply_markup=get_categories_keyboard(categories, expense_id)
-                )
+    try:
+        ctx.expense.payment_type = payment_type
+        ctx.session.commit()
+        await _save_expense(ctx.query.edit_message_text, ctx.session, ctx.expense, ctx.user_data)
+    except Exception as e:
+        logger.error(f"Error saving expense ({payment_type.value}): {e}")
+        await ctx.query.edit_message_text(f"Ошибка сохранения: {e}")
 
-        elif data.startswith(CallbackPrefix.BACK):
-            # Go back to categories
-            expense_id = int(parts[1])
-            categories = session.query(Category).filter_by(is_active=True).order_by(Category.order_num).all()
 
-            await query.edit_message_text(
-                Messages.SELECT_CATEGORY,
-                reply_markup=get_categories_keyboard(categories, expense_id)
-            )
+@callback_router.route(CallbackAction.PAYMENT_CASH, "expense_id", load_expense=True)
+async def on_payment_cash(ctx: CallbackContext):
+    await _set_payment_and_save(ctx, PaymentType.CASH)
 
-        elif data.startswith(CallbackPrefix.CANCEL):
-            # Cancel operation
-            expense_id = int(parts[1])
 
-            expense = session.query(Expense).filter_by(id=expense_id).first()
-            if expense:
-                expense.status = ExpenseStatus.CANCELLED
-                session.commit()
+@callback_router.route(CallbackAction.PAYMENT_BANK, "expense_id", load_expense=True)
+async def on_payment_bank(ctx: CallbackContext):
+    await _set_payment_and_save(ctx, PaymentType.BANK)
 
-            await query.edit_message_text(Messages.CANCELLED)
 
-    finally:
-        session.close()
+@callback_router.route(CallbackAction.CATEGORY, "category_id", "expense_id", load_expense=True)
+async def on_category(ctx: CallbackContext):
+    """Category selected, show subcategories"""
+    category_id = ctx.args["category_id"]
+
+    if ctx.expense:
+        ctx.expense.category_id = category_id
+        ctx.session.commit()
+
+        if ctx.expense.input_type in MEDIA_INPUT_TYPES:
+            text, markup = _media_draft_view(ctx.session, ctx.expense, user_data=ctx.user_data)
+            await ctx.query.edit_message_text(text, reply_markup=markup)
+            return
+
+    await ctx.query.edit_message_text(
+        Messages.SELECT_SUBCATEGORY,
+        reply_markup=get_subcategories_keyboard(get_catalog(ctx.session), category_id, ctx.args["expense_id"])
+    )
+
+
+@callback_router.route(CallbackAction.SUBCATEGORY, "subcategory_id", "expense_id", load_expense=True)
+async def on_subcategory(ctx: CallbackContext):
+    """Subcategory selected, show payment type selection"""
+    expense = ctx.expense
+    if not expense:
+        await ctx.query.edit_message_text(Messages.ERROR)
+        return
+
+    subcategory_id = ctx.args["subcategory_id"]
+    expense.subcategory_id = subcategory_id
+    if not expense.category_id:
+        # Suggested subcategories are picked without a category tap
+        subcategory = get_catalog(ctx.session).subcategory(subcategory_id)
+        expense.category_id = subcategory.category_id if subcategory else None
+    async with _media_draft_lock:
+        ctx.session.commit()
+        extracting = expense.file_path is None
+
+    # For PHOTO/DOCUMENT - payment_type already set to BANK, save directly
+    if expense.input_type in MEDIA_INPUT_TYPES:
+        if extracting:
+            # Extraction still running, _complete_media_draft saves it
+            text, markup = _media_draft_view(ctx.session, expense, user_data=ctx.user_data)
+            await ctx.query.edit_message_text(text, reply_markup=markup)
+            return
+        await _save_expense(ctx.query.edit_message_text, ctx.session, expense, ctx.user_data)
+        return
+
+    # For TEXT/VOICE - ask for payment type
+    subcategory = get_catalog(ctx.session).subcategory(subcategory_id)
+    await ctx.query.edit_message_text(
+        f"📝 *{expense.description or '—'}*\n"
+        f"💰 *{expense.amount} {expense.currency}*\n"
+        f"📂 {subcategory.name if subcategory else '—'}\n\n"
+        f"Выберите способ оплаты:",
+        parse_mode='Markdown',
+        reply_markup=get_payment_type_keyboard(expense.id)
+    )
+
+
+@callback_router.route(CallbackAction.SHORTCUT, "subcategory_id", "payment", "expense_id", load_expense=True)
+async def on_shortcut(ctx: CallbackContext):
+    """Frequent choice: category, subcategory and payment type in one tap, then save"""
+    expense = ctx.expense
+    subcategory = get_catalog(ctx.session).subcategory(ctx.args["subcategory_id"])
+    if not expense or not subcategory:
+        await ctx.query.edit_message_text(Messages.ERROR)
+        return
+
+    expense.category_id = subcategory.category_id
+    expense.subcategory_id = subcategory.id
+    expense.payment_type = PAYMENT_BY_CODE.get(ctx.args["payment"], expense.payment_type)
+    async with _media_draft_lock:
+        ctx.session.commit()
+        extracting = expense.file_path is None
+
+    if expense.input_type in MEDIA_INPUT_TYPES and extracting:
+        # Extraction still running, _complete_media_draft saves it
+        text, markup = _media_draft_view(ctx.session, expense, user_data=ctx.user_data)
+        await ctx.query.edit_message_text(text, reply_markup=markup)
+        return
+    if expense.payment_type is None:
+        await ctx.query.edit_message_text(
+            f"📝 *{expense.description or '—'}*\n"
+            f"💰 *{expense.amount} {expense.currency}*\n"
+            f"📂 {subcategory.name}\n\n"
+            f"Выберите способ оплаты:",
+            parse_mode='Markdown',
+            reply_markup=get_payment_type_keyboard(expense.id)
+        )
+        return
+    await _save_expense(ctx.query.edit_message_text, ctx.session, expense, ctx.user_data)
+
+
+@callback_router.route(CallbackAction.BACK_TO_SUBCATEGORY, "expense_id", load_expense=True)
+async def on_back_to_subcategory(ctx: CallbackContext):
+    """Go back to subcategory selection from payment type"""
+    expense = ctx.expense
+    expense_id = ctx.args["expense_id"]
+
+    if expense and expense.category_id:
+        await ctx.query.edit_message_text(
+            Messages.SELECT_SUBCATEGORY,
+            reply_markup=get_subcategories_keyboard(get_catalog(ctx.session), expense.category_id, expense_id)
+        )
+    else:
+        # Fallback to categories if no category selected
+        await ctx.query.edit_message_text(
+            Messages.SELECT_CATEGORY,
+            reply_markup=get_categories_keyboard(get_catalog(ctx.session), expense_id)
+        )
+
+
+@callback_router.route(CallbackAction.BACK, "expense_id", load_expense=True)
+async def on_back(ctx: CallbackContext):
+    """Go back to categories"""
+    if ctx.expense:
+        ctx.expense.category_id = None
+        ctx.session.commit()
+
+        if ctx.expense.input_type in MEDIA_INPUT_TYPES:
+            text, markup = _media_draft_view(ctx.session, ctx.expense, user_data=ctx.user_data)
+            await ctx.query.edit_message_text(text, reply_markup=markup)
+            return
+
+        await ctx.query.edit_message_text(
+            Messages.SELECT_CATEGORY,
+            reply_markup=_categories_keyboard(ctx.session, ctx.expense, ctx.user_data)
+        )
+        return
+
+    await ctx.query.edit_message_text(
+        Messages.SELECT_CATEGORY,
+        reply_markup=get_categories_keyboard(get_catalog(ctx.session), ctx.args["expense_id"])
+    )
+
+
+@callback_router.route(CallbackAction.CANCEL, "expense_id", load_expense=True)
+async def on_cancel(ctx: CallbackContext):
+    """Cancel operation"""
+    if ctx.expense:
+        ctx.expense.status = ExpenseStatus.CANCELLED
+        ctx.session.commit()
+
+    await ctx.query.edit_message_text(Messages.CANCELLED)
+
+
+def _batch_state(ctx: CallbackContext):
+    """(all batch expenses, pending ones, selected pending ids)"""
+    expenses = get_batch_expenses(ctx.session, ctx.batch)
+    pending = [e for e in expenses if e.status == ExpenseStatus.PENDING]
+    return expenses, pending, batch_selection(ctx.chat_data, ctx.batch, pending)
+
+
+@callback_router.route(
+    CallbackAction.BATCH_SELECT_ALL, "batch_id", "select_all",
+    load_batch=True, on_missing_batch=Messages.BATCH_NOT_FOUND
+)
+async def on_batch_select_all(ctx: CallbackContext):
+    """Select / deselect all pending batch expenses"""
+    set_batch_selection(ctx.chat_data, ctx.batch, None if ctx.args["select_all"] else [])
+
+    text, keyboard = _batch_view(ctx.session, ctx.batch, ctx.chat_data)
+    await ctx.query.edit_message_text(text, reply_markup=keyboard)
+
+
+@callback_router.route(
+    CallbackAction.BATCH_SELECT, "batch_id", "number",
+    load_batch=True, on_missing_batch=Messages.BATCH_NOT_FOUND
+)
+async def on_batch_select(ctx: CallbackContext):
+    """Toggle one batch expense"""
+    expenses, pending, selected = _batch_state(ctx)
+    number = ctx.args["number"]
+
+    if 1 <= number <= len(expenses):
+        expense_id = expenses[number - 1].id
+        if expense_id in selected:
+            selected.remove(expense_id)
+        else:
+            selected.append(expense_id)
+        set_batch_selection(ctx.chat_data, ctx.batch, selected)
+
+    text, keyboard = _batch_view(ctx.session, ctx.batch, ctx.chat_data)
+    await ctx.query.edit_message_text(text, reply_markup=keyboard)
+
+
+@callback_router.route(
+    CallbackAction.BATCH_ITEM, "batch_id", "number",
+    load_batch=True, on_missing_batch=Messages.BATCH_NOT_FOUND
+)
+async def on_batch_item(ctx: CallbackContext):
+    """Select only one pending batch expense (one-by-one pager)"""
+    expenses, pending, selected = _batch_state(ctx)
+    number = ctx.args["number"]
+
+    if 1 <= number <= len(expenses) and expenses[number - 1] in pending:
+        set_batch_selection(ctx.chat_data, ctx.batch, [expenses[number - 1].id])
+
+    text, keyboard = _batch_view(ctx.session, ctx.batch, ctx.chat_data)
+    await ctx.query.edit_message_text(text, reply_markup=keyboard)
+
+
+@callback_router.route(
+    CallbackAction.BATCH_CATEGORY, "category_id", "batch_id",
+    load_batch=True, on_missing_batch=Messages.BATCH_NOT_FOUND
+)
+async def on_batch_category(ctx: CallbackContext):
+    """Category for selected batch expenses, show subcategories"""
+    expenses, pending, selected = _batch_state(ctx)
+    if not selected:
+        text, keyboard = _batch_view(ctx.session, ctx.batch, ctx.chat_data, note=Messages.BATCH_NOTHING_SELECTED)
+        await ctx.query.edit_message_text(text, reply_markup=keyboard)
+        return
+
+    summary = format_batch_summary(expenses, batch_title(ctx.batch), focused_item(ctx.chat_data, ctx.batch, expenses))
+    await ctx.query.edit_message_text(
+        f"{summary}\n\n" + Messages.BATCH_SELECT_SUBCATEGORY.format(selected=len(selected)),
+        reply_markup=get_batch_subcategories_keyboard(
+            get_catalog(ctx.session), ctx.args["category_id"], ctx.batch.id
+        )
+    )
+
+
+@callback_router.route(
+    CallbackAction.BATCH_SUBCATEGORY, "subcategory_id", "batch_id",
+    load_batch=True, on_missing_batch=Messages.BATCH_NOT_FOUND
+)
+async def on_batch_subcategory(ctx: CallbackContext):
+    """Subcategory for selected batch expenses: ask payment type if needed, else save"""
+    subcategory = get_catalog(ctx.session).subcategory(ctx.args["subcategory_id"])
+    expenses, pending, selected = _batch_state(ctx)
+
+    if subcategory and any(e.payment_type is None for e in pending if e.id in selected):
+        summary = format_batch_summary(expenses, batch_title(ctx.batch), focused_item(ctx.chat_data, ctx.batch, expenses))
+        await ctx.query.edit_message_text(
+            f"{summary}\n\n📂 {subcategory.name}\n"
+            + Messages.BATCH_SELECT_PAYMENT.format(selected=len(selected)),
+            reply_markup=get_batch_payment_type_keyboard(ctx.batch.id, subcategory.category_id, subcategory.id)
+        )
+    else:
+        await _save_batch(ctx.query, ctx.session, ctx.chat_data, ctx.batch, subcategory, user_data=ctx.user_data)
+
+
+async def _batch_payment(ctx: CallbackContext, payment_type: PaymentType):
+    """Payment type for selected batch expenses, save them"""
+    subcategory = get_catalog(ctx.session).subcategory(ctx.args["subcategory_id"])
+    await _save_batch(ctx.query, ctx.session, ctx.chat_data, ctx.batch, subcategory, payment_type, ctx.user_data)
+
+
+@callback_router.route(
+    CallbackAction.BATCH_PAYMENT_CASH, "subcategory_id", "batch_id",
+    load_batch=True, on_missing_batch=Messages.BATCH_NOT_FOUND
+)
+async def on_batch_payment_cash(ctx: CallbackContext):
+    await _batch_payment(ctx, PaymentType.CASH)
+
+
+@callback_router.route(
+    CallbackAction.BATCH_PAYMENT_BANK, "subcategory_id", "batch_id",
+    load_batch=True, on_missing_batch=Messages.BATCH_NOT_FOUND
+)
+async def on_batch_payment_bank(ctx: CallbackContext):
+    await _batch_payment(ctx, PaymentType.BANK)
+
+
+@callback_router.route(
+    CallbackAction.BATCH_BACK, "batch_id",
+    load_batch=True, on_missing_batch=Messages.BATCH_NOT_FOUND
+)
+async def on_batch_back(ctx: CallbackContext):
+    """Back to batch category selection"""
+    text, keyboard = _batch_view(ctx.session, ctx.batch, ctx.chat_data)
+    await ctx.query.edit_message_text(text, reply_markup=keyboard)
 
 
 async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -986,6 +2065,60 @@ async def setup_bot_commands(application):
     logger.info("Bot commands menu set up successfully")
 
 
+# Only the update types we have handlers for
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
+
+
+def run_webhook(application):
+    """Serve updates through the embedded webhook server (behind nginx)"""
+    if not config.WEBHOOK_URL:
+        logger.error("BOT_MODE=webhook but WEBHOOK_URL is not set!")
+        return
+    secret_token = config.WEBHOOK_SECRET_TOKEN
+    if not secret_token:
+        # The webhook is registered on every start, so a per-run token works as well
+        secret_token = secrets.token_urlsafe(32)
+        logger.info("WEBHOOK_SECRET_TOKEN is not set, using a random token for this run")
+
+    logger.info(
+        f"Starting bot (webhook) on {config.WEBHOOK_LISTEN}:{config.WEBHOOK_PORT}/{config.WEBHOOK_PATH.strip('/')}, "
+        f"public URL {config.webhook_url_full}"
+    )
+    # Telegram sends X-Telegram-Bot-Api-Secret-Token with every request;
+    # requests with a missing/wrong token are rejected with 403 by the server.
+    application.run_webhook(
+        listen=config.WEBHOOK_LISTEN,
+        port=config.WEBHOOK_PORT,
+        url_path=config.WEBHOOK_PATH.strip("/"),
+        webhook_url=config.webhook_url_full,
+        secret_token=secret_token,
+        allowed_updates=ALLOWED_UPDATES,
+        max_connections=config.WEBHOOK_MAX_CONNECTIONS,
+    )
+
+
+async def post_init(application: Application):
+    """Startup: commands menu, metrics and profiler, dedup window and suggestion model, background tasks"""
+    await setup_bot_commands(application)
+    await perf.start(application)
+    profiler.start()
+    await processed_updates.load(get_db)
+    await load_suggestions(get_db)
+    dropbox_tokens.start()
+    upload_store.start(get_db)
+    reconciler.start(get_db)
+
+
+async def close_clients(application: Application):
+    """Close shared HTTP clients and background tasks on shutdown"""
+    await dropbox_tokens.stop()
+    await upload_store.stop()
+    await reconciler.stop()
+    await perf.stop()
+    await profiler.stop()
+    await openai_client.close()
+
+
 def main():
     """Start the bot"""
     if not config.TELEGRAM_BOT_TOKEN:
@@ -996,33 +2129,62 @@ def main():
     get_db()
 
     # Create application
-    application = Application.builder().token(config.TELEGRAM_BOT_TOKEN).build()
+    builder = (
+        Application.builder()
+        .token(config.TELEGRAM_BOT_TOKEN)
+        .concurrent_updates(ChatOrderedUpdateProcessor(config.MAX_CONCURRENT_UPDATES))
+        .rate_limiter(create_rate_limiter())
+        .persistence(create_persistence())
+    )
+    if config.TELEGRAM_API_BASE_URL:
+        # e.g. a local Bot API server or a fake Telegram server in tests
+        builder = builder.base_url(config.TELEGRAM_API_BASE_URL)
+    if config.TELEGRAM_API_FILE_URL:
+        builder = builder.base_file_url(config.TELEGRAM_API_FILE_URL)
+    application = builder.build()
 
     # Set up commands menu on startup
-    application.post_init = setup_bot_commands
-
-    # Add handlers
-    application.add_handler(CommandHandler("start", start_command))
-    application.add_handler(CommandHandler("auth", auth_command))
-    application.add_handler(CommandHandler("help", help_command))
-    application.add_handler(CommandHandler("stats", stats_command))
-    application.add_handler(CommandHandler("invite", invite_command))
-    application.add_handler(CommandHandler("adduser", adduser_command))
-    application.add_handler(CommandHandler("removeuser", removeuser_command))
-    application.add_handler(CommandHandler("users", users_command))
+    application.post_init = post_init
+    application.post_shutdown = close_clients
+
+    # Redelivered updates stop here
+    application.add_handler(TypeHandler(Update, skip_duplicate_update), group=-1)
+
+    # Add handlers (timed per handler, see perf.py)
+    application.add_handler(CommandHandler("start", perf.measured(start_command)))
+    application.add_handler(CommandHandler("auth", perf.measured(auth_command)))
+    application.add_handler(CommandHandler("help", perf.measured(help_command)))
+    application.add_handler(CommandHandler("stats", perf.measured(stats_command)))
+    application.add_handler(CommandHandler("invite", perf.measured(invite_command)))
+    application.add_handler(CommandHandler("adduser", perf.measured(adduser_command)))
+    application.add_handler(CommandHandler("removeuser", perf.measured(removeuser_command)))
+    application.add_handler(CommandHandler("users", perf.measured(users_command)))
+    application.add_handler(CommandHandler("reconcile", perf.measured(reconcile_command)))
+    application.add_handler(CommandHandler("perf", perf.measured(perf_command)))
+    application.add_handler(CommandHandler("profile", perf.measured(profile_command)))
 
     # Message handlers
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
-    application.add_handler(MessageHandler(filters.PHOTO, handle_photo))
-    application.add_handler(MessageHandler(filters.Document.ALL, handle_document))
-    application.add_handler(MessageHandler(filters.VOICE, handle_voice))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, perf.measured(handle_text)))
+    application.add_handler(MessageHandler(filters.PHOTO, perf.measured(handle_photo)))
+    application.add_handler(MessageHandler(filters.Document.ALL, perf.measured(handle_document)))
+    application.add_handler(MessageHandler(filters.VOICE, perf.measured(handle_voice)))
 
     # Callback handler
-    application.add_handler(CallbackQueryHandler(handle_callback))
+    application.add_handler(CallbackQueryHandler(perf.measured(handle_callback)))
+
+    # Updates get recorded as processed only after all handlers succeeded
+    application.add_handler(TypeHandler(Update, mark_update_processed), group=1)
+    application.add_error_handler(handle_error)
 
-    # Start polling
-    logger.info("Starting bot...")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    try:
+        if config.BOT_MODE == "webhook":
+            run_webhook(application)
+        else:
+            logger.info("Starting bot (polling)...")
+            application.run_polling(allowed_updates=ALLOWED_UPDATES)
+    finally:
+        # Last: PTB and post_shutdown (flushes, profiler) log until run_* returns
+        logging_setup.shutdown()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,242 @@
+"""
+Table-driven router for inline button callbacks
+
+Callback data is a compact versioned binary payload, base64url encoded:
+    [version][action][varint arg]...
+Ten-digit ids take 5 bytes, so payloads stay far below Telegram's 64-byte limit.
+Buttons sent before the switch use "prefix:arg:arg" strings, they are still
+understood by an exact prefix lookup (no startswith ordering issues).
+"""
+import base64
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from telegram import Update
+from telegram.ext import ContextTypes
+
+import metrics
+from config import CallbackAction, CallbackPrefix
+from database import Expense
+from batches import get_batch
+
+logger = logging.getLogger(__name__)
+
+PAYLOAD_VERSION = 1
+MAX_CALLBACK_DATA = 64
+
+CALLBACK_LATENCY = metrics.histogram(
+    "payme_callback_route_seconds",
+    "Callback handling time per route",
+)
+CALLBACK_ERRORS = metrics.counter("payme_callback_errors_total", "Callbacks that could not be routed or failed")
+
+# Legacy string prefixes -> actions (argument order is the same)
+LEGACY_PREFIXES = {
+    CallbackPrefix.CONFIRM_TRANSCRIPTION: CallbackAction.CONFIRM_TRANSCRIPTION,
+    CallbackPrefix.RETRY_TRANSCRIPTION: CallbackAction.RETRY_TRANSCRIPTION,
+    CallbackPrefix.CONFIRM_AMOUNT: CallbackAction.CONFIRM_AMOUNT,
+    CallbackPrefix.EDIT_AMOUNT: CallbackAction.EDIT_AMOUNT,
+    CallbackPrefix.CATEGORY: CallbackAction.CATEGORY,
+    CallbackPrefix.SUBCATEGORY: CallbackAction.SUBCATEGORY,
+    CallbackPrefix.CANCEL: CallbackAction.CANCEL,
+    CallbackPrefix.BACK: CallbackAction.BACK,
+    CallbackPrefix.BACK_TO_SUBCATEGORY: CallbackAction.BACK_TO_SUBCATEGORY,
+    CallbackPrefix.PAYMENT_CASH: CallbackAction.PAYMENT_CASH,
+    CallbackPrefix.PAYMENT_BANK: CallbackAction.PAYMENT_BANK,
+}
+
+
+class InvalidCallback(ValueError):
+    """Callback data that can't be decoded"""
+
+
+def _write_varint(value: int, out: bytearray):
+    if value < 0:
+        raise ValueError(f"Callback arguments must be non-negative, got {value}")
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return
+
+
+def _read_varints(raw: bytes) -> List[int]:
+    values = []
+    value = shift = 0
+    for byte in raw:
+        value |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            values.append(value)
+            value = shift = 0
+    if shift:
+        raise InvalidCallback("truncated varint")
+    return values
+
+
+class CallbackTemplate:
+    """Callback payload with action and leading args encoded once, rest filled per button"""
+    __slots__ = ("_prefix",)
+
+    def __init__(self, action: CallbackAction, *fixed_args: int):
+        raw = bytearray((PAYLOAD_VERSION, int(action)))
+        for arg in fixed_args:
+            _write_varint(int(arg), raw)
+        self._prefix = bytes(raw)
+
+    def fill(self, *args: int) -> str:
+        raw = bytearray(self._prefix)
+        for arg in args:
+            _write_varint(int(arg), raw)
+        data = base64.urlsafe_b64encode(bytes(raw)).rstrip(b"=").decode("ascii")
+        if len(data) > MAX_CALLBACK_DATA:
+            raise ValueError(f"Callback data too long ({len(data)} bytes)")
+        return data
+
+
+def encode_callback(action: CallbackAction, *args: int) -> str:
+    """Build callback_data for a button"""
+    return CallbackTemplate(action).fill(*args)
+
+
+def decode_callback(data: str) -> Tuple[CallbackAction, List[int]]:
+    """Parse callback_data into (action, int args)"""
+    if not data:
+        raise InvalidCallback("empty callback data")
+
+    try:
+        if ":" in data:
+            prefix, *args = data.split(":")
+            action = LEGACY_PREFIXES.get(prefix)
+            if action is None:
+                raise InvalidCallback(f"unknown legacy prefix {prefix!r}")
+            return action, [int(a) for a in args]
+
+        raw = base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+        if len(raw) < 2:
+            raise InvalidCallback("payload too short")
+        if raw[0] != PAYLOAD_VERSION:
+            raise InvalidCallback(f"unsupported payload version {raw[0]}")
+        return CallbackAction(raw[1]), _read_varints(raw[2:])
+    except InvalidCallback:
+        raise
+    except ValueError as e:
+        raise InvalidCallback(str(e)) from e
+
+
+@dataclass
+class CallbackContext:
+    """Everything a route handler needs, with the expense/batch already loaded"""
+    update: Update
+    context: ContextTypes.DEFAULT_TYPE
+    session: Any
+    args: Dict[str, int] = field(default_factory=dict)
+    expense: Optional[Expense] = None
+    batch: Any = None
+
+    @property
+    def query(self):
+        return self.update.callback_query
+
+    @property
+    def user_id(self) -> int:
+        return self.update.effective_user.id
+
+    @property
+    def chat_data(self) -> dict:
+        """Per-chat drafts, persisted write-behind"""
+        return self.context.chat_data
+
+    @property
+    def user_data(self) -> dict:
+        """Per-user state (frequent choices), persisted write-behind"""
+        return self.context.user_data
+
+
+RouteHandler = Callable[[CallbackContext], Awaitable[None]]
+
+
+@dataclass
+class Route:
+    action: CallbackAction
+    handler: RouteHandler
+    fields: Tuple[str, ...]
+    load_expense: bool = False
+    load_batch: bool = False
+    on_missing_batch: Optional[str] = None
+
+    @property
+    def name(self) -> str:
+        return self.action.name.lower()
+
+
+class CallbackRouter:
+    """Dispatch callbacks by action with O(1) lookup"""
+
+    def __init__(self):
+        self._routes: Dict[CallbackAction, Route] = {}
+
+    def route(
+        self,
+        action: CallbackAction,
+        *fields: str,
+        load_expense: bool = False,
+        load_batch: bool = False,
+        on_missing_batch: str = None,
+    ):
+        """
+        Register handler for action. fields name the payload arguments;
+        load_expense/load_batch preload from "expense_id"/"batch_id"
+        """
+        def decorator(handler: RouteHandler) -> RouteHandler:
+            if action in self._routes:
+                raise ValueError(f"Route for {action.name} already registered")
+            self._routes[action] = Route(action, handler, fields, load_expense, load_batch, on_missing_batch)
+            return handler
+        return decorator
+
+    async def dispatch(self, ctx: CallbackContext) -> bool:
+        """Route callback; returns False if it could not be routed"""
+        data = ctx.query.data
+        try:
+            action, values = decode_callback(data)
+        except InvalidCallback as e:
+            CALLBACK_ERRORS.inc(reason="decode")
+            logger.warning(f"[Callback] Can't decode {data!r}: {e}")
+            return False
+
+        route = self._routes.get(action)
+        if route is None or len(values) != len(route.fields):
+            CALLBACK_ERRORS.inc(reason="route")
+            logger.warning(f"[Callback] No route for {action.name} with {len(values)} args")
+            return False
+
+        ctx.args = dict(zip(route.fields, values))
+
+        started = time.monotonic()
+        try:
+            if route.load_expense:
+                ctx.expense = ctx.session.query(Expense).filter_by(id=ctx.args["expense_id"]).first()
+            if route.load_batch:
+                ctx.batch = get_batch(ctx.session, ctx.args["batch_id"], ctx.user_id)
+                if ctx.batch is None:
+                    if route.on_missing_batch:
+                        await ctx.query.edit_message_text(route.on_missing_batch)
+                    return True
+
+            await route.handler(ctx)
+            return True
+        except Exception:
+            CALLBACK_ERRORS.inc(reason="handler", route=route.name)
+            raise
+        finally:
+            CALLBACK_LATENCY.observe(time.monotonic() - started, route=route.name)
+
+
+callback_router = CallbackRouter()
@@ -0,0 +1,120 @@
+"""
+Cached category/subcategory catalog
+
+Categories change rarely, but every keyboard needs them. The catalog is
+loaded once into plain (session-independent) objects and gets a new version
+whenever it changes:
+- immediately when this process writes Category/Subcategory rows
+- after CATALOG_TTL_SECONDS when rows were changed elsewhere (backend admin)
+Keyboards are memoized per catalog version.
+"""
+import hashlib
+import logging
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import event
+
+import metrics
+from config import config
+from database import Category, Subcategory
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class CategoryEntry:
+    id: int
+    code: str
+    name: str
+
+
+@dataclass(frozen=True)
+class SubcategoryEntry:
+    id: int
+    category_id: int
+    code: str
+    name: str
+
+
+class Catalog:
+    """Immutable snapshot of active categories and subcategories"""
+
+    def __init__(self, version: int, fingerprint: str,
+                 categories: List[CategoryEntry], subcategories: List[SubcategoryEntry]):
+        self.version = version
+        self.fingerprint = fingerprint
+        self.categories: Tuple[CategoryEntry, ...] = tuple(categories)
+        self._categories_by_id = {c.id: c for c in categories}
+        self._subcategories_by_id = {s.id: s for s in subcategories}
+        self._subcategories_by_category: Dict[int, Tuple[SubcategoryEntry, ...]] = {}
+        for sub in subcategories:
+            self._subcategories_by_category.setdefault(sub.category_id, ())
+            self._subcategories_by_category[sub.category_id] += (sub,)
+
+    def category(self, category_id: int) -> Optional[CategoryEntry]:
+        return self._categories_by_id.get(category_id)
+
+    def subcategory(self, subcategory_id: int) -> Optional[SubcategoryEntry]:
+        return self._subcategories_by_id.get(subcategory_id)
+
+    def subcategories_of(self, category_id: int) -> Tuple[SubcategoryEntry, ...]:
+        return self._subcategories_by_category.get(category_id, ())
+
+
+_catalog: Optional[Catalog] = None
+_loaded_at = 0.0
+_stale = True
+_lock = threading.Lock()
+
+
+def _load(session, version: int) -> Catalog:
+    categories = [
+        CategoryEntry(c.id, c.code, c.name)
+        for c in session.query(Category).filter_by(is_active=True).order_by(Category.order_num).all()
+    ]
+    subcategories = [
+        SubcategoryEntry(s.id, s.category_id, s.code, s.name)
+        for s in session.query(Subcategory).filter_by(is_active=True).order_by(Subcategory.order_num).all()
+    ]
+    fingerprint = hashlib.sha1(repr((categories, subcategories)).encode("utf-8")).hexdigest()
+    return Catalog(version, fingerprint, categories, subcategories)
+
+
+def get_catalog(session) -> Catalog:
+    """Current catalog, reloaded when invalidated or older than the TTL"""
+    global _catalog, _loaded_at, _stale
+
+    with _lock:
+        expired = time.monotonic() - _loaded_at > config.CATALOG_TTL_SECONDS
+        if _catalog is not None and not _stale and not expired:
+            metrics.CACHE_REQUESTS.inc(cache="catalog", result="hit")
+            return _catalog
+        metrics.CACHE_REQUESTS.inc(cache="catalog", result="miss")
+
+        version = _catalog.version if _catalog else 0
+        fresh = _load(session, version + 1)
+        if _catalog is None or fresh.fingerprint != _catalog.fingerprint:
+            _catalog = fresh
+            logger.info(f"[Catalog] Loaded version {fresh.version}: {len(fresh.categories)} categories")
+        _loaded_at = time.monotonic()
+        _stale = False
+        return _catalog
+
+
+def invalidate_catalog():
+    """Force reload on next access"""
+    global _stale
+    _stale = True
+
+
+@event.listens_for(Category, "after_insert")
+@event.listens_for(Category, "after_update")
+@event.listens_for(Category, "after_delete")
+@event.listens_for(Subcategory, "after_insert")
+@event.listens_for(Subcategory, "after_update")
+@event.listens_for(Subcategory, "after_delete")
+def _on_catalog_change(mapper, connection, target):
+    invalidate_catalog()
@@ -0,0 +1,94 @@
+"""
+Concurrent update processing with per-chat ordering
+
+Updates from different chats run concurrently, updates from the same chat
+are applied one after another in arrival order. An update takes one of the
+max_concurrent_updates slots only once it is its chat's turn, so a burst
+from one chat waits on its chat lock without holding slots other chats
+need. Heavy work (downloads, OpenAI calls) is capped globally by media_queue.
+"""
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Dict, Optional
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+import metrics
+import tracing
+
+logger = logging.getLogger(__name__)
+
+UPDATE_WAIT = metrics.histogram(
+    "payme_update_queue_wait_seconds",
+    "Time an update waited for earlier updates of the same chat",
+)
+
+
+def _chat_key(update: object) -> Optional[int]:
+    """Serialization key: chat id, falling back to user id"""
+    if not isinstance(update, Update):
+        return None
+    if update.effective_chat:
+        return update.effective_chat.id
+    if update.effective_user:
+        return update.effective_user.id
+    return None
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Process updates concurrently, but serialize updates of one chat"""
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self._locks: Dict[int, asyncio.Lock] = {}
+        self._pending: Dict[int, int] = {}
+
+    async def process_update(self, update: object, coroutine: "Awaitable[Any]") -> None:  # type: ignore[misc]
+        # Replaces the base class version, which takes the concurrency slot
+        # before do_process_update and would hold it while waiting for the chat.
+        # Root span of the update's trace, background tasks started by handlers inherit it
+        with tracing.span("update", **tracing.update_attributes(update)):
+            await self._process_in_order(update, coroutine)
+
+    async def do_process_update(self, update: object, coroutine: "Awaitable[Any]") -> None:
+        await coroutine
+
+    async def _run(self, update: object, coroutine: "Awaitable[Any]") -> None:
+        async with self._semaphore:
+            await self.do_process_update(update, coroutine)
+
+    async def _process_in_order(self, update: object, coroutine: "Awaitable[Any]") -> None:
+        key = _chat_key(update)
+        if key is None:
+            await self._run(update, coroutine)
+            return
+
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = asyncio.Lock()
+        self._pending[key] = self._pending.get(key, 0) + 1
+
+        started = time.monotonic()
+        try:
+            async with lock:
+                UPDATE_WAIT.observe(time.monotonic() - started)
+                tracing.annotate(chat_wait=round(time.monotonic() - started, 3))
+                await self._run(update, coroutine)
+        finally:
+            self._pending[key] -= 1
+            if not self._pending[key]:
+                # Nobody else queued for this chat - drop its lock
+                del self._pending[key]
+                del self._locks[key]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    @property
+    def active_chats(self) -> int:
+        return len(self._locks)
@@ -2,6 +2,7 @@
 Configuration for Expense Tracking Bot
 """
 import os
+import enum
 from dataclasses import dataclass
 from dotenv import load_dotenv
 
@@ -33,18 +34,124 @@ class Config:
 
     # Upload directory
     UPLOAD_DIR: str = os.getenv("UPLOAD_DIR", "uploads")
+    # Retention (file_store.py): size budget, age after which files already in Dropbox are deleted,
+    # seconds between sweeps
+    UPLOAD_MAX_MB: float = float(os.getenv("UPLOAD_MAX_MB", "2048"))
+    UPLOAD_RETENTION_DAYS: float = float(os.getenv("UPLOAD_RETENTION_DAYS", "30"))
+    UPLOAD_SWEEP_INTERVAL: float = float(os.getenv("UPLOAD_SWEEP_INTERVAL", "3600"))
 
     # Dropbox OAuth2
     DROPBOX_APP_KEY: str = os.getenv("DROPBOX_APP_KEY", "")
     DROPBOX_APP_SECRET: str = os.getenv("DROPBOX_APP_SECRET", "")
     DROPBOX_REFRESH_TOKEN: str = os.getenv("DROPBOX_REFRESH_TOKEN", "")
     DROPBOX_ACCESS_TOKEN: str = os.getenv("DROPBOX_ACCESS_TOKEN", "")  # Legacy/manual
+    # Access token cache (survives restarts) and how long before expiry it is renewed
+    DROPBOX_TOKEN_CACHE: str = os.getenv("DROPBOX_TOKEN_CACHE", "data/dropbox_token.json")
+    DROPBOX_TOKEN_RENEW_MARGIN: float = float(os.getenv("DROPBOX_TOKEN_RENEW_MARGIN", "900"))
+    # Concurrent uploads / shared link requests when several expenses are confirmed together
+    DROPBOX_CONCURRENCY: int = int(os.getenv("DROPBOX_CONCURRENCY", "4"))
+    # Re-upload of confirmed expenses without Dropbox link (reconcile.py): seconds between runs
+    # (0 = only on /reconcile), expenses per batch
+    RECONCILE_INTERVAL: float = float(os.getenv("RECONCILE_INTERVAL", "21600"))
+    RECONCILE_BATCH_SIZE: int = int(os.getenv("RECONCILE_BATCH_SIZE", "100"))
+
+    # Update delivery: "polling" (default) or "webhook"
+    BOT_MODE: str = os.getenv("BOT_MODE", "polling")
+
+    # Webhook (used when BOT_MODE=webhook)
+    WEBHOOK_URL: str = os.getenv("WEBHOOK_URL", "")  # Public base URL, e.g. https://example.com
+    WEBHOOK_PATH: str = os.getenv("WEBHOOK_PATH", "telegram/webhook")
+    WEBHOOK_LISTEN: str = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+    WEBHOOK_PORT: int = int(os.getenv("WEBHOOK_PORT", "8443"))
+    WEBHOOK_SECRET_TOKEN: str = os.getenv("WEBHOOK_SECRET_TOKEN", "")  # Empty = random per run
+    WEBHOOK_MAX_CONNECTIONS: int = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+
+    # Concurrency: updates processed in parallel (ordered per chat) and
+    # global cap on heavy jobs (file download + OpenAI extraction)
+    MAX_CONCURRENT_UPDATES: int = int(os.getenv("MAX_CONCURRENT_UPDATES", "64"))
+    HEAVY_JOBS_MAX: int = int(os.getenv("HEAVY_JOBS_MAX", "4"))
+
+    # Media job queue admission limits (waiting jobs, total and per user)
+    MEDIA_QUEUE_MAX: int = int(os.getenv("MEDIA_QUEUE_MAX", "50"))
+    MEDIA_QUEUE_PER_USER: int = int(os.getenv("MEDIA_QUEUE_PER_USER", "10"))
+
+    # Album (media group) items are collected until none arrived for this long
+    ALBUM_WINDOW_SECONDS: float = float(os.getenv("ALBUM_WINDOW_SECONDS", "1.5"))
+
+    # Category catalog is re-read at most this often (changes made by this process apply at once)
+    CATALOG_TTL_SECONDS: int = int(os.getenv("CATALOG_TTL_SECONDS", "300"))
+
+    # Subcategory suggestions (naive Bayes over confirmed expenses): a one-tap button is
+    # offered when the model is at least this sure and has learned from enough expenses
+    SUGGESTION_MIN_PROBABILITY: float = float(os.getenv("SUGGESTION_MIN_PROBABILITY", "0.6"))
+    SUGGESTION_MIN_EXAMPLES: int = int(os.getenv("SUGGESTION_MIN_EXAMPLES", "20"))
+    SUGGESTION_TRAINING_ROWS: int = int(os.getenv("SUGGESTION_TRAINING_ROWS", "50000"))
+
+    # Per-user shortcuts: up to FREQUENT_SHORTCUTS most frequent (subcategory, payment) choices,
+    # scores halve every FREQUENT_HALF_LIFE_DAYS, shown from FREQUENT_MIN_SCORE
+    FREQUENT_SHORTCUTS: int = int(os.getenv("FREQUENT_SHORTCUTS", "3"))
+    FREQUENT_HALF_LIFE_DAYS: float = float(os.getenv("FREQUENT_HALF_LIFE_DAYS", "7"))
+    FREQUENT_MIN_SCORE: float = float(os.getenv("FREQUENT_MIN_SCORE", "2"))
+
+    # Ids of recently processed updates kept (payme_processed_updates) to skip Telegram redeliveries
+    DEDUP_RECENT_UPDATES: int = int(os.getenv("DEDUP_RECENT_UPDATES", "10000"))
+
+    # Bot state persistence (chat/user data, drafts). Empty URL = main database,
+    # e.g. sqlite:///data/bot_state.db for a local SQLite file (WAL mode)
+    BOT_STATE_DB_URL: str = os.getenv("BOT_STATE_DB_URL", "")
+    PERSISTENCE_FLUSH_INTERVAL: float = float(os.getenv("PERSISTENCE_FLUSH_INTERVAL", "10"))
+
+    # Outbound Bot API limits (Telegram allows ~30 msg/s overall, ~1 msg/s per chat, 20/min per group)
+    TELEGRAM_GLOBAL_RATE: float = float(os.getenv("TELEGRAM_GLOBAL_RATE", "30"))
+    TELEGRAM_CHAT_RATE: float = float(os.getenv("TELEGRAM_CHAT_RATE", "1"))
+    TELEGRAM_CHAT_BURST: int = int(os.getenv("TELEGRAM_CHAT_BURST", "3"))
+    TELEGRAM_GROUP_RATE_PER_MINUTE: float = float(os.getenv("TELEGRAM_GROUP_RATE_PER_MINUTE", "20"))
+    TELEGRAM_MAX_RETRIES: int = int(os.getenv("TELEGRAM_MAX_RETRIES", "3"))
+
+    # Tracing (tracing.py): finished spans kept in memory, JSON lines file (empty = off),
+    # OpenTelemetry export (needs the opentelemetry package)
+    TRACE_BUFFER_SIZE: int = int(os.getenv("TRACE_BUFFER_SIZE", "2000"))
+    TRACE_FILE: str = os.getenv("TRACE_FILE", "")
+    TRACE_OTEL: bool = os.getenv("TRACE_OTEL", "false").lower() in ("1", "true", "yes")
+
+    # Prometheus endpoint GET /metrics (0 = off) and event loop lag sampling interval (perf.py)
+    METRICS_HOST: str = os.getenv("METRICS_HOST", "0.0.0.0")
+    METRICS_PORT: int = int(os.getenv("METRICS_PORT", "9100"))
+    LOOP_LAG_INTERVAL: float = float(os.getenv("LOOP_LAG_INTERVAL", "0.5"))
+
+    # Profiling (profiling.py, /profile): share of updates profiled, stack sampling or cProfile,
+    # sampling interval, output directory, .prof dumps kept per handler;
+    # event loop blocking longer than LOOP_BLOCK_THRESHOLD seconds is logged with its stack (0 = off)
+    PROFILE_ENABLED: bool = os.getenv("PROFILE_ENABLED", "false").lower() in ("1", "true", "yes")
+    PROFILE_SAMPLE_PERCENT: float = float(os.getenv("PROFILE_SAMPLE_PERCENT", "10"))
+    PROFILE_MODE: str = os.getenv("PROFILE_MODE", "stack")
+    PROFILE_INTERVAL: float = float(os.getenv("PROFILE_INTERVAL", "0.005"))
+    PROFILE_DIR: str = os.getenv("PROFILE_DIR", "data/profiles")
+    PROFILE_KEEP: int = int(os.getenv("PROFILE_KEEP", "20"))
+    LOOP_BLOCK_THRESHOLD: float = float(os.getenv("LOOP_BLOCK_THRESHOLD", "0.25"))
+
+    # Logging (logging_setup.py): json or text, root level, per module levels ("httpx=WARNING,tracing=DEBUG"),
+    # same warning/error passes LOG_REPEAT_LIMIT times per LOG_REPEAT_WINDOW seconds (0 = no limit)
+    LOG_FORMAT: str = os.getenv("LOG_FORMAT", "json")
+    LOG_LEVEL: str = os.getenv("LOG_LEVEL", "INFO")
+    LOG_LEVELS: str = os.getenv("LOG_LEVELS", "httpx=WARNING")
+    LOG_REPEAT_LIMIT: int = int(os.getenv("LOG_REPEAT_LIMIT", "5"))
+    LOG_REPEAT_WINDOW: float = float(os.getenv("LOG_REPEAT_WINDOW", "60"))
+
+    # Telegram Bot API endpoint (override to point the bot at a local/fake server)
+    TELEGRAM_API_BASE_URL: str = os.getenv("TELEGRAM_API_BASE_URL", "")
+    TELEGRAM_API_FILE_URL: str = os.getenv("TELEGRAM_API_FILE_URL", "")
 
     @property
     def DATABASE_URL(self) -> str:
         """Build MySQL connection URL"""
         return f"mysql+pymysql://{self.DB_USER}:{self.DB_PASSWORD}@{self.DB_HOST}:{self.DB_PORT}/{self.DB_NAME}?charset=utf8mb4"
 
+    @property
+    def webhook_url_full(self) -> str:
+        """Public URL Telegram should POST updates to"""
+        return f"{self.WEBHOOK_URL.rstrip('/')}/{self.WEBHOOK_PATH.strip('/')}"
+
     @property
     def admin_ids_list(self) -> list[int]:
         """Get list of admin telegram IDs"""
@@ -63,7 +170,32 @@ class Config:
 config = Config()
 
 
-# Callback data prefixes for inline buttons
+# Callback actions for inline buttons (encoded by callback_router)
+class CallbackAction(enum.IntEnum):
+    """Callback action codes - never renumber, old buttons keep their codes"""
+    CONFIRM_TRANSCRIPTION = 1
+    RETRY_TRANSCRIPTION = 2
+    CONFIRM_AMOUNT = 3
+    EDIT_AMOUNT = 4
+    CATEGORY = 5
+    SUBCATEGORY = 6
+    CANCEL = 7
+    BACK = 8
+    BACK_TO_SUBCATEGORY = 9
+    PAYMENT_CASH = 10
+    PAYMENT_BANK = 11
+    BATCH_CATEGORY = 12
+    BATCH_SUBCATEGORY = 13
+    BATCH_BACK = 14
+    BATCH_SELECT = 15
+    BATCH_SELECT_ALL = 16
+    BATCH_PAYMENT_CASH = 17
+    BATCH_PAYMENT_BANK = 18
+    BATCH_ITEM = 19
+    SHORTCUT = 20
+
+
+# Legacy string callback data prefixes (buttons sent before CallbackAction)
 class CallbackPrefix:
     """Prefixes for callback data"""
     CONFIRM_TRANSCRIPTION = "confirm_trans"
@@ -99,6 +231,10 @@ class Messages:
 
     SELECT_CATEGORY = "Выберите категорию расхода:"
     SELECT_SUBCATEGORY = "Выберите подкатегорию:"
+    MEDIA_EXTRACTING = "⏳ Распознаю сумму…"
+    MEDIA_SAVE_PENDING = "⏳ Сохраню, как только распознаю сумму"
+    AMOUNT_NOT_FOUND = "Сумма не найдена"
+    ENTER_AMOUNT = "✏️ Отправьте сумму сообщением, например: 12.50 или 12.50 USD"
 
     VOICE_TRANSCRIPTION = (
         "Транскрибация голосового сообщения:\n\n"
@@ -124,10 +260,43 @@ class Messages:
     PROCESSING_FILE = "Получил файл, обрабатываю..."
     PROCESSING_PHOTO = "Получил фото, обрабатываю..."
 
+    ALBUM_PROCESSING = "⏳ Обрабатываю {count} фото"
+    ALBUM_TITLE = "🖼 Альбом: {count} фото, 💳 Оплата: Bank"
+    ALBUM_REJECTED = "⚠️ Не обработано фото: {count}, отправьте их ещё раз."
+    TEXT_BATCH_TITLE = "📝 Расходов в сообщении: {count}"
+    EXTRACTING_MORE = "⏳ Ищу ещё расходы…"
+    VOICE_BATCH_TITLE = "🎤 {transcription}"
+    BATCH_SELECT_CATEGORY = "Выберите категорию для отмеченных расходов ({selected} из {pending}):"
+    BATCH_SELECT_SUBCATEGORY = "Выберите подкатегорию для отмеченных расходов ({selected}):"
+    BATCH_SELECT_PAYMENT = "Выберите способ оплаты для отмеченных расходов ({selected}):"
+    BATCH_SELECT_ITEM_CATEGORY = "Выберите категорию для расхода №{number} (осталось {pending}):"
+    BATCH_NOTHING_SELECTED = "Отметьте хотя бы один расход"
+    BATCH_SAVED = "✅ Сохранено расходов: {count}\n📂 {category} → {subcategory}"
+    BATCH_NOT_FOUND = "Расходы не найдены или уже сохранены"
+
+    DUPLICATE_FILE = "♻️ Этот файл уже был получен"
+    DUPLICATE_SAVED = "✅ Расход уже сохранён"
+    ALBUM_DUPLICATES = "♻️ Уже получены раньше: {count}"
+    ALBUM_ALL_DUPLICATES = "♻️ Все фото альбома уже были получены"
+    QUEUE_POSITION = "🕐 В очереди: {position}"
+    QUEUE_FULL = (
+        "Сейчас много файлов в обработке, попробуйте отправить ещё раз через пару минут."
+    )
+    QUEUE_USER_FULL = (
+        "Вы отправили слишком много файлов сразу. "
+        "Дождитесь обработки предыдущих и отправьте ещё раз."
+    )
+
     # Admin messages
     USER_ADDED = "Пользователь {user} добавлен в список разрешённых."
     USER_REMOVED = "Пользователь {user} удалён из списка."
     USER_LIST = "Список пользователей:\n{users}"
+    RECONCILE_STARTED = "⏳ Проверяю расходы без ссылки на Dropbox..."
+    RECONCILE_PROGRESS = "⏳ Проверено: {scanned}, загружено: {uploaded}, ошибок: {failed}, нет файла: {missing}"
+    RECONCILE_DONE = "✅ Готово. Проверено: {scanned}, загружено: {uploaded}, ошибок: {failed}, нет файла: {missing}"
+    RECONCILE_RUNNING = "Сверка с Dropbox уже выполняется"
+    RECONCILE_UNAVAILABLE = "❌ Dropbox недоступен (нет действующего токена)"
+    PROFILE_USAGE = "Использование: /profile [on [процент] [stack|cprofile] | off]"
 
     HELP = (
         "Команды:\n"
@@ -137,5 +306,8 @@ class Messages:
         "Админ команды:\n"
         "/adduser <telegram_id> - Добавить пользователя\n"
         "/removeuser <telegram_id> - Удалить пользователя\n"
-        "/users - Список пользователей"
+        "/users - Список пользователей\n"
+        "/reconcile - Загрузить в Dropbox файлы без ссылки\n"
+        "/perf - Задержки обработчиков и сервисов\n"
+        "/profile [on|off] - Профилирование обработчиков"
     )
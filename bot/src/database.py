@@ -2,12 +2,16 @@
 Database models for Expense Tracking Bot
 All tables have prefix 'payme_'
 """
+import logging
 from datetime import datetime
-from sqlalchemy import create_engine, Column, Integer, BigInteger, String, DateTime, ForeignKey, Text, Boolean, Enum as SQLEnum, Numeric
+from sqlalchemy import create_engine, inspect, text, Column, Integer, BigInteger, String, DateTime, ForeignKey, Text, Boolean, Enum as SQLEnum, Numeric
+from sqlalchemy.dialects import mysql
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
 import enum
 
+logger = logging.getLogger(__name__)
+
 Base = declarative_base()
 
 
@@ -94,6 +98,9 @@ class Expense(Base):
     original_text = Column(Text, nullable=True)
     transcription = Column(Text, nullable=True)
     file_id = Column(String(255), nullable=True)
+    file_unique_id = Column(String(64), nullable=True, index=True)  # Same for the same file across messages
+    content_hash = Column(String(64), nullable=True, index=True)  # sha256 of the downloaded file
+    dropbox_hash = Column(String(64), nullable=True, index=True)  # Dropbox content_hash of the file
     file_path = Column(String(500), nullable=True)
     file_name = Column(String(255), nullable=True)
 
@@ -144,10 +151,78 @@ class InviteCode(Base):
     used_at = Column(DateTime, nullable=True)
 
 
+class DropboxUpload(Base):
+    """Files already in Dropbox by content_hash, so the same file is uploaded and shared once"""
+    __tablename__ = 'payme_dropbox_uploads'
+
+    content_hash = Column(String(64), primary_key=True)  # Dropbox content_hash (block hash)
+    path = Column(String(500), nullable=False)
+    url = Column(String(500), nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
+class ProcessedUpdate(Base):
+    """Telegram updates handled to the end, so redeliveries are skipped (see dedup.py)"""
+    __tablename__ = 'payme_processed_updates'
+
+    update_id = Column(BigInteger, primary_key=True, autoincrement=False)
+    processed_at = Column(DateTime, default=datetime.utcnow)
+
+
+class BotState(Base):
+    """Persisted bot/chat/user data and conversation states (python-telegram-bot persistence)"""
+    __tablename__ = 'payme_bot_state'
+
+    kind = Column(String(64), primary_key=True)  # bot / chat / user / conv:<name>
+    key = Column(String(255), primary_key=True)
+    data = Column(Text().with_variant(mysql.MEDIUMTEXT(), "mysql"), nullable=True)  # JSON, up to 16 MB on MySQL
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
+# payme_expenses columns added after the table went live (file dedup), each with its own index
+EXPENSE_FILE_COLUMNS = (
+    ("file_unique_id", "VARCHAR(64) DEFAULT NULL"),
+    ("content_hash", "VARCHAR(64) DEFAULT NULL"),
+    ("dropbox_hash", "VARCHAR(64) DEFAULT NULL"),
+)
+
+
+def add_expense_file_columns(engine):
+    """Add the file dedup columns to an existing payme_expenses (describe, then alter what is missing)"""
+    table = Expense.__tablename__
+    inspector = inspect(engine)
+    if table not in inspector.get_table_names():
+        return
+    existing = {c["name"] for c in inspector.get_columns(table)}
+    for column, definition in EXPENSE_FILE_COLUMNS:
+        if column in existing:
+            continue
+        with engine.begin() as conn:
+            conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {definition}"))
+            conn.execute(text(f"CREATE INDEX ix_{table}_{column} ON {table} ({column})"))
+        logger.info(f"Added column {table}.{column}")
+
+
+def widen_bot_state(engine):
+    """payme_bot_state.data created as TEXT (64 KB on MySQL) becomes MEDIUMTEXT"""
+    if engine.dialect.name != "mysql":
+        return
+    inspector = inspect(engine)
+    if BotState.__tablename__ not in inspector.get_table_names():
+        return
+    for column in inspector.get_columns(BotState.__tablename__):
+        if column["name"] == "data" and isinstance(column["type"], mysql.TEXT):
+            with engine.begin() as conn:
+                conn.execute(text(f"ALTER TABLE {BotState.__tablename__} MODIFY data MEDIUMTEXT NULL"))
+            logger.info(f"Widened {BotState.__tablename__}.data to MEDIUMTEXT")
+
+
 def init_db(database_url: str):
     """Initialize database and create tables"""
     engine = create_engine(database_url, echo=False, pool_pre_ping=True)
     Base.metadata.create_all(engine)
+    add_expense_file_columns(engine)
+    widen_bot_state(engine)
     return engine
 
 
@@ -0,0 +1,224 @@
+"""
+Idempotent update processing
+
+Telegram redelivers updates the bot didn't acknowledge before a crash or
+restart. Two layers keep them from running the pipeline again:
+- update_id: ids of updates that went through all handlers without an
+  error are kept (in memory and in payme_processed_updates); a handler in
+  group -1 stops repeats and updates still in progress. An update whose
+  handler failed or was interrupted is not recorded and runs again. Media
+  handlers hand the update off to a background task: it is recorded when
+  that task succeeds, not when the handler returns
+- files: expenses remember the file's file_unique_id and content hash, so a
+  redelivered or resent file short-circuits to the existing expense before
+  the download (file_unique_id) or before extraction (content hash)
+The same read of the file also yields its Dropbox content_hash, which the
+upload uses to find files already in Dropbox (see dropbox_service.py).
+"""
+import asyncio
+import hashlib
+import logging
+from collections import deque
+from typing import Callable, Deque, List, NamedTuple, Optional, Set
+
+from telegram import Update
+from telegram.ext import ApplicationHandlerStop, ContextTypes
+
+import metrics
+from config import config
+from database import Expense, ExpenseStatus, ProcessedUpdate
+from dropbox_service import BLOCK_SIZE, DropboxContentHasher
+
+logger = logging.getLogger(__name__)
+
+DUPLICATES = metrics.counter("payme_duplicates_total", "Redelivered updates and resent files that were skipped")
+
+# Old location of the id window (bot_data), dropped from the persisted state on startup
+RECENT_UPDATES_KEY = "recent_update_ids"
+
+
+class ProcessedUpdates:
+    """
+    Ids of updates handled to the end: the last `capacity` in memory, all of
+    them in payme_processed_updates (pruned to the same window), so the
+    window survives restarts without growing the persisted bot state
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self._ids: Deque[int] = deque()
+        self._seen: Set[int] = set()
+        self._in_flight: Set[int] = set()
+        self._failed: Set[int] = set()
+        self._handed_off: Set[int] = set()
+        self._session_factory: Optional[Callable] = None
+        self._since_prune = 0
+
+    def _load(self) -> List[int]:
+        session = self._session_factory()
+        try:
+            rows = session.query(ProcessedUpdate.update_id).order_by(
+                ProcessedUpdate.update_id.desc()
+            ).limit(self.capacity).all()
+            return [row[0] for row in reversed(rows)]
+        finally:
+            session.close()
+
+    async def load(self, session_factory: Callable):
+        """Read the window from the database (session_factory returns a new session)"""
+        self._session_factory = session_factory
+        for update_id in await asyncio.to_thread(self._load):
+            self._remember(update_id)
+
+    def _remember(self, update_id: int):
+        self._ids.append(update_id)
+        self._seen.add(update_id)
+        while len(self._ids) > self.capacity:
+            self._seen.discard(self._ids.popleft())
+
+    def start(self, update_id: int) -> bool:
+        """False if the update was processed already or is being processed right now"""
+        if update_id in self._seen or update_id in self._in_flight:
+            return False
+        self._in_flight.add(update_id)
+        return True
+
+    def failed(self, update_id: int):
+        """A handler raised: a redelivery of this update may run again"""
+        if update_id in self._in_flight:
+            self._failed.add(update_id)
+
+    def hand_off(self, update_id: int):
+        """The update goes on in a background task, which calls finish() (see handlers_done())"""
+        self._handed_off.add(update_id)
+
+    async def handlers_done(self, update_id: int):
+        """All handlers returned: finish unless the update was handed off to a task"""
+        if update_id in self._handed_off:
+            self._handed_off.discard(update_id)
+            return
+        await self.finish(update_id)
+
+    def _store(self, update_id: int, prune_below: Optional[int]):
+        session = self._session_factory()
+        try:
+            session.merge(ProcessedUpdate(update_id=update_id))
+            if prune_below is not None:
+                session.query(ProcessedUpdate).filter(
+                    ProcessedUpdate.update_id < prune_below
+                ).delete(synchronize_session=False)
+            session.commit()
+        finally:
+            session.close()
+
+    async def finish(self, update_id: int):
+        """Processing is over: remember the update unless a handler failed"""
+        if update_id not in self._in_flight:
+            return
+        self._in_flight.discard(update_id)
+        if update_id in self._failed:
+            self._failed.discard(update_id)
+            return
+        self._remember(update_id)
+        if self._session_factory is None:
+            return
+        prune_below = None
+        self._since_prune += 1
+        if self._since_prune >= max(1, self.capacity // 10):
+            self._since_prune = 0
+            prune_below = self._ids[0]
+        try:
+            await asyncio.to_thread(self._store, update_id, prune_below)
+        except Exception as e:
+            logger.warning(f"[Dedup] Could not store processed update {update_id}: {e}")
+
+
+processed_updates = ProcessedUpdates(config.DEDUP_RECENT_UPDATES)
+
+
+async def skip_duplicate_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """TypeHandler for group -1: stop processing of already received updates"""
+    context.bot_data.pop(RECENT_UPDATES_KEY, None)
+    if not processed_updates.start(update.update_id):
+        DUPLICATES.inc(kind="update")
+        logger.info(f"[Dedup] Update {update.update_id} already processed, skipping")
+        raise ApplicationHandlerStop
+
+
+async def mark_update_processed(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """TypeHandler for the last group: the update went through all handlers"""
+    await processed_updates.handlers_done(update.update_id)
+
+
+async def handle_error(update: object, context: ContextTypes.DEFAULT_TYPE):
+    """Error handler: log the exception, a redelivery of the update is processed again"""
+    logger.error("Exception while handling an update", exc_info=context.error)
+    if isinstance(update, Update):
+        processed_updates.failed(update.update_id)
+
+
+class FileHashes(NamedTuple):
+    content_hash: str  # sha256
+    dropbox_hash: str  # Dropbox content_hash
+
+
+def _hash_file(path: str) -> FileHashes:
+    digest = hashlib.sha256()
+    dropbox = DropboxContentHasher()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(BLOCK_SIZE), b""):
+            digest.update(chunk)
+            dropbox.update(chunk)
+    return FileHashes(digest.hexdigest(), dropbox.hexdigest())
+
+
+async def file_hashes(path: str) -> FileHashes:
+    """sha256 and Dropbox content_hash of a downloaded file (one read, off the event loop)"""
+    return await asyncio.to_thread(_hash_file, path)
+
+
+def find_duplicate_expense(
+    session,
+    user_id: int,
+    file_unique_id: str = None,
+    content_hash: str = None,
+) -> Optional[Expense]:
+    """Latest not cancelled expense of the user with the same file"""
+    query = session.query(Expense).filter(
+        Expense.user_id == user_id,
+        Expense.status != ExpenseStatus.CANCELLED,
+    )
+    if file_unique_id:
+        query = query.filter(Expense.file_unique_id == file_unique_id)
+    elif content_hash:
+        query = query.filter(Expense.content_hash == content_hash)
+    else:
+        return None
+
+    expense = query.order_by(Expense.id.desc()).first()
+    if expense:
+        DUPLICATES.inc(kind="file_unique_id" if file_unique_id else "content_hash")
+    return expense
+
+
+def known_file_ids(session, user_id: int, file_unique_ids: List[str]) -> Set[str]:
+    """Which of the given files the user already sent (one query for a whole album)"""
+    if not file_unique_ids:
+        return set()
+    rows = session.query(Expense.file_unique_id).filter(
+        Expense.user_id == user_id,
+        Expense.status != ExpenseStatus.CANCELLED,
+        Expense.file_unique_id.in_(file_unique_ids),
+    ).all()
+    known = {row[0] for row in rows}
+    if known:
+        DUPLICATES.inc(len(known), kind="file_unique_id")
+    return known
+
+
+class DuplicateFile(Exception):
+    """Raised from a media job when the downloaded file is already an expense"""
+
+    def __init__(self, expense_id: int):
+        super().__init__(f"file already stored as expense {expense_id}")
+        self.expense_id = expense_id
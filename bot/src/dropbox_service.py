@@ -1,75 +1,342 @@
 """
 Dropbox upload service with OAuth2 refresh token support
+
+Access tokens come from DropboxTokenManager: concurrent callers share one
+refresh (async lock), a background task renews the token before it expires
+so uploads don't pay for the refresh inline, and the token is cached in
+config.DROPBOX_TOKEN_CACHE to survive restarts. A revoked refresh token
+(invalid_grant) is reported through the payme_dropbox_auth_ok gauge.
+
+Uploads are deduplicated by Dropbox's content_hash (block hash, computed
+locally the same way): payme_dropbox_uploads maps hashes of uploaded files
+to their path and shared link, so a file that is already in Dropbox gets
+the existing link instead of another copy. backfill_dropbox_hashes.py fills
+the index for uploads made before it existed.
+
+Expenses confirmed together go through upload_batch: files are sent
+concurrently as upload sessions, committed with one finish_batch call, and
+their shared links are created config.DROPBOX_CONCURRENCY at a time.
 """
+import asyncio
+import hashlib
+import json
 import os
 import logging
+import time
 from datetime import datetime
-from typing import Optional
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
 import httpx
+
+import metrics
+import tracing
 from config import config
+from database import DropboxUpload
 
 logger = logging.getLogger(__name__)
 
-# Cache for access token
-_access_token = None
-_token_expires_at = None
+TOKEN_URL = "https://api.dropboxapi.com/oauth2/token"
+
+TOKEN_REFRESHES = metrics.counter("payme_dropbox_token_refreshes_total", "Dropbox access token refreshes")
+UPLOADS = metrics.counter("payme_dropbox_uploads_total", "Dropbox uploads by outcome (uploaded / reused / error)")
+AUTH_OK = metrics.gauge(
+    "payme_dropbox_auth_ok",
+    "1 while the Dropbox refresh token works, 0 after invalid_grant (re-authorize the app)",
+)
+
+
+# Dropbox hashes files in blocks of this size
+BLOCK_SIZE = 4 * 1024 * 1024
+
+
+class DropboxContentHasher:
+    """
+    Dropbox content_hash: sha256 over the concatenated sha256 digests of
+    the file's 4 MB blocks. Accepts data in chunks of any size
+    """
+
+    def __init__(self):
+        self._overall = hashlib.sha256()
+        self._block = hashlib.sha256()
+        self._block_size = 0
+
+    def update(self, data: bytes):
+        view = memoryview(data)
+        while view:
+            take = min(BLOCK_SIZE - self._block_size, len(view))
+            self._block.update(view[:take])
+            self._block_size += take
+            view = view[take:]
+            if self._block_size == BLOCK_SIZE:
+                self._overall.update(self._block.digest())
+                self._block = hashlib.sha256()
+                self._block_size = 0
+
+    def hexdigest(self) -> str:
+        overall = self._overall.copy()
+        if self._block_size:
+            overall.update(self._block.digest())
+        return overall.hexdigest()
+
+
+def _hash_file(path: str) -> str:
+    hasher = DropboxContentHasher()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(BLOCK_SIZE), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+async def dropbox_file_hash(path: str) -> str:
+    """Dropbox content_hash of a local file (computed off the event loop)"""
+    return await asyncio.to_thread(_hash_file, path)
+
+
+class DropboxTokenManager:
+    """Short-lived access token obtained from the long-lived refresh token"""
+
+    def __init__(self, cache_path: str, renew_margin: float):
+        self.cache_path = cache_path
+        self.renew_margin = renew_margin
+        self._access_token: Optional[str] = None
+        self._expires_at = 0.0
+        self._lock = asyncio.Lock()
+        self._loaded = False
+        self._renewal: Optional[asyncio.Task] = None
+        # Set when Dropbox rejects the refresh token, refreshing again won't help
+        self.invalid_grant = False
+        AUTH_OK.set(1)
+
+    @property
+    def healthy(self) -> bool:
+        return not self.invalid_grant
+
+    def _fresh(self, margin: float) -> bool:
+        return bool(self._access_token) and time.time() < self._expires_at - margin
+
+    @staticmethod
+    def _fingerprint() -> str:
+        """Cached tokens belong to the configured refresh token"""
+        return hashlib.sha256(config.DROPBOX_REFRESH_TOKEN.encode()).hexdigest()[:16]
+
+    def _load(self):
+        try:
+            with open(self.cache_path, encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if data.get("refresh_token") == self._fingerprint():
+            self._access_token = data.get("access_token")
+            self._expires_at = float(data.get("expires_at", 0))
+
+    def _save(self):
+        directory = os.path.dirname(self.cache_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{self.cache_path}.tmp"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump({
+                "access_token": self._access_token,
+                "expires_at": self._expires_at,
+                "refresh_token": self._fingerprint(),
+            }, f)
+        os.replace(tmp_path, self.cache_path)
+
+    async def get(self) -> Optional[str]:
+        """Valid access token, refreshing if needed (one refresh for all concurrent callers)"""
+        # If we have a direct access token (legacy), use it
+        if config.DROPBOX_ACCESS_TOKEN and not config.DROPBOX_REFRESH_TOKEN:
+            return config.DROPBOX_ACCESS_TOKEN
+
+        if self._fresh(60):
+            return self._access_token
+        async with self._lock:
+            # Whoever waited on the lock gets the token the first caller fetched
+            if not self._fresh(60):
+                await self._refresh()
+            return self._access_token if self._fresh(0) else None
+
+    async def _refresh(self):
+        """Fetch a new access token (caller holds the lock)"""
+        if self.invalid_grant:
+            return
+
+        if not self._loaded:
+            self._loaded = True
+            await asyncio.to_thread(self._load)
+            if self._fresh(self.renew_margin):
+                return
+
+        # Refresh token using refresh_token
+        if not config.DROPBOX_REFRESH_TOKEN:
+            logger.warning("Dropbox: No refresh token configured")
+            return
+
+        if not config.DROPBOX_APP_KEY or not config.DROPBOX_APP_SECRET:
+            logger.warning("Dropbox: App key/secret not configured")
+            return
+
+        try:
+            async with httpx.AsyncClient(timeout=30.0) as client:
+                with tracing.span("dropbox.token_refresh"):
+                    response = await client.post(
+                        TOKEN_URL,
+                        data={
+                            "grant_type": "refresh_token",
+                            "refresh_token": config.DROPBOX_REFRESH_TOKEN,
+                            "client_id": config.DROPBOX_APP_KEY,
+                            "client_secret": config.DROPBOX_APP_SECRET,
+                        }
+                    )
+        except httpx.HTTPError as e:
+            TOKEN_REFRESHES.inc(outcome="error")
+            logger.error(f"Dropbox token refresh error: {e}")
+            return
+
+        if response.status_code == 200:
+            data = response.json()
+            self._access_token = data.get("access_token")
+            self._expires_at = time.time() + data.get("expires_in", 14400)  # Default 4 hours
+            self.invalid_grant = False
+            AUTH_OK.set(1)
+            TOKEN_REFRESHES.inc(outcome="ok")
+            logger.info("Dropbox: Token refreshed successfully")
+            try:
+                await asyncio.to_thread(self._save)
+            except OSError as e:
+                logger.warning(f"Dropbox: Could not cache token in {self.cache_path}: {e}")
+            return
+
+        if response.status_code == 400 and "invalid_grant" in response.text:
+            # Revoked or expired refresh token: only re-authorizing the app helps
+            self.invalid_grant = True
+            AUTH_OK.set(0)
+            TOKEN_REFRESHES.inc(outcome="invalid_grant")
+            logger.error("Dropbox: refresh token rejected (invalid_grant), re-authorize the app")
+            return
+
+        TOKEN_REFRESHES.inc(outcome="error")
+        logger.error(f"Dropbox token refresh error: {response.status_code} - {response.text}")
+
+    async def _renew_loop(self):
+        """Renew the token renew_margin before it expires"""
+        while True:
+            if not self.invalid_grant and not self._fresh(self.renew_margin):
+                async with self._lock:
+                    if not self._fresh(self.renew_margin):
+                        await self._refresh()
+            # Next check: just before the renewal point, at least once a minute on failures
+            wait = self._expires_at - self.renew_margin - time.time() if self._fresh(self.renew_margin) else 60
+            await asyncio.sleep(max(wait, 60))
+
+    def start(self):
+        """Start background renewal (only with a refresh token configured)"""
+        if config.DROPBOX_REFRESH_TOKEN and self._renewal is None:
+            self._renewal = asyncio.create_task(self._renew_loop())
+
+    async def stop(self):
+        if self._renewal is not None:
+            self._renewal.cancel()
+            try:
+                await self._renewal
+            except asyncio.CancelledError:
+                pass
+            self._renewal = None
+
+
+token_manager = DropboxTokenManager(config.DROPBOX_TOKEN_CACHE, config.DROPBOX_TOKEN_RENEW_MARGIN)
 
 
 async def get_access_token() -> Optional[str]:
     """Get valid access token, refreshing if needed"""
-    global _access_token, _token_expires_at
+    return await token_manager.get()
 
-    # Check if we have a valid cached token
-    if _access_token and _token_expires_at:
-        if datetime.now().timestamp() < _token_expires_at - 300:  # 5 min buffer
-            return _access_token
 
-    # If we have a direct access token (legacy), use it
-    if config.DROPBOX_ACCESS_TOKEN and not config.DROPBOX_REFRESH_TOKEN:
-        return config.DROPBOX_ACCESS_TOKEN
+def find_upload(session, content_hash: str) -> Optional[DropboxUpload]:
+    """Already uploaded file with this content_hash"""
+    return session.get(DropboxUpload, content_hash)
 
-    # Refresh token using refresh_token
-    if not config.DROPBOX_REFRESH_TOKEN:
-        logger.warning("Dropbox: No refresh token configured")
-        return None
 
-    if not config.DROPBOX_APP_KEY or not config.DROPBOX_APP_SECRET:
-        logger.warning("Dropbox: App key/secret not configured")
-        return None
+def record_upload(session, content_hash: str, path: str, url: str):
+    """Remember an uploaded file (the caller commits)"""
+    session.merge(DropboxUpload(content_hash=content_hash, path=path, url=url))
 
-    try:
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.post(
-                "https://api.dropboxapi.com/oauth2/token",
-                data={
-                    "grant_type": "refresh_token",
-                    "refresh_token": config.DROPBOX_REFRESH_TOKEN,
-                    "client_id": config.DROPBOX_APP_KEY,
-                    "client_secret": config.DROPBOX_APP_SECRET,
-                }
-            )
 
-            if response.status_code == 200:
-                data = response.json()
-                _access_token = data.get("access_token")
-                expires_in = data.get("expires_in", 14400)  # Default 4 hours
-                _token_expires_at = datetime.now().timestamp() + expires_in
-                logger.info("Dropbox: Token refreshed successfully")
-                return _access_token
-            else:
-                logger.error(f"Dropbox token refresh error: {response.status_code} - {response.text}")
-                return None
+def _find_uploads(session, content_hashes: Iterable[str]) -> Dict[str, Optional[DropboxUpload]]:
+    """find_upload for several files (blocking, run in a thread)"""
+    return {content_hash: find_upload(session, content_hash) for content_hash in content_hashes}
+
+
+def _record_uploads(session, uploads: List[Tuple[str, str, str]]):
+    """record_upload for (content_hash, path, url) entries (blocking, run in a thread)"""
+    for content_hash, path, url in uploads:
+        record_upload(session, content_hash, path, url)
+
+
+def _dropbox_path(local_path: str, category_code: str, expense_id: int) -> str:
+    """Unique Dropbox path: /PayMe/<category>/<year>/<month>/<expense id>_<timestamp><ext>"""
+    date_folder = datetime.now().strftime("%Y/%m")
+    ext = os.path.splitext(os.path.basename(local_path))[1]
+    dropbox_filename = f"{expense_id}_{datetime.now().strftime('%Y%m%d_%H%M%S')}{ext}"
+    return f"/PayMe/{category_code}/{date_folder}/{dropbox_filename}"
+
+
+def _read_file(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
 
-    except Exception as e:
-        logger.error(f"Dropbox token refresh error: {e}")
-        return None
 
+@tracing.traced("dropbox.shared_link")
+async def _shared_link(client: httpx.AsyncClient, access_token: str, path: str) -> Optional[str]:
+    """Public shared link of a Dropbox file (the existing one if it was shared before)"""
+    link_response = await client.post(
+        "https://api.dropboxapi.com/2/sharing/create_shared_link_with_settings",
+        headers={
+            "Authorization": f"Bearer {access_token}",
+            "Content-Type": "application/json"
+        },
+        json={
+            "path": path,
+            "settings": {
+                "requested_visibility": "public"
+            }
+        }
+    )
 
+    if link_response.status_code == 200:
+        return link_response.json().get("url")
+    elif link_response.status_code == 409:
+        # Link already exists, get existing link
+        existing_response = await client.post(
+            "https://api.dropboxapi.com/2/sharing/list_shared_links",
+            headers={
+                "Authorization": f"Bearer {access_token}",
+                "Content-Type": "application/json"
+            },
+            json={
+                "path": path,
+                "direct_only": True
+            }
+        )
+        if existing_response.status_code == 200:
+            links = existing_response.json().get("links", [])
+            if links:
+                url = links[0].get("url")
+                logger.info(f"Dropbox: Got existing link: {url}")
+                return url
+
+    logger.error(f"Dropbox link error: {link_response.status_code} - {link_response.text}")
+    return None
+
+
+@tracing.traced("dropbox.upload")
 async def upload_to_dropbox(
     local_path: str,
     category_code: str = "UNCATEGORIZED",
     subcategory_code: str = "",
-    expense_id: int = 0
+    expense_id: int = 0,
+    content_hash: str = None,
+    session=None
 ) -> Optional[str]:
     """
     Upload file to Dropbox and return shared link
@@ -79,35 +346,40 @@ async def upload_to_dropbox(
         category_code: Category code for folder organization
         subcategory_code: Subcategory code
         expense_id: Expense ID for unique naming
+        content_hash: Dropbox content_hash of the file (computed here if missing)
+        session: Database session for the upload index; without it every call uploads.
+            New uploads are added to the session, the caller commits
 
     Returns:
         Shared link URL or None if failed
     """
+    if not os.path.exists(local_path):
+        logger.error(f"Dropbox: File not found: {local_path}")
+        return None
+
+    if session is not None:
+        if not content_hash:
+            content_hash = await dropbox_file_hash(local_path)
+        existing = await asyncio.to_thread(find_upload, session, content_hash)
+        if existing is not None:
+            UPLOADS.inc(outcome="reused")
+            tracing.annotate(reused=True)
+            logger.info(f"Dropbox: {local_path} already uploaded as {existing.path}, reusing link")
+            return existing.url
+
     access_token = await get_access_token()
 
     if not access_token:
         logger.error("Dropbox: No valid access token")
         return None
 
-    if not os.path.exists(local_path):
-        logger.error(f"Dropbox: File not found: {local_path}")
-        return None
-
     logger.info(f"Dropbox: Uploading {local_path} for expense {expense_id}")
 
     try:
-        # Generate Dropbox path
-        date_folder = datetime.now().strftime("%Y/%m")
-        filename = os.path.basename(local_path)
-        ext = os.path.splitext(filename)[1]
-
-        # Create unique filename
-        dropbox_filename = f"{expense_id}_{datetime.now().strftime('%Y%m%d_%H%M%S')}{ext}"
-        dropbox_path = f"/PayMe/{category_code}/{date_folder}/{dropbox_filename}"
+        dropbox_path = _dropbox_path(local_path, category_code, expense_id)
 
-        # Read file
-        with open(local_path, "rb") as f:
-            file_data = f.read()
+        # Read file, off the event loop
+        file_data = await asyncio.to_thread(_read_file, local_path)
 
         async with httpx.AsyncClient(timeout=120.0) as client:
             # Upload file
@@ -122,55 +394,184 @@ async def upload_to_dropbox(
             )
 
             if upload_response.status_code != 200:
+                UPLOADS.inc(outcome="error")
                 logger.error(f"Dropbox upload error: {upload_response.status_code} - {upload_response.text}")
                 return None
 
             upload_result = upload_response.json()
             uploaded_path = upload_result.get("path_display", dropbox_path)
+            uploaded_hash = upload_result.get("content_hash")
+            if content_hash and uploaded_hash and uploaded_hash != content_hash:
+                logger.warning(
+                    f"Dropbox: content_hash mismatch for {local_path}: local {content_hash}, Dropbox {uploaded_hash}"
+                )
 
-            # Create shared link
-            link_response = await client.post(
-                "https://api.dropboxapi.com/2/sharing/create_shared_link_with_settings",
-                headers={
-                    "Authorization": f"Bearer {access_token}",
-                    "Content-Type": "application/json"
-                },
-                json={
-                    "path": uploaded_path,
-                    "settings": {
-                        "requested_visibility": "public"
-                    }
+            url = await _shared_link(client, access_token, uploaded_path)
+            if not url:
+                UPLOADS.inc(outcome="error")
+                return None
+
+        UPLOADS.inc(outcome="uploaded")
+        logger.info(f"Dropbox: Upload success, URL: {url}")
+        if session is not None and (uploaded_hash or content_hash):
+            await asyncio.to_thread(record_upload, session, uploaded_hash or content_hash, uploaded_path, url)
+        return url
+
+    except Exception as e:
+        UPLOADS.inc(outcome="error")
+        logger.error(f"Dropbox upload error: {e}")
+        return None
+
+
+class BatchFile(NamedTuple):
+    expense_id: int
+    local_path: str
+    category_code: str
+    content_hash: str  # Dropbox content_hash
+
+
+@tracing.traced("dropbox.upload_batch")
+async def upload_batch(files: List[BatchFile], session) -> Dict[int, str]:
+    """
+    Upload the files of several expenses, returns expense_id -> shared link.
+
+    Files already in Dropbox (see find_upload) and repeats within the batch
+    aren't uploaded again. New uploads are added to the session, the caller
+    commits. Failed files are logged and left out of the result
+    """
+    urls: Dict[int, str] = {}
+    # content_hash -> files with it, the first one is uploaded
+    pending: Dict[str, List[BatchFile]] = {}
+    known = await asyncio.to_thread(_find_uploads, session, {file.content_hash for file in files})
+    for file in files:
+        existing = known[file.content_hash]
+        if existing is not None:
+            UPLOADS.inc(outcome="reused")
+            urls[file.expense_id] = existing.url
+        else:
+            pending.setdefault(file.content_hash, []).append(file)
+    tracing.annotate(files=len(files), reused=len(urls))
+    if not pending:
+        return urls
+
+    access_token = await get_access_token()
+    if not access_token:
+        logger.error("Dropbox: No valid access token")
+        return urls
+
+    logger.info(f"Dropbox: Uploading {len(pending)} files for expenses {[f.expense_id for f in files]}")
+    limit = asyncio.Semaphore(config.DROPBOX_CONCURRENCY)
+    uploads = [group[0] for group in pending.values()]
+    linked: List[Tuple[BatchFile, str, str, Optional[str]]] = []
+
+    try:
+        async with httpx.AsyncClient(timeout=120.0) as client:
+            async def start(file: BatchFile) -> Optional[dict]:
+                """Send the whole file as a closed upload session, returns its finish_batch entry"""
+                async with limit:
+                    with tracing.span("dropbox.upload_session", expense_id=file.expense_id):
+                        data = await asyncio.to_thread(_read_file, file.local_path)
+                        response = await client.post(
+                            "https://content.dropboxapi.com/2/files/upload_session/start",
+                            headers={
+                                "Authorization": f"Bearer {access_token}",
+                                "Dropbox-API-Arg": json.dumps({"close": True}),
+                                "Content-Type": "application/octet-stream"
+                            },
+                            content=data
+                        )
+                if response.status_code != 200:
+                    logger.error(f"Dropbox upload error: {response.status_code} - {response.text}")
+                    return None
+                return {
+                    "cursor": {"session_id": response.json()["session_id"], "offset": len(data)},
+                    "commit": {
+                        "path": _dropbox_path(file.local_path, file.category_code, file.expense_id),
+                        "mode": "add",
+                        "autorename": True,
+                    },
                 }
-            )
 
-            if link_response.status_code == 200:
-                link_result = link_response.json()
-                url = link_result.get("url")
-                logger.info(f"Dropbox: Upload success, URL: {url}")
-                return url
-            elif link_response.status_code == 409:
-                # Link already exists, get existing link
-                existing_response = await client.post(
-                    "https://api.dropboxapi.com/2/sharing/list_shared_links",
+            started = await asyncio.gather(*(start(file) for file in uploads))
+            committed = [(file, entry) for file, entry in zip(uploads, started) if entry is not None]
+            if not committed:
+                UPLOADS.inc(len(uploads), outcome="error")
+                return urls
+
+            # One commit for all sessions (finish_batch_v2 returns the results right away)
+            with tracing.span("dropbox.finish_batch", entries=len(committed)):
+                finish_response = await client.post(
+                    "https://api.dropboxapi.com/2/files/upload_session/finish_batch_v2",
                     headers={
                         "Authorization": f"Bearer {access_token}",
                         "Content-Type": "application/json"
                     },
-                    json={
-                        "path": uploaded_path,
-                        "direct_only": True
-                    }
+                    json={"entries": [entry for _, entry in committed]}
                 )
-                if existing_response.status_code == 200:
-                    links = existing_response.json().get("links", [])
-                    if links:
-                        url = links[0].get("url")
-                        logger.info(f"Dropbox: Got existing link: {url}")
-                        return url
+            if finish_response.status_code != 200:
+                UPLOADS.inc(len(uploads), outcome="error")
+                logger.error(f"Dropbox finish_batch error: {finish_response.status_code} - {finish_response.text}")
+                return urls
+
+            uploaded = []
+            for (file, entry), result in zip(committed, finish_response.json().get("entries", [])):
+                if result.get(".tag") != "success":
+                    logger.error(f"Dropbox upload error for expense {file.expense_id}: {result}")
+                    continue
+                path = result.get("path_display", entry["commit"]["path"])
+                uploaded.append((file, path, result.get("content_hash") or file.content_hash))
 
-            logger.error(f"Dropbox link error: {link_response.status_code} - {link_response.text}")
-            return None
+            async def link(path: str) -> Optional[str]:
+                async with limit:
+                    return await _shared_link(client, access_token, path)
 
+            links = await asyncio.gather(*(link(path) for _, path, _ in uploaded))
+            linked = [(file, path, content_hash, url) for (file, path, content_hash), url in zip(uploaded, links)]
     except Exception as e:
         logger.error(f"Dropbox upload error: {e}")
+
+    linked = [(file, path, content_hash, url) for file, path, content_hash, url in linked if url]
+    await asyncio.to_thread(_record_uploads, session, [
+        (content_hash, path, url) for _, path, content_hash, url in linked
+    ])
+    for file, path, content_hash, url in linked:
+        for same in pending[file.content_hash]:
+            urls[same.expense_id] = url
+    done = sum(1 for *_, url in linked if url)
+    UPLOADS.inc(done, outcome="uploaded")
+    if len(uploads) > done:
+        UPLOADS.inc(len(uploads) - done, outcome="error")
+    logger.info(f"Dropbox: Uploaded {done}/{len(uploads)} files")
+    return urls
+
+
+async def shared_file_hash(client: httpx.AsyncClient, url: str) -> Optional[Tuple[str, str]]:
+    """(path, content_hash) of the file behind a shared link, None if it is gone"""
+    access_token = await get_access_token()
+    if not access_token:
+        logger.error("Dropbox: No valid access token")
+        return None
+    headers = {"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"}
+
+    link_response = await client.post(
+        "https://api.dropboxapi.com/2/sharing/get_shared_link_metadata",
+        headers=headers,
+        json={"url": url},
+    )
+    if link_response.status_code != 200:
+        logger.warning(f"Dropbox: shared link {url}: {link_response.status_code} - {link_response.text}")
+        return None
+    link = link_response.json()
+
+    metadata_response = await client.post(
+        "https://api.dropboxapi.com/2/files/get_metadata",
+        headers=headers,
+        json={"path": link.get("id") or link.get("path_lower")},
+    )
+    if metadata_response.status_code != 200:
+        logger.warning(f"Dropbox: metadata of {url}: {metadata_response.status_code} - {metadata_response.text}")
+        return None
+    metadata = metadata_response.json()
+    if not metadata.get("content_hash"):
         return None
+    return metadata.get("path_display") or metadata.get("path_lower"), metadata["content_hash"]
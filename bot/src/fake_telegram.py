@@ -0,0 +1,105 @@
+"""
+Minimal fake Telegram Bot API for local webhook testing
+
+Usage:
+    1. python src/fake_telegram.py serve            (fake Bot API on :8081)
+    2. BOT_MODE=webhook WEBHOOK_URL=http://127.0.0.1:8443 WEBHOOK_SECRET_TOKEN=test \\
+       TELEGRAM_API_BASE_URL=http://127.0.0.1:8081/bot python src/bot.py
+    3. python src/fake_telegram.py send "бензин 50 евро"   (POSTs an update to the webhook)
+"""
+import http.server
+import json
+import socketserver
+import sys
+import time
+
+import httpx
+
+PORT = 8081
+WEBHOOK = "http://127.0.0.1:8443/telegram/webhook"
+SECRET_TOKEN = "test"
+CHAT_ID = 100000001
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "PayMe", "username": "payme_fake_bot"}
+FROM_USER = {"id": CHAT_ID, "is_bot": False, "first_name": "Test", "username": "tester"}
+
+_message_id = 1000
+
+
+def _message(text: str = "") -> dict:
+    """Build a Message object for send*/edit* results"""
+    global _message_id
+    _message_id += 1
+    return {
+        "message_id": _message_id,
+        "date": int(time.time()),
+        "chat": {"id": CHAT_ID, "type": "private"},
+        "from": BOT_USER,
+        "text": text,
+    }
+
+
+class FakeBotAPIHandler(http.server.BaseHTTPRequestHandler):
+    def do_POST(self):
+        method = self.path.rsplit("/", 1)[-1]
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        print(f"<- {method} {body[:200]!r}")
+
+        if method == "getMe":
+            result = BOT_USER
+        elif method.startswith("send") or method.startswith("edit"):
+            result = _message()
+        else:
+            result = True
+
+        payload = json.dumps({"ok": True, "result": result}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass  # Suppress logs
+
+
+def serve():
+    with socketserver.ThreadingTCPServer(("127.0.0.1", PORT), FakeBotAPIHandler) as httpd:
+        print(f"Fake Bot API on http://127.0.0.1:{PORT}/bot")
+        httpd.serve_forever()
+
+
+def send(text: str):
+    """POST a text message update to the bot webhook"""
+    update = {
+        "update_id": int(time.time()),
+        "message": {
+            "message_id": 1,
+            "date": int(time.time()),
+            "chat": {"id": CHAT_ID, "type": "private"},
+            "from": FROM_USER,
+            "text": text,
+        },
+    }
+    response = httpx.post(
+        WEBHOOK,
+        json=update,
+        headers={"X-Telegram-Bot-Api-Secret-Token": SECRET_TOKEN},
+    )
+    print(f"-> webhook: {response.status_code}")
+
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] not in ("serve", "send"):
+        print(__doc__)
+        sys.exit(1)
+
+    if sys.argv[1] == "serve":
+        serve()
+    else:
+        send(" ".join(sys.argv[2:]) or "тест 10 евро")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,200 @@
+"""
+Local store for downloaded Telegram files (config.UPLOAD_DIR)
+
+- Layout: <UPLOAD_DIR>/<aa>/<bb>/<kind>_<file_unique_id><ext>, sharded by a
+  hash of file_unique_id, so no directory grows large and a resent file maps
+  to the same path. Raw Telegram file names stay in Expense.file_name only
+- Writes are atomic: downloads go to a temporary file that is renamed into
+  place, readers never see a partial file
+- Retention: a background sweep deletes files that are no longer needed
+  (already in Dropbox, cancelled, or not referenced by any expense) once
+  they are older than config.UPLOAD_RETENTION_DAYS, and oldest first while
+  the store is over config.UPLOAD_MAX_MB. Files of pending or not yet
+  uploaded expenses are never evicted
+- Disk usage is exported as payme_upload_store_bytes / _files
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import re
+import secrets
+import time
+from typing import Callable, List, NamedTuple, Optional, Set
+
+import metrics
+import tracing
+from config import config
+from database import Expense, ExpenseStatus
+
+logger = logging.getLogger(__name__)
+
+STORE_BYTES = metrics.gauge("payme_upload_store_bytes", "Size of downloaded files kept in UPLOAD_DIR")
+STORE_FILES = metrics.gauge("payme_upload_store_files", "Number of downloaded files kept in UPLOAD_DIR")
+EVICTIONS = metrics.counter("payme_upload_evictions_total", "Local files deleted by the retention sweep")
+
+TEMP_SUFFIX = ".part"
+
+# Younger files are left alone: their expense may not reference them yet (download in progress)
+MIN_AGE_SECONDS = 3600
+
+# Paths per query when checking which files expenses still need
+QUERY_CHUNK = 500
+
+
+def _safe_ext(ext: str) -> str:
+    """Extension from a user supplied file name, reduced to [a-z0-9]"""
+    ext = re.sub(r"[^a-z0-9]", "", ext.lower().lstrip("."))[:10]
+    return f".{ext}" if ext else ""
+
+
+def store_path(kind: str, file_unique_id: str, ext: str = "") -> str:
+    """Where a Telegram file is kept (kind: photo / doc / voice)"""
+    shard = hashlib.sha1(file_unique_id.encode()).hexdigest()
+    name = re.sub(r"[^A-Za-z0-9_-]", "", file_unique_id)
+    return os.path.join(config.UPLOAD_DIR, shard[:2], shard[2:4], f"{kind}_{name}{_safe_ext(ext)}")
+
+
+async def download(file, kind: str, ext: str = "") -> str:
+    """Download a telegram.File into the store (temporary file + rename), returns its path"""
+    path = store_path(kind, file.file_unique_id, ext)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{secrets.token_hex(4)}{TEMP_SUFFIX}"
+    try:
+        with tracing.span("telegram.download", kind=kind, size=getattr(file, "file_size", None)):
+            await file.download_to_drive(tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    return path
+
+
+class StoredFile(NamedTuple):
+    path: str
+    size: int
+    mtime: float
+
+
+def _scan(root: str) -> List[StoredFile]:
+    files = []
+    for directory, _, names in os.walk(root):
+        for name in names:
+            path = os.path.join(directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append(StoredFile(path, stat.st_size, stat.st_mtime))
+    return files
+
+
+def _needed_paths(session, paths: List[str]) -> Set[str]:
+    """Paths of expenses that still need their file (pending, or not in Dropbox yet)"""
+    needed = set()
+    for i in range(0, len(paths), QUERY_CHUNK):
+        rows = session.query(Expense.file_path).filter(
+            Expense.file_path.in_(paths[i:i + QUERY_CHUNK]),
+            Expense.dropbox_url.is_(None),
+            Expense.status != ExpenseStatus.CANCELLED,
+        ).distinct().all()
+        needed.update(row[0] for row in rows)
+    return needed
+
+
+class FileStore:
+    """Retention sweep over config.UPLOAD_DIR, run periodically in the background"""
+
+    def __init__(self, root: str, max_bytes: int, retention_seconds: float, interval: float):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.retention_seconds = retention_seconds
+        self.interval = interval
+        self._session_factory: Optional[Callable] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def _remove(self, file: StoredFile, reason: str) -> bool:
+        try:
+            os.remove(file.path)
+        except OSError as e:
+            logger.warning(f"[FileStore] Could not delete {file.path}: {e}")
+            return False
+        EVICTIONS.inc(reason=reason)
+        return True
+
+    def sweep(self, now: float = None) -> int:
+        """Evict files past retention / over budget, returns how many were deleted"""
+        now = now or time.time()
+        files = _scan(self.root)
+
+        # Temporary files of interrupted downloads
+        stale = [f for f in files if f.path.endswith(TEMP_SUFFIX) and now - f.mtime > MIN_AGE_SECONDS]
+        removed = {f.path for f in stale if self._remove(f, "partial")}
+        files = [f for f in files if not f.path.endswith(TEMP_SUFFIX)]
+
+        candidates = sorted((f for f in files if now - f.mtime > MIN_AGE_SECONDS), key=lambda f: f.mtime)
+        session = self._session_factory()
+        try:
+            needed = _needed_paths(session, [f.path for f in candidates])
+        finally:
+            session.close()
+        evictable = [f for f in candidates if f.path not in needed]
+
+        total = sum(f.size for f in files)
+        for file in evictable:
+            if now - file.mtime > self.retention_seconds:
+                reason = "age"
+            elif total > self.max_bytes:
+                reason = "size"
+            else:
+                # Oldest first: the rest are younger and the store is within budget
+                break
+            if self._remove(file, reason):
+                removed.add(file.path)
+                total -= file.size
+
+        kept = [f for f in files if f.path not in removed]
+        STORE_BYTES.set(total)
+        STORE_FILES.set(len(kept))
+        if total > self.max_bytes:
+            logger.warning(
+                f"[FileStore] {total / 1024 / 1024:.0f} MB kept, over the {self.max_bytes / 1024 / 1024:.0f} MB "
+                f"budget: the remaining files belong to pending or not uploaded expenses"
+            )
+        if removed:
+            logger.info(f"[FileStore] Evicted {len(removed)} files, {len(kept)} kept ({total / 1024 / 1024:.1f} MB)")
+        return len(removed)
+
+    async def _sweep_loop(self):
+        while True:
+            try:
+                await asyncio.to_thread(self.sweep)
+            except Exception as e:
+                logger.error(f"[FileStore] Sweep failed: {e}", exc_info=True)
+            await asyncio.sleep(self.interval)
+
+    def start(self, session_factory: Callable):
+        """Start the periodic sweep (session_factory returns a new database session)"""
+        self._session_factory = session_factory
+        if self._task is None:
+            self._task = asyncio.create_task(self._sweep_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+upload_store = FileStore(
+    config.UPLOAD_DIR,
+    max_bytes=int(config.UPLOAD_MAX_MB * 1024 * 1024),
+    retention_seconds=config.UPLOAD_RETENTION_DAYS * 86400,
+    interval=config.UPLOAD_SWEEP_INTERVAL,
+)
@@ -1,8 +1,21 @@
 """
 Inline keyboards for the Expense Bot
+
+Category/subcategory keyboards are built from templates precomputed per
+catalog version (button texts, row layout, encoded callback prefixes);
+only the expense/batch id is filled in per message. Filled keyboards are
+memoized too, so "Назад" taps on the same expense reuse the markup. The
+first keyboard of an expense costs about as much as building it from
+scratch: creating the telegram button objects dominates, not the texts
+(see benchmarks/bench_keyboards.py).
 """
+import threading
+from functools import lru_cache
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
-from config import CallbackPrefix
+import metrics
+from config import CallbackAction
+from callback_router import encode_callback, CallbackTemplate
+from catalog import Catalog
 
 # Category emojis mapping (match database codes)
 CATEGORY_EMOJIS = {
@@ -45,40 +58,133 @@ def get_transcription_confirmation_keyboard(expense_id: int) -> InlineKeyboardMa
         [
             InlineKeyboardButton(
                 "✅ Да, верно",
-                callback_data=f"{CallbackPrefix.CONFIRM_TRANSCRIPTION}:{expense_id}"
+                callback_data=encode_callback(CallbackAction.CONFIRM_TRANSCRIPTION, expense_id)
             ),
             InlineKeyboardButton(
                 "🔄 Записать заново",
-                callback_data=f"{CallbackPrefix.RETRY_TRANSCRIPTION}:{expense_id}"
+                callback_data=encode_callback(CallbackAction.RETRY_TRANSCRIPTION, expense_id)
             ),
         ],
     ]
     return InlineKeyboardMarkup(keyboard)
 
 
-def get_categories_keyboard(categories: list, expense_id: int) -> InlineKeyboardMarkup:
+def _chunk(buttons: list, size: int = 2) -> tuple:
+    """Split buttons into rows (2 per row by default)"""
+    return tuple(tuple(buttons[i:i + size]) for i in range(0, len(buttons), size))
+
+
+def _fill(template_rows: tuple, *args: int) -> list:
+    """Build button rows from (text, CallbackTemplate) rows"""
+    return [
+        [InlineKeyboardButton(text, callback_data=template.fill(*args)) for text, template in row]
+        for row in template_rows
+    ]
+
+
+@lru_cache(maxsize=64)
+def _category_rows(catalog: Catalog, action: CallbackAction) -> tuple:
+    """Category buttons template for a catalog version"""
+    return _chunk([
+        (f"{CATEGORY_EMOJIS.get(cat.code, '📂')} {cat.name}", CallbackTemplate(action, cat.id))
+        for cat in catalog.categories
+    ])
+
+
+@lru_cache(maxsize=256)
+def _subcategory_rows(catalog: Catalog, category_id: int, action: CallbackAction) -> tuple:
+    """Subcategory buttons template for a catalog version"""
+    return _chunk([
+        (f"{SUBCATEGORY_EMOJIS.get(sub.code, '📌')} {sub.name}", CallbackTemplate(action, sub.id))
+        for sub in catalog.subcategories_of(category_id)
+    ])
+
+
+@lru_cache(maxsize=1024)
+def get_categories_keyboard(catalog: Catalog, expense_id: int) -> InlineKeyboardMarkup:
     """
     Keyboard for selecting main category (2 buttons per row)
     """
-    keyboard = []
-    row = []
+    return InlineKeyboardMarkup(_fill(_category_rows(catalog, CallbackAction.CATEGORY), expense_id))
 
-    for cat in categories:
-        emoji = CATEGORY_EMOJIS.get(cat.code, "📂")
-        row.append(
-            InlineKeyboardButton(
-                f"{emoji} {cat.name}",
-                callback_data=f"{CallbackPrefix.CATEGORY}:{cat.id}:{expense_id}"
-            )
+
+@lru_cache(maxsize=1024)
+def get_media_categories_keyboard(catalog: Catalog, expense_id: int) -> InlineKeyboardMarkup:
+    """
+    Category keyboard of a photo/document expense, sent before extraction
+    finishes, with a cancel row
+    """
+    keyboard = _fill(_category_rows(catalog, CallbackAction.CATEGORY), expense_id)
+    keyboard.append([
+        InlineKeyboardButton(
+            "❌ Отмена",
+            callback_data=encode_callback(CallbackAction.CANCEL, expense_id)
         )
-        if len(row) == 2:
-            keyboard.append(row)
-            row = []
+    ])
+    return InlineKeyboardMarkup(keyboard)
+
 
-    # Add remaining button if odd number
-    if row:
-        keyboard.append(row)
+def with_suggestion(
+    markup: InlineKeyboardMarkup,
+    catalog: Catalog,
+    subcategory,
+    action: CallbackAction,
+    target_id: int
+) -> InlineKeyboardMarkup:
+    """
+    Keyboard with a one-tap button for a suggested subcategory on top.
+    action: SUBCATEGORY (target: expense) or BATCH_SUBCATEGORY (target: batch)
+    """
+    category = catalog.category(subcategory.category_id)
+    path = f"{category.name} → {subcategory.name}" if category else subcategory.name
+    button = InlineKeyboardButton(
+        f"✨ {SUBCATEGORY_EMOJIS.get(subcategory.code, '📌')} {path}",
+        callback_data=encode_callback(action, subcategory.id, target_id)
+    )
+    return InlineKeyboardMarkup([[button], *markup.inline_keyboard])
 
+
+def with_shortcuts(
+    markup: InlineKeyboardMarkup,
+    choices: list,
+    expense_id: int
+) -> InlineKeyboardMarkup:
+    """
+    Keyboard with a top row of frequent choices: [(subcategory entry, payment code), ...],
+    each button sets category, subcategory and payment type at once
+    """
+    row = [
+        InlineKeyboardButton(
+            f"{SUBCATEGORY_EMOJIS.get(subcategory.code, '📌')} {subcategory.name}"
+            + {1: " 💵", 2: " 🏦"}.get(payment_code, ""),
+            callback_data=encode_callback(CallbackAction.SHORTCUT, subcategory.id, payment_code, expense_id)
+        )
+        for subcategory, payment_code in choices
+    ]
+    return InlineKeyboardMarkup([row, *markup.inline_keyboard])
+
+
+def with_amount_edit(markup: InlineKeyboardMarkup, expense_id: int) -> InlineKeyboardMarkup:
+    """Keyboard of an extracted photo/document expense with an "edit amount" row at the bottom"""
+    button = InlineKeyboardButton(
+        "✏️ Изменить сумму",
+        callback_data=encode_callback(CallbackAction.EDIT_AMOUNT, expense_id)
+    )
+    return InlineKeyboardMarkup([*markup.inline_keyboard, [button]])
+
+
+def get_amount_input_keyboard(expense_id: int, amount, currency: str) -> InlineKeyboardMarkup:
+    """
+    Keyboard under the amount prompt: keep the current amount (or go on
+    without one) instead of typing it, or cancel the expense
+    """
+    keep = f"✅ Оставить {amount} {currency}" if amount is not None else "⏭ Без суммы"
+    keyboard = [
+        [
+            InlineKeyboardButton(keep, callback_data=encode_callback(CallbackAction.CONFIRM_AMOUNT, expense_id)),
+            InlineKeyboardButton("❌ Отмена", callback_data=encode_callback(CallbackAction.CANCEL, expense_id)),
+        ],
+    ]
     return InlineKeyboardMarkup(keyboard)
 
 
@@ -91,55 +197,39 @@ def get_payment_type_keyboard(expense_id: int) -> InlineKeyboardMarkup:
         [
             InlineKeyboardButton(
                 "💵 Cash",
-                callback_data=f"{CallbackPrefix.PAYMENT_CASH}:{expense_id}"
+                callback_data=encode_callback(CallbackAction.PAYMENT_CASH, expense_id)
             ),
             InlineKeyboardButton(
                 "🏦 Bank",
-                callback_data=f"{CallbackPrefix.PAYMENT_BANK}:{expense_id}"
+                callback_data=encode_callback(CallbackAction.PAYMENT_BANK, expense_id)
             ),
         ],
         [
             InlineKeyboardButton(
                 "⬅️ Назад",
-                callback_data=f"{CallbackPrefix.BACK_TO_SUBCATEGORY}:{expense_id}"
+                callback_data=encode_callback(CallbackAction.BACK_TO_SUBCATEGORY, expense_id)
             )
         ]
     ]
     return InlineKeyboardMarkup(keyboard)
 
 
+@lru_cache(maxsize=1024)
 def get_subcategories_keyboard(
-    subcategories: list,
+    catalog: Catalog,
     category_id: int,
     expense_id: int
 ) -> InlineKeyboardMarkup:
     """
     Keyboard for selecting subcategory (2 buttons per row)
     """
-    keyboard = []
-    row = []
-
-    for subcat in subcategories:
-        emoji = SUBCATEGORY_EMOJIS.get(subcat.code, "📌")
-        row.append(
-            InlineKeyboardButton(
-                f"{emoji} {subcat.name}",
-                callback_data=f"{CallbackPrefix.SUBCATEGORY}:{subcat.id}:{expense_id}"
-            )
-        )
-        if len(row) == 2:
-            keyboard.append(row)
-            row = []
-
-    # Add remaining button if odd number
-    if row:
-        keyboard.append(row)
+    keyboard = _fill(_subcategory_rows(catalog, category_id, CallbackAction.SUBCATEGORY), expense_id)
 
     # Add back button
     keyboard.append([
         InlineKeyboardButton(
             "⬅️ Назад",
-            callback_data=f"{CallbackPrefix.BACK}:{expense_id}"
+            callback_data=encode_callback(CallbackAction.BACK, expense_id)
         )
     ])
 
@@ -152,11 +242,11 @@ def get_amount_confirmation_keyboard(expense_id: int, amount: float, currency: s
         [
             InlineKeyboardButton(
                 f"✅ Да, {amount} {currency}",
-                callback_data=f"{CallbackPrefix.CONFIRM_AMOUNT}:{expense_id}"
+                callback_data=encode_callback(CallbackAction.CONFIRM_AMOUNT, expense_id)
             ),
             InlineKeyboardButton(
                 "🔄 Нет",
-                callback_data=f"{CallbackPrefix.RETRY_TRANSCRIPTION}:{expense_id}"
+                callback_data=encode_callback(CallbackAction.RETRY_TRANSCRIPTION, expense_id)
             ),
         ],
     ]
@@ -169,12 +259,140 @@ def get_voice_with_amount_keyboard(expense_id: int, amount: float, currency: str
         [
             InlineKeyboardButton(
                 f"✅ Да, {amount} {currency}",
-                callback_data=f"{CallbackPrefix.CONFIRM_TRANSCRIPTION}:{expense_id}"
+                callback_data=encode_callback(CallbackAction.CONFIRM_TRANSCRIPTION, expense_id)
             ),
             InlineKeyboardButton(
                 "🔄 Нет",
-                callback_data=f"{CallbackPrefix.RETRY_TRANSCRIPTION}:{expense_id}"
+                callback_data=encode_callback(CallbackAction.RETRY_TRANSCRIPTION, expense_id)
+            ),
+        ],
+    ]
+    return InlineKeyboardMarkup(keyboard)
+
+
+def get_batch_categories_keyboard(
+    catalog: Catalog,
+    batch_id: int,
+    selection: list = None
+) -> InlineKeyboardMarkup:
+    """
+    Keyboard for selecting one category for the selected expenses of a batch.
+    selection: [(item_number, is_selected), ...] for pending items -
+    with more than one item, toggle buttons (5 per row) are shown on top,
+    followed by a pager when exactly one item is selected
+    """
+    keyboard = []
+
+    if selection and len(selection) > 1:
+        keyboard.extend(_chunk([
+            InlineKeyboardButton(
+                f"{'☑️' if is_selected else '⬜'} {number}",
+                callback_data=encode_callback(CallbackAction.BATCH_SELECT, batch_id, number)
+            )
+            for number, is_selected in selection
+        ], size=5))
+
+        numbers = [number for number, _ in selection]
+        selected = [number for number, is_selected in selection if is_selected]
+        all_selected = len(selected) == len(numbers)
+
+        if len(selected) == 1:
+            # One by one: pager over the pending items
+            position = numbers.index(selected[0])
+            keyboard.append([
+                InlineKeyboardButton(
+                    "◀️",
+                    callback_data=encode_callback(CallbackAction.BATCH_ITEM, batch_id, numbers[position - 1])
+                ),
+                InlineKeyboardButton(
+                    "☑️ Выбрать все",
+                    callback_data=encode_callback(CallbackAction.BATCH_SELECT_ALL, batch_id, 1)
+                ),
+                InlineKeyboardButton(
+                    "▶️",
+                    callback_data=encode_callback(
+                        CallbackAction.BATCH_ITEM, batch_id, numbers[(position + 1) % len(numbers)]
+                    )
+                ),
+            ])
+        else:
+            keyboard.append([
+                InlineKeyboardButton(
+                    "⬜ Снять все" if all_selected else "☑️ Выбрать все",
+                    callback_data=encode_callback(CallbackAction.BATCH_SELECT_ALL, batch_id, 0 if all_selected else 1)
+                ),
+                InlineKeyboardButton(
+                    "👉 По одному",
+                    callback_data=encode_callback(CallbackAction.BATCH_ITEM, batch_id, numbers[0])
+                ),
+            ])
+
+    keyboard.extend(_fill(_category_rows(catalog, CallbackAction.BATCH_CATEGORY), batch_id))
+    return InlineKeyboardMarkup(keyboard)
+
+
+@lru_cache(maxsize=256)
+def get_batch_subcategories_keyboard(catalog: Catalog, category_id: int, batch_id: int) -> InlineKeyboardMarkup:
+    """
+    Keyboard for selecting one subcategory for the selected expenses of a batch (2 buttons per row)
+    """
+    keyboard = _fill(_subcategory_rows(catalog, category_id, CallbackAction.BATCH_SUBCATEGORY), batch_id)
+
+    keyboard.append([
+        InlineKeyboardButton(
+            "⬅️ Назад",
+            callback_data=encode_callback(CallbackAction.BATCH_BACK, batch_id)
+        )
+    ])
+
+    return InlineKeyboardMarkup(keyboard)
+
+
+def get_batch_payment_type_keyboard(batch_id: int, category_id: int, subcategory_id: int) -> InlineKeyboardMarkup:
+    """
+    Keyboard for selecting payment type for the selected expenses of a batch
+    Final step before saving
+    """
+    keyboard = [
+        [
+            InlineKeyboardButton(
+                "💵 Cash",
+                callback_data=encode_callback(CallbackAction.BATCH_PAYMENT_CASH, subcategory_id, batch_id)
+            ),
+            InlineKeyboardButton(
+                "🏦 Bank",
+                callback_data=encode_callback(CallbackAction.BATCH_PAYMENT_BANK, subcategory_id, batch_id)
             ),
         ],
+        [
+            InlineKeyboardButton(
+                "⬅️ Назад",
+                callback_data=encode_callback(CallbackAction.BATCH_CATEGORY, category_id, batch_id)
+            )
+        ]
     ]
     return InlineKeyboardMarkup(keyboard)
+
+
+# Memoized builders, their hit rate is reported as cache="keyboards"
+_CACHED_BUILDERS = (
+    _category_rows,
+    _subcategory_rows,
+    get_categories_keyboard,
+    get_media_categories_keyboard,
+    get_subcategories_keyboard,
+    get_batch_subcategories_keyboard,
+)
+_reported = {"hit": 0, "miss": 0}
+_reported_lock = threading.Lock()
+
+
+def _collect_cache_stats():
+    infos = [builder.cache_info() for builder in _CACHED_BUILDERS]
+    with _reported_lock:
+        for result, total in (("hit", sum(i.hits for i in infos)), ("miss", sum(i.misses for i in infos))):
+            metrics.CACHE_REQUESTS.inc(total - _reported[result], cache="keyboards", result=result)
+            _reported[result] = total
+
+
+metrics.register_collector(_collect_cache_stats)
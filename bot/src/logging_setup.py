@@ -0,0 +1,183 @@
+"""
+Logging pipeline: non-blocking, structured, rate-limited
+
+setup() (once, at startup) puts a QueueHandler on the root logger: code
+that logs only enqueues the record, a QueueListener thread formats and
+writes it, so the event loop never waits for log I/O.
+
+- Records get the update id, user id, trace id and stage (the current
+  tracing span) of the code that logged them, plus any extra= fields
+  (e.g. duration); LOG_FORMAT=json writes one JSON object per line,
+  LOG_FORMAT=text the classic format
+- Repeated warnings/errors (same logger and message, numbers ignored) pass
+  LOG_REPEAT_LIMIT times per LOG_REPEAT_WINDOW seconds; the first one after
+  the window says how many were suppressed
+- LOG_LEVEL sets the root level, LOG_LEVELS per module levels
+  ("httpx=WARNING,dropbox_service=DEBUG")
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import re
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Dict, Optional, Tuple
+
+import tracing
+from config import config
+
+TEXT_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+
+# Attributes every LogRecord has, anything else came in through extra=
+_STANDARD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+class ContextFilter(logging.Filter):
+    """Adds the current trace context (runs in the logging thread/task, before queueing)"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        span = tracing.current()
+        if span is not None:
+            for name, value in (
+                ("update_id", span.update_id),
+                ("user_id", span.user_id),
+                ("trace_id", span.trace_id),
+                ("stage", span.name),
+            ):
+                if not hasattr(record, name):
+                    setattr(record, name, value)
+        return True
+
+
+class RepeatFilter(logging.Filter):
+    """Lets a repeated warning/error through `limit` times per `window` seconds"""
+
+    def __init__(self, limit: int, window: float):
+        super().__init__()
+        self.limit = limit
+        self.window = window
+        # key -> (window start, passed, suppressed)
+        self._seen: Dict[Tuple[str, int, str], Tuple[float, int, int]] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(record: logging.LogRecord) -> Tuple[str, int, str]:
+        return record.name, record.levelno, re.sub(r"\d+", "#", str(record.msg)[:200])
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno < logging.WARNING or self.limit <= 0:
+            return True
+        key = self._key(record)
+        now = time.monotonic()
+        with self._lock:
+            started, passed, suppressed = self._seen.get(key, (now, 0, 0))
+            if now - started > self.window:
+                if suppressed:
+                    record.suppressed_repeats = suppressed
+                started, passed, suppressed = now, 0, 0
+            if passed >= self.limit:
+                self._seen[key] = (started, passed, suppressed + 1)
+                return False
+            self._seen[key] = (started, passed + 1, suppressed)
+            if len(self._seen) > 10000:
+                # Forget finished windows
+                self._seen = {k: v for k, v in self._seen.items() if now - v[0] <= self.window}
+        return True
+
+
+class StructuredQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that keeps the traceback separate from the message"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.message = record.getMessage()
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.msg = record.message
+        record.args = None
+        record.exc_info = None
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for name, value in vars(record).items():
+            if name not in _STANDARD_ATTRIBUTES and value is not None:
+                data[name] = value
+        if record.exc_text:
+            data["exc"] = record.exc_text
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """Classic format, with the update and repeat count appended when known"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        text = super().format(record)
+        update_id = getattr(record, "update_id", None)
+        if update_id is not None:
+            text += f" [update {update_id}]"
+        suppressed = getattr(record, "suppressed_repeats", None)
+        if suppressed:
+            text += f" (+{suppressed} similar suppressed)"
+        return text
+
+
+def _parse_levels(spec: str) -> Dict[str, str]:
+    levels = {}
+    for item in spec.split(","):
+        name, _, level = item.partition("=")
+        if name.strip() and level.strip():
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def setup(log_format: str = None):
+    """Install the queue-based pipeline on the root logger (idempotent)"""
+    global _listener
+    if _listener is not None:
+        return
+
+    output = logging.StreamHandler(sys.stdout)
+    if (log_format or config.LOG_FORMAT).lower() == "json":
+        output.setFormatter(JsonFormatter())
+    else:
+        output.setFormatter(TextFormatter(TEXT_FORMAT))
+
+    log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+    handler = StructuredQueueHandler(log_queue)
+    handler.addFilter(RepeatFilter(config.LOG_REPEAT_LIMIT, config.LOG_REPEAT_WINDOW))
+    handler.addFilter(ContextFilter())
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(config.LOG_LEVEL.upper())
+    for name, level in _parse_levels(config.LOG_LEVELS).items():
+        logging.getLogger(name).setLevel(level)
+
+    _listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=True)
+    _listener.start()
+    atexit.register(shutdown)
+
+
+def shutdown():
+    """Write out queued records and stop the listener thread (last thing on exit, also run by atexit)"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -0,0 +1,225 @@
+"""
+Admission-controlled job queue for heavy media processing
+
+Photo/document/voice jobs (download + OpenAI) go through one bounded queue:
+- at most config.HEAVY_JOBS_MAX jobs run at once
+- lower priority value runs first (voice before photos before documents)
+- within a priority, users take turns (the user served longest ago goes next)
+- new jobs are rejected with QueueFull once the queue or the user's share is full
+Jobs run in the submitter's context, so they stay in the update's trace.
+"""
+import asyncio
+import contextvars
+import enum
+import itertools
+import logging
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Set
+
+import metrics
+import tracing
+from config import config
+from profiling import profiler
+
+logger = logging.getLogger(__name__)
+
+QUEUE_WAIT = metrics.histogram(
+    "payme_media_queue_wait_seconds",
+    "Time a media job waited in the queue before starting",
+)
+QUEUE_DEPTH = metrics.gauge("payme_media_queue_depth", "Media jobs waiting in the queue")
+QUEUE_RUNNING = metrics.gauge("payme_media_queue_running", "Media jobs currently running")
+QUEUE_REJECTED = metrics.counter("payme_media_queue_rejected_total", "Media jobs rejected by admission control")
+
+
+class JobPriority(enum.IntEnum):
+    """Lower runs first"""
+    VOICE = 0
+    PHOTO = 1
+    DOCUMENT = 2
+
+
+class QueueFull(Exception):
+    """Raised when a job is not admitted"""
+
+    def __init__(self, per_user: bool):
+        super().__init__("user queue limit reached" if per_user else "media queue is full")
+        self.per_user = per_user
+
+
+# on_position(position): position >= 1 while queued, 0 once the job starts
+PositionCallback = Callable[[int], Awaitable[None]]
+
+
+@dataclass
+class _Job:
+    user_id: int
+    priority: JobPriority
+    seq: int
+    factory: Callable[[], Awaitable[Any]]
+    future: asyncio.Future
+    on_position: Optional[PositionCallback] = None
+    enqueued_at: float = field(default_factory=time.monotonic)
+    last_position: Optional[int] = None
+    # The submitter's context: the job runs in its trace
+    context: contextvars.Context = field(default_factory=contextvars.copy_context)
+
+
+class MediaJobQueue:
+    """Bounded, priority-aware queue with per-user fair scheduling"""
+
+    def __init__(self, max_running: int, max_pending: int, max_pending_per_user: int):
+        self.max_running = max_running
+        self.max_pending = max_pending
+        self.max_pending_per_user = max_pending_per_user
+
+        self._pending: Dict[int, Deque[_Job]] = {}
+        self._last_served: Dict[int, int] = {}
+        self._seq = itertools.count()
+        self._serve_seq = itertools.count(1)
+        self._running = 0
+        # The loop keeps only weak references to tasks: job runs and position updates live here
+        self._tasks: Set[asyncio.Task] = set()
+
+    @property
+    def depth(self) -> int:
+        return sum(len(jobs) for jobs in self._pending.values())
+
+    @property
+    def running(self) -> int:
+        return self._running
+
+    def pending_for(self, user_id: int) -> int:
+        return len(self._pending.get(user_id, ()))
+
+    async def submit(
+        self,
+        user_id: int,
+        priority: JobPriority,
+        factory: Callable[[], Awaitable[Any]],
+        on_position: Optional[PositionCallback] = None,
+    ) -> Any:
+        """Queue a job and wait for its result; raises QueueFull if not admitted"""
+        if self.pending_for(user_id) >= self.max_pending_per_user:
+            QUEUE_REJECTED.inc(reason="user")
+            raise QueueFull(per_user=True)
+        if self.depth >= self.max_pending:
+            QUEUE_REJECTED.inc(reason="global")
+            raise QueueFull(per_user=False)
+
+        job = _Job(
+            user_id=user_id,
+            priority=priority,
+            seq=next(self._seq),
+            factory=factory,
+            future=asyncio.get_running_loop().create_future(),
+            on_position=on_position,
+        )
+        self._pending.setdefault(user_id, deque()).append(job)
+        self._pump()
+
+        try:
+            return await job.future
+        except asyncio.CancelledError:
+            # Handler went away while waiting - drop the job if it hasn't started
+            jobs = self._pending.get(user_id)
+            if jobs and job in jobs:
+                jobs.remove(job)
+                if not jobs:
+                    del self._pending[user_id]
+                self._pump()
+            raise
+
+    def _order(self) -> List[_Job]:
+        """Pending jobs in the order they will be started"""
+        heads = {user_id: list(jobs) for user_id, jobs in self._pending.items() if jobs}
+        last_served = dict(self._last_served)
+        serve_seq = itertools.count(10 ** 9)
+        ordered = []
+
+        while heads:
+            user_id = min(
+                heads,
+                key=lambda u: (heads[u][0].priority, last_served.get(u, 0), heads[u][0].seq),
+            )
+            ordered.append(heads[user_id].pop(0))
+            last_served[user_id] = next(serve_seq)
+            if not heads[user_id]:
+                del heads[user_id]
+
+        return ordered
+
+    def _pump(self):
+        """Start jobs while there are free slots, then refresh queue positions"""
+        ordered = self._order()
+
+        while ordered and self._running < self.max_running:
+            job = ordered.pop(0)
+            jobs = self._pending[job.user_id]
+            jobs.remove(job)
+            if not jobs:
+                del self._pending[job.user_id]
+            self._last_served[job.user_id] = next(self._serve_seq)
+            self._start(job)
+
+        for position, job in enumerate(ordered, start=1):
+            self._notify(job, position)
+
+        QUEUE_DEPTH.set(len(ordered))
+        QUEUE_RUNNING.set(self._running)
+
+    def _start(self, job: _Job):
+        self._running += 1
+        waited = time.monotonic() - job.enqueued_at
+        QUEUE_WAIT.observe(waited, priority=job.priority.name.lower())
+        if waited > 1:
+            logger.info(f"[Queue] user {job.user_id} {job.priority.name.lower()} job waited {waited:.1f}s")
+
+        if job.last_position:
+            self._notify(job, 0)
+        self._spawn(self._run(job), context=job.context)
+
+    async def _run(self, job: _Job):
+        priority = job.priority.name.lower()
+        tracing.record("queue.wait", time.time() - (time.monotonic() - job.enqueued_at), priority=priority)
+        try:
+            with tracing.span("media.job", priority=priority):
+                result = await profiler.background(job.factory(), "media")
+            if not job.future.done():
+                job.future.set_result(result)
+        except asyncio.CancelledError:
+            job.future.cancel()
+            raise
+        except Exception as e:
+            if not job.future.done():
+                job.future.set_exception(e)
+        finally:
+            self._running -= 1
+            self._pump()
+
+    def _notify(self, job: _Job, position: int):
+        if job.on_position is None or job.last_position == position:
+            return
+        job.last_position = position
+        self._spawn(self._safe_notify(job.on_position, position))
+
+    def _spawn(self, coro, context: contextvars.Context = None):
+        task = asyncio.create_task(coro, context=context)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    @staticmethod
+    async def _safe_notify(callback: PositionCallback, position: int):
+        try:
+            await callback(position)
+        except Exception as e:
+            logger.debug(f"[Queue] position update failed: {e}")
+
+
+media_queue = MediaJobQueue(
+    max_running=config.HEAVY_JOBS_MAX,
+    max_pending=config.MEDIA_QUEUE_MAX,
+    max_pending_per_user=config.MEDIA_QUEUE_PER_USER,
+)
@@ -0,0 +1,251 @@
+"""
+In-process metrics: counters, gauges and histograms
+
+render() formats all metrics in the Prometheus text format, serve() exposes
+them on GET /metrics (config.METRICS_PORT). Values that are cheap to read
+but not tracked as they change (cache statistics, queue sizes) come from
+collectors that run right before metrics are read.
+"""
+import asyncio
+import bisect
+import logging
+import threading
+from typing import Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Seconds, covers Telegram taps (ms) up to long PDF/vision calls
+DEFAULT_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0,
+)
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+
+def _label_key(labels: dict) -> LabelKey:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+class Counter:
+    """Monotonic counter with optional labels"""
+
+    def __init__(self, name: str, help_text: str = ""):
+        self.name = name
+        self.help = help_text
+        self._values: Dict[LabelKey, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(_label_key(labels), 0)
+
+    def items(self) -> List[Tuple[LabelKey, float]]:
+        with self._lock:
+            return list(self._values.items())
+
+
+class Gauge:
+    """Value that can go up and down, with optional labels"""
+
+    def __init__(self, name: str, help_text: str = ""):
+        self.name = name
+        self.help = help_text
+        self._values: Dict[LabelKey, float] = {}
+        self._lock = threading.Lock()
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[_label_key(labels)] = value
+
+    def value(self, **labels) -> float:
+        return self._values.get(_label_key(labels), 0)
+
+    def items(self) -> List[Tuple[LabelKey, float]]:
+        with self._lock:
+            return list(self._values.items())
+
+
+class _HistogramSeries:
+    __slots__ = ("counts", "count", "sum", "max")
+
+    def __init__(self, n_buckets: int):
+        self.counts = [0] * (n_buckets + 1)  # last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+
+class Histogram:
+    """Bucketed histogram with optional labels"""
+
+    def __init__(self, name: str, help_text: str = "", buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(sorted(buckets))
+        self._series: Dict[LabelKey, _HistogramSeries] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = _label_key(labels)
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = _HistogramSeries(len(self.buckets))
+            series.counts[idx] += 1
+            series.count += 1
+            series.sum += value
+            if value > series.max:
+                series.max = value
+
+    def items(self) -> List[Tuple[LabelKey, _HistogramSeries]]:
+        with self._lock:
+            return list(self._series.items())
+
+    def quantile(self, q: float, **labels) -> Optional[float]:
+        """Estimate quantile by linear interpolation inside the bucket"""
+        series = self._series.get(_label_key(labels))
+        if not series or not series.count:
+            return None
+
+        rank = q * series.count
+        seen = 0
+        lower = 0.0
+        for i, count in enumerate(series.counts):
+            upper = self.buckets[i] if i < len(self.buckets) else series.max
+            if count and seen + count >= rank:
+                return lower + (upper - lower) * ((rank - seen) / count)
+            seen += count
+            lower = upper
+        return series.max
+
+
+_registry: Dict[str, object] = {}
+_registry_lock = threading.Lock()
+
+
+def counter(name: str, help_text: str = "") -> Counter:
+    """Get or create a counter"""
+    with _registry_lock:
+        metric = _registry.get(name)
+        if metric is None:
+            metric = _registry[name] = Counter(name, help_text)
+        return metric
+
+
+def gauge(name: str, help_text: str = "") -> Gauge:
+    """Get or create a gauge"""
+    with _registry_lock:
+        metric = _registry.get(name)
+        if metric is None:
+            metric = _registry[name] = Gauge(name, help_text)
+        return metric
+
+
+def histogram(name: str, help_text: str = "", buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+    """Get or create a histogram"""
+    with _registry_lock:
+        metric = _registry.get(name)
+        if metric is None:
+            metric = _registry[name] = Histogram(name, help_text, buckets)
+        return metric
+
+
+# Shared by the in-process caches (catalog, keyboards), labels: cache, result (hit / miss)
+CACHE_REQUESTS = counter("payme_cache_requests_total", "Lookups of in-process caches by result (hit / miss)")
+
+
+def all_metrics() -> List[object]:
+    """All registered metrics, in registration order"""
+    with _registry_lock:
+        return list(_registry.values())
+
+
+_collectors: List[Callable[[], None]] = []
+
+
+def register_collector(callback: Callable[[], None]):
+    """callback() refreshes gauges/counters right before metrics are read"""
+    _collectors.append(callback)
+
+
+def collect():
+    for callback in list(_collectors):
+        try:
+            callback()
+        except Exception as e:
+            logger.warning(f"[Metrics] Collector {callback!r} failed: {e}")
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(key: LabelKey, extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+    pairs = key + extra
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+def render() -> str:
+    """All metrics in the Prometheus text exposition format (0.0.4)"""
+    collect()
+    lines = []
+    for metric in all_metrics():
+        kind = {Counter: "counter", Gauge: "gauge", Histogram: "histogram"}[type(metric)]
+        if metric.help:
+            lines.append(f"# HELP {metric.name} {_escape(metric.help)}")
+        lines.append(f"# TYPE {metric.name} {kind}")
+        if isinstance(metric, Histogram):
+            for key, series in metric.items():
+                cumulative = 0
+                for bound, count in zip(metric.buckets + (float("inf"),), series.counts):
+                    cumulative += count
+                    lines.append(f"{metric.name}_bucket{_labels(key, (('le', _number(bound)),))} {cumulative}")
+                lines.append(f"{metric.name}_sum{_labels(key)} {_number(series.sum)}")
+                lines.append(f"{metric.name}_count{_labels(key)} {series.count}")
+        else:
+            for key, value in metric.items():
+                lines.append(f"{metric.name}{_labels(key)} {_number(value)}")
+    return "\n".join(lines) + "\n"
+
+
+async def _handle_http(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), timeout=5.0)
+        parts = request.split(b"\r\n", 1)[0].split()
+        path = parts[1].split(b"?", 1)[0] if len(parts) >= 2 else b""
+        if parts[:1] == [b"GET"] and path == b"/metrics":
+            # Rendering walks every series, keep it off the event loop
+            body = (await asyncio.to_thread(render)).encode("utf-8")
+            status, content_type = "200 OK", "text/plain; version=0.0.4; charset=utf-8"
+        else:
+            body, status, content_type = b"not found\n", "404 Not Found", "text/plain"
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("ascii") + body
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(host: str, port: int) -> asyncio.AbstractServer:
+    """HTTP endpoint for Prometheus scraping: GET /metrics"""
+    server = await asyncio.start_server(_handle_http, host, port)
+    logger.info(f"[Metrics] Serving /metrics on {host}:{port}")
+    return server
@@ -0,0 +1,88 @@
+"""
+Shared HTTP client for OpenAI API calls
+
+One keep-alive connection pool instead of a new client (TCP + TLS handshake)
+per request. Handlers call prewarm() while they download the file, so the
+connection is ready when extraction starts.
+"""
+import json
+import logging
+import time
+from typing import AsyncIterator, Optional
+
+import httpx
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+API_URL = "https://api.openai.com/v1"
+
+# Pooled connections are kept this long; prewarm is skipped while one should still be open
+KEEPALIVE_SECONDS = 120.0
+
+_client: Optional[httpx.AsyncClient] = None
+_last_used = 0.0
+
+
+def get_client() -> httpx.AsyncClient:
+    """Shared client, requests pass their own timeout"""
+    global _client, _last_used
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            timeout=60.0,
+            limits=httpx.Limits(max_keepalive_connections=10, keepalive_expiry=KEEPALIVE_SECONDS),
+        )
+    _last_used = time.monotonic()
+    return _client
+
+
+async def prewarm():
+    """Open a pooled connection to the API unless one was used recently (never raises)"""
+    if not config.OPENAI_API_KEY or time.monotonic() - _last_used < KEEPALIVE_SECONDS / 2:
+        return
+    try:
+        await get_client().head(
+            f"{API_URL}/models",
+            headers={"Authorization": f"Bearer {config.OPENAI_API_KEY}"},
+            timeout=5.0,
+        )
+    except httpx.HTTPError as e:
+        logger.debug(f"[OpenAI] prewarm failed: {e}")
+
+
+async def stream_chat_completion(payload: dict, timeout: float = 30.0) -> AsyncIterator[str]:
+    """
+    Chat completion in streaming mode: yields content deltas as they arrive
+    (server-sent events). Raises httpx.HTTPStatusError for a non-200 response
+    """
+    async with get_client().stream(
+        "POST",
+        f"{API_URL}/chat/completions",
+        timeout=timeout,
+        headers={
+            "Authorization": f"Bearer {config.OPENAI_API_KEY}",
+            "Content-Type": "application/json"
+        },
+        json={**payload, "stream": True},
+    ) as response:
+        if response.status_code != 200:
+            await response.aread()
+            response.raise_for_status()
+        async for line in response.aiter_lines():
+            if not line.startswith("data:"):
+                continue
+            data = line[len("data:"):].strip()
+            if data == "[DONE]":
+                break
+            choices = json.loads(data).get("choices") or []
+            content = choices[0].get("delta", {}).get("content") if choices else None
+            if content:
+                yield content
+
+
+async def close():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
@@ -0,0 +1,168 @@
+"""
+Handler latency, event loop lag and the /perf summary
+
+- measured(): wraps a handler callback, its duration goes to
+  payme_handler_seconds{handler} (errors to payme_handler_errors_total);
+  sampled runs are profiled when profiling is on (see profiling.py)
+- LoopLagMonitor: a task that sleeps config.LOOP_LAG_INTERVAL and records
+  how late it wakes up; lag means something blocks the event loop
+- start(): lag monitor, queue gauges and the /metrics endpoint
+  (config.METRICS_PORT, see metrics.serve)
+- report(): p50/p95/p99 from the same in-process histograms, for /perf
+"""
+import asyncio
+import functools
+import html
+import logging
+import time
+from collections import defaultdict
+from typing import List, Optional
+
+import metrics
+from config import config
+from media_queue import media_queue
+from profiling import profiler
+from timings import PIPELINE_TIME
+from tracing import DB_TIME, DEPENDENCY_TIME
+
+logger = logging.getLogger(__name__)
+
+HANDLER_TIME = metrics.histogram("payme_handler_seconds", "Time a handler callback took for an update")
+HANDLER_ERRORS = metrics.counter("payme_handler_errors_total", "Handler callbacks that raised")
+LOOP_LAG = metrics.histogram(
+    "payme_event_loop_lag_seconds",
+    "How much later than scheduled the event loop resumed a sleeping task",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0),
+)
+ACTIVE_CHATS = metrics.gauge("payme_active_chats", "Chats with an update being processed or waiting")
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+# Telegram message limit, with room for the <pre> tags
+MAX_REPORT_LENGTH = 4000
+
+
+def measured(callback):
+    """Handler callback wrapper recording its duration under the function name"""
+    name = callback.__name__
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        started = time.monotonic()
+        try:
+            return await profiler.run(name, update, callback(update, context))
+        except Exception:
+            HANDLER_ERRORS.inc(handler=name)
+            raise
+        finally:
+            HANDLER_TIME.observe(time.monotonic() - started, handler=name)
+    return wrapper
+
+
+class LoopLagMonitor:
+    """Measures event loop lag by oversleeping of a periodic task"""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            LOOP_LAG.observe(max(0.0, loop.time() - started - self.interval))
+
+    def start(self):
+        if self._task is None and self.interval > 0:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+loop_lag = LoopLagMonitor(config.LOOP_LAG_INTERVAL)
+_server: Optional[asyncio.AbstractServer] = None
+
+
+async def start(application):
+    """Lag monitor, active chats gauge and the metrics endpoint"""
+    global _server
+    loop_lag.start()
+
+    processor = application.update_processor
+    if hasattr(processor, "active_chats"):
+        metrics.register_collector(lambda: ACTIVE_CHATS.set(processor.active_chats))
+
+    if config.METRICS_PORT and _server is None:
+        try:
+            _server = await metrics.serve(config.METRICS_HOST, config.METRICS_PORT)
+        except OSError as e:
+            logger.error(f"[Metrics] Could not listen on {config.METRICS_HOST}:{config.METRICS_PORT}: {e}")
+
+
+async def stop():
+    global _server
+    await loop_lag.stop()
+    if _server is not None:
+        _server.close()
+        await _server.wait_closed()
+        _server = None
+
+
+def _duration(seconds: Optional[float]) -> str:
+    if seconds is None:
+        return "—"
+    return f"{seconds * 1000:.0f}ms" if seconds < 1 else f"{seconds:.2f}s"
+
+
+def _histogram_rows(histogram: metrics.Histogram, *label_names: str) -> List[str]:
+    rows = []
+    for key, series in sorted(histogram.items()):
+        labels = dict(key)
+        name = ".".join(labels.get(label, "") for label in label_names) or "all"
+        quantiles = " ".join(
+            f"p{int(q * 100)}={_duration(histogram.quantile(q, **labels))}" for q in QUANTILES
+        )
+        rows.append(f"{name}: n={series.count} {quantiles}")
+    return rows or ["—"]
+
+
+def _cache_rows() -> List[str]:
+    totals = defaultdict(lambda: {"hit": 0.0, "miss": 0.0})
+    for key, value in metrics.CACHE_REQUESTS.items():
+        labels = dict(key)
+        totals[labels.get("cache", "")][labels.get("result", "")] = value
+    rows = []
+    for cache, counts in sorted(totals.items()):
+        lookups = counts["hit"] + counts["miss"]
+        if lookups:
+            rows.append(f"{cache}: {counts['hit'] / lookups:.0%} hits of {lookups:.0f}")
+    return rows or ["—"]
+
+
+def report() -> str:
+    """Live latency summary for /perf (HTML, monospace)"""
+    metrics.collect()
+    sections = [
+        ("Handlers", _histogram_rows(HANDLER_TIME, "handler")),
+        ("Pipelines (wall)", _histogram_rows(PIPELINE_TIME, "handler")),
+        ("Dependencies", _histogram_rows(DEPENDENCY_TIME, "dependency", "operation")),
+        ("DB", _histogram_rows(DB_TIME, "statement")),
+        ("Event loop lag", _histogram_rows(LOOP_LAG)),
+        ("Queues", [
+            f"media: {media_queue.depth} waiting, {media_queue.running} running",
+            f"active chats: {ACTIVE_CHATS.value():.0f}",
+        ]),
+        ("Caches", _cache_rows()),
+    ]
+    text = "\n\n".join(f"{title}\n" + "\n".join(rows) for title, rows in sections)
+    if len(text) > MAX_REPORT_LENGTH:
+        text = text[:MAX_REPORT_LENGTH - 1] + "…"
+    return f"<pre>{html.escape(text)}</pre>"
@@ -0,0 +1,232 @@
+"""
+Database-backed persistence for python-telegram-bot (bot/chat/user data, conversations)
+
+Handlers keep in-progress state (drafts) in context.chat_data / user_data;
+the Application hands changed entries to this class every
+config.PERSISTENCE_FLUSH_INTERVAL seconds and on shutdown. Updates are
+buffered and written write-behind in one transaction per flush (off the
+event loop), so handling an update never waits for the state table.
+When that transaction fails the rows are written one by one: a row that
+keeps failing (MAX_WRITE_ATTEMPTS flushes) is dropped with an error, it
+doesn't hold back the others.
+
+Storage is the payme_bot_state table in config.BOT_STATE_DB_URL (the main
+MySQL database when empty). SQLite files are switched to WAL mode.
+"""
+import asyncio
+import json
+import logging
+from typing import Any, Dict, Optional, Tuple
+
+from sqlalchemy import create_engine, event, tuple_
+from sqlalchemy.orm import sessionmaker
+from telegram.ext import BasePersistence, PersistenceInput
+
+import metrics
+from config import config
+from database import BotState, widen_bot_state
+
+logger = logging.getLogger(__name__)
+
+FLUSH_TIME = metrics.histogram("payme_persistence_flush_seconds", "Time to write buffered bot state")
+FLUSH_ROWS = metrics.counter("payme_persistence_rows_total", "Bot state rows written or deleted")
+DROPPED_ROWS = metrics.counter("payme_persistence_dropped_total", "Bot state rows given up after repeated write failures")
+
+# Flushes a row may fail before its value is dropped
+MAX_WRITE_ATTEMPTS = 3
+
+BOT_KEY = ""
+CONVERSATION_PREFIX = "conv:"
+
+StateKey = Tuple[str, str]
+
+
+def _create_engine(database_url: str):
+    engine = create_engine(database_url, echo=False, pool_pre_ping=True)
+    if engine.dialect.name == "sqlite":
+        @event.listens_for(engine, "connect")
+        def _sqlite_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            cursor.execute("PRAGMA journal_mode=WAL")
+            cursor.execute("PRAGMA synchronous=NORMAL")
+            cursor.close()
+    BotState.__table__.create(engine, checkfirst=True)
+    widen_bot_state(engine)
+    return engine
+
+
+class DBPersistence(BasePersistence):
+    """BasePersistence storing JSON documents in payme_bot_state"""
+
+    def __init__(self, database_url: str, update_interval: float):
+        # Callback data stays in the buttons (see callback_router), nothing to store
+        super().__init__(
+            store_data=PersistenceInput(callback_data=False),
+            update_interval=update_interval,
+        )
+        self.database_url = database_url
+        self._session_factory = None
+        # Buffered writes: key -> JSON document, None deletes the row
+        self._dirty: Dict[StateKey, Optional[str]] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+        # Failed flushes per row, see _write_dirty
+        self._failures: Dict[StateKey, int] = {}
+
+    def _session(self):
+        if self._session_factory is None:
+            self._session_factory = sessionmaker(bind=_create_engine(self.database_url))
+        return self._session_factory()
+
+    # Loading (once, on startup)
+
+    def _load_kind(self, kind: str) -> Dict[str, Any]:
+        session = self._session()
+        try:
+            return {
+                row.key: json.loads(row.data) if row.data else None
+                for row in session.query(BotState).filter_by(kind=kind).all()
+            }
+        finally:
+            session.close()
+
+    async def _load(self, kind: str) -> Dict[str, Any]:
+        return await asyncio.to_thread(self._load_kind, kind)
+
+    async def get_user_data(self) -> Dict[int, Dict[Any, Any]]:
+        return {int(key): data or {} for key, data in (await self._load("user")).items()}
+
+    async def get_chat_data(self) -> Dict[int, Dict[Any, Any]]:
+        return {int(key): data or {} for key, data in (await self._load("chat")).items()}
+
+    async def get_bot_data(self) -> Dict[Any, Any]:
+        return (await self._load("bot")).get(BOT_KEY) or {}
+
+    async def get_callback_data(self) -> None:
+        return None
+
+    async def get_conversations(self, name: str) -> Dict[Tuple[Any, ...], object]:
+        rows = await self._load(CONVERSATION_PREFIX + name)
+        return {tuple(json.loads(key)): state for key, state in rows.items()}
+
+    # Write-behind updates
+
+    def _buffer(self, kind: str, key: Any, data: Any):
+        self._dirty[(kind, str(key))] = None if data is None else json.dumps(data, ensure_ascii=False)
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_soon())
+
+    async def _flush_soon(self):
+        # Let the Application hand over the rest of this round first
+        await asyncio.sleep(0)
+        await self._write_dirty()
+
+    async def _write_dirty(self):
+        retry: Dict[StateKey, Optional[str]] = {}
+        while self._dirty:
+            batch, self._dirty = self._dirty, {}
+            started = asyncio.get_running_loop().time()
+            try:
+                await asyncio.to_thread(self._write, batch)
+                errors = {}
+            except Exception as e:
+                logger.warning(f"[Persistence] Flush of {len(batch)} rows failed ({e}), writing them one by one")
+                errors = await asyncio.to_thread(self._write_each, batch)
+            FLUSH_TIME.observe(asyncio.get_running_loop().time() - started)
+            FLUSH_ROWS.inc(len(batch) - len(errors))
+
+            for state_key in batch.keys() - errors.keys():
+                self._failures.pop(state_key, None)
+            for state_key, error in errors.items():
+                attempts = self._failures.get(state_key, 0) + 1
+                if attempts < MAX_WRITE_ATTEMPTS:
+                    self._failures[state_key] = attempts
+                    retry[state_key] = batch[state_key]
+                    continue
+                self._failures.pop(state_key, None)
+                DROPPED_ROWS.inc(kind=state_key[0])
+                logger.error(
+                    f"[Persistence] Dropped {state_key[0]} {state_key[1]!r} after {attempts} failed writes: {error}"
+                )
+        # Retried on the next round, newer values buffered meanwhile win
+        self._dirty = {**retry, **self._dirty}
+
+    def _write(self, batch: Dict[StateKey, Optional[str]]):
+        session = self._session()
+        try:
+            session.query(BotState).filter(
+                tuple_(BotState.kind, BotState.key).in_(list(batch))
+            ).delete(synchronize_session=False)
+            session.add_all(
+                BotState(kind=kind, key=key, data=data)
+                for (kind, key), data in batch.items()
+                if data is not None
+            )
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    def _write_each(self, batch: Dict[StateKey, Optional[str]]) -> Dict[StateKey, str]:
+        """Write rows in separate transactions, returns the errors of those that failed"""
+        errors = {}
+        session = self._session()
+        try:
+            for (kind, key), data in batch.items():
+                try:
+                    session.query(BotState).filter_by(kind=kind, key=key).delete(synchronize_session=False)
+                    if data is not None:
+                        session.add(BotState(kind=kind, key=key, data=data))
+                    session.commit()
+                except Exception as e:
+                    session.rollback()
+                    errors[(kind, key)] = str(e)[:200]
+        finally:
+            session.close()
+        return errors
+
+    async def update_user_data(self, user_id: int, data: Dict[Any, Any]) -> None:
+        self._buffer("user", user_id, data)
+
+    async def update_chat_data(self, chat_id: int, data: Dict[Any, Any]) -> None:
+        self._buffer("chat", chat_id, data)
+
+    async def update_bot_data(self, data: Dict[Any, Any]) -> None:
+        self._buffer("bot", BOT_KEY, data)
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def update_conversation(self, name: str, key: Tuple[Any, ...], new_state: Optional[object]) -> None:
+        self._buffer(CONVERSATION_PREFIX + name, json.dumps(list(key)), new_state)
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        self._buffer("chat", chat_id, None)
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._buffer("user", user_id, None)
+
+    # This process is the only writer, in-memory data is always current
+
+    async def refresh_user_data(self, user_id: int, user_data: Dict[Any, Any]) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: Dict[Any, Any]) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: Dict[Any, Any]) -> None:
+        pass
+
+    async def flush(self) -> None:
+        """Called on shutdown: write everything still buffered"""
+        if self._flush_task is not None:
+            await self._flush_task
+        await self._write_dirty()
+
+
+def create_persistence() -> DBPersistence:
+    return DBPersistence(
+        database_url=config.BOT_STATE_DB_URL or config.DATABASE_URL,
+        update_interval=config.PERSISTENCE_FLUSH_INTERVAL,
+    )
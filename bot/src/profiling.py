@@ -0,0 +1,303 @@
+"""
+Opt-in profiling of handlers and event loop blocking
+
+Switched on with PROFILE_ENABLED or /profile on (admin), a share of handler
+runs (config.PROFILE_SAMPLE_PERCENT) is profiled, per handler:
+- stack mode (default): a thread samples the event loop thread every
+  config.PROFILE_INTERVAL seconds; samples taken while a profiled handler
+  runs are added to <PROFILE_DIR>/<handler>.folded (collapsed stacks, for
+  flamegraph.pl / speedscope). Work the handler continues in background
+  tasks (media queue jobs, see background()) counts for the handler too.
+  Only on-CPU time of the loop thread shows up:
+  awaited I/O is in the traces (tracing.py), asyncio.to_thread work is not
+  sampled
+- cprofile mode: the handler run under cProfile, dumped to
+  <PROFILE_DIR>/<handler>-<time>-<update_id>.prof (pstats / snakeviz), its
+  background tasks to <handler>.<name>-<time>-0.prof; the last
+  config.PROFILE_KEEP per name are kept. cProfile sees everything
+  the loop runs meanwhile, and only one run is profiled at a time
+
+Independently of the switch, a watchdog reports event loop blocking longer
+than config.LOOP_BLOCK_THRESHOLD: a heartbeat callback on the loop is
+checked from the sampler thread, which logs the running coroutine and the
+loop thread's stack while it is still blocked (payme_event_loop_blocks_total).
+"""
+import asyncio
+import cProfile
+import glob
+import html
+import inspect
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import traceback
+from collections import Counter, defaultdict, deque
+from contextvars import ContextVar
+from typing import Awaitable, Deque, Dict, Optional, TypeVar
+
+import metrics
+from config import config
+
+logger = logging.getLogger(__name__)
+
+LOOP_BLOCKS = metrics.counter("payme_event_loop_blocks_total", "Event loop blocked longer than LOOP_BLOCK_THRESHOLD")
+PROFILED = metrics.counter("payme_profiled_updates_total", "Handler runs profiled")
+
+MODES = ("stack", "cprofile")
+
+# How often collapsed stacks are rewritten on disk while they change
+FLUSH_INTERVAL = 10.0
+
+# Frames kept in a blocking report
+BLOCK_STACK_DEPTH = 30
+
+T = TypeVar("T")
+
+# Handler of the sampled run the current code belongs to; tasks started from it inherit it
+_sampled_handler: ContextVar[Optional[str]] = ContextVar("profiled_handler", default=None)
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})".replace(";", ",")
+
+
+def _running_coroutine(frame) -> Optional[str]:
+    """Coroutine the loop thread is in and the task it belongs to, from its sampled stack
+
+    Coroutine frames of the running task sit on top of the loop's own frames:
+    the innermost one is where the loop is stuck, the outermost the task.
+    """
+    names = []
+    while frame is not None:
+        if frame.f_code.co_flags & inspect.CO_COROUTINE:
+            names.append(f"{frame.f_code.co_qualname} ({os.path.basename(frame.f_code.co_filename)})")
+        frame = frame.f_back
+    if not names:
+        return None
+    return names[0] if len(names) == 1 else f"{names[0]} of task {names[-1]}"
+
+
+class Profiler:
+    """Handler sampling (stack / cProfile) and the event loop blocking watchdog"""
+
+    def __init__(self):
+        self.enabled = config.PROFILE_ENABLED
+        self.percent = config.PROFILE_SAMPLE_PERCENT
+        self.mode = config.PROFILE_MODE if config.PROFILE_MODE in MODES else "stack"
+        self.directory = config.PROFILE_DIR
+        self.interval = config.PROFILE_INTERVAL
+        self.block_threshold = config.LOOP_BLOCK_THRESHOLD
+
+        # Frame of a profiled run (see run()) -> handler name, read by the sampler thread
+        self._active: Dict[object, str] = {}
+        self._stacks: Dict[str, Counter] = defaultdict(Counter)
+        self._dirty = False
+        self._lock = threading.Lock()
+        self._cprofile_busy = False
+        self.profiled: Counter = Counter()
+        self.blocks: Deque[str] = deque(maxlen=5)
+
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread: Optional[int] = None
+        self._beat = 0.0
+        self._beat_handle: Optional[asyncio.TimerHandle] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stopping = threading.Event()
+
+    # Switching
+
+    def configure(self, enabled: bool, percent: float = None, mode: str = None):
+        """Runtime switch (/profile)"""
+        if percent is not None:
+            self.percent = max(0.0, min(100.0, percent))
+        if mode is not None:
+            if mode not in MODES:
+                raise ValueError(f"mode must be one of {', '.join(MODES)}")
+            self.mode = mode
+        self.enabled = enabled
+        logger.info(f"[Profiler] {'on' if enabled else 'off'}: {self.percent:g}% of updates, {self.mode} mode")
+
+    # Handler runs
+
+    async def run(self, handler: str, update: object, awaitable: Awaitable[T]) -> T:
+        """Await a handler coroutine, profiled if it is sampled"""
+        if not self.enabled or random.random() * 100 >= self.percent:
+            return await awaitable
+        PROFILED.inc(handler=handler, mode=self.mode)
+        self.profiled[handler] += 1
+        token = _sampled_handler.set(handler)
+        try:
+            if self.mode == "cprofile":
+                return await self._run_cprofile(handler, getattr(update, "update_id", None), awaitable)
+            return await self._run_sampled(handler, awaitable)
+        finally:
+            _sampled_handler.reset(token)
+
+    async def background(self, awaitable: Awaitable[T], name: str = "background") -> T:
+        """Await work a handler continues in a task, profiled if that handler run is"""
+        handler = _sampled_handler.get()
+        if handler is None or not self.enabled:
+            return await awaitable
+        if self.mode == "cprofile":
+            return await self._run_cprofile(f"{handler}.{name}", None, awaitable)
+        return await self._run_sampled(handler, awaitable)
+
+    async def _run_sampled(self, handler: str, awaitable: Awaitable[T]) -> T:
+        # This coroutine's frame sits between the loop and the handler on the stack
+        # whenever the handler runs: the sampler attributes samples by it
+        frame = sys._getframe()
+        self._active[frame] = handler
+        try:
+            return await awaitable
+        finally:
+            self._active.pop(frame, None)
+
+    async def _run_cprofile(self, handler: str, update_id: Optional[int], awaitable: Awaitable[T]) -> T:
+        if self._cprofile_busy:
+            # The thread can only have one active profiler
+            return await awaitable
+        self._cprofile_busy = True
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            return await awaitable
+        finally:
+            profile.disable()
+            self._cprofile_busy = False
+            await asyncio.to_thread(self._dump_cprofile, profile, handler, update_id)
+
+    def _dump_cprofile(self, profile: cProfile.Profile, handler: str, update_id: Optional[int]):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            stamp = time.strftime("%Y%m%d-%H%M%S")
+            profile.dump_stats(os.path.join(self.directory, f"{handler}-{stamp}-{update_id or 0}.prof"))
+            dumps = sorted(glob.glob(os.path.join(glob.escape(self.directory), f"{handler}-*.prof")), key=os.path.getmtime)
+            for path in dumps[:-config.PROFILE_KEEP] if config.PROFILE_KEEP > 0 else []:
+                os.remove(path)
+        except OSError as e:
+            logger.warning(f"[Profiler] Could not write profile of {handler}: {e}")
+
+    # Sampler thread
+
+    def _sample(self, frames: dict):
+        frame = frames.get(self._loop_thread)
+        stack = []
+        while frame is not None:
+            handler = self._active.get(frame)
+            if handler is not None:
+                stack.reverse()
+                with self._lock:
+                    self._stacks[handler][";".join([handler] + stack)] += 1
+                    self._dirty = True
+                return
+            stack.append(_frame_label(frame))
+            frame = frame.f_back
+
+    def _check_blocking(self, frames: dict, reported: float) -> float:
+        """Report a blocked loop once per heartbeat, returns the heartbeat reported last"""
+        beat = self._beat
+        blocked = time.monotonic() - beat
+        if beat == reported or blocked < self.block_threshold:
+            return reported
+        frame = frames.get(self._loop_thread)
+        stack = "".join(traceback.format_stack(frame, limit=BLOCK_STACK_DEPTH)) if frame is not None else ""
+        coroutine = _running_coroutine(frame) or "a callback (no task)"
+        LOOP_BLOCKS.inc()
+        self.blocks.append(f"{time.strftime('%H:%M:%S')} over {blocked:.2f}s in {coroutine}")
+        logger.warning(
+            f"[Profiler] Event loop blocked for over {blocked:.2f}s in {coroutine}",
+            extra={"duration": round(blocked, 3), "coroutine": coroutine, "stack": stack},
+        )
+        return beat
+
+    def _sampler_loop(self):
+        reported = 0.0
+        flushed = time.monotonic()
+        while not self._stopping.is_set():
+            sampling = bool(self._active)
+            if sampling or self.block_threshold > 0:
+                frames = sys._current_frames()
+                if sampling:
+                    self._sample(frames)
+                if self.block_threshold > 0:
+                    reported = self._check_blocking(frames, reported)
+                del frames
+            if self._dirty and time.monotonic() - flushed > FLUSH_INTERVAL:
+                self.flush()
+                flushed = time.monotonic()
+            self._stopping.wait(self.interval if sampling else self._watch_interval)
+
+    @property
+    def _watch_interval(self) -> float:
+        return self.block_threshold / 4 if self.block_threshold > 0 else 0.1
+
+    def flush(self):
+        """Rewrite <handler>.folded files with the stacks counted so far"""
+        with self._lock:
+            if not self._dirty:
+                return
+            stacks = {handler: dict(counts) for handler, counts in self._stacks.items()}
+            self._dirty = False
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            for handler, counts in stacks.items():
+                path = os.path.join(self.directory, f"{handler}.folded")
+                with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+                    f.writelines(f"{stack} {count}\n" for stack, count in counts.items())
+                os.replace(f"{path}.tmp", path)
+        except OSError as e:
+            logger.warning(f"[Profiler] Could not write stacks: {e}")
+
+    # Lifecycle
+
+    def _heartbeat(self):
+        self._beat = time.monotonic()
+        self._beat_handle = self._loop.call_later(self._watch_interval, self._heartbeat)
+
+    def start(self):
+        """Start the heartbeat and the sampler thread (call on the event loop)"""
+        if self._thread is not None:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self._heartbeat()
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._sampler_loop, name="profiler", daemon=True)
+        self._thread.start()
+
+    async def stop(self):
+        if self._thread is None:
+            return
+        self._stopping.set()
+        if self._beat_handle is not None:
+            self._beat_handle.cancel()
+        await asyncio.to_thread(self._thread.join)
+        self._thread = None
+        self.flush()
+
+    def status(self) -> str:
+        """State for /profile (HTML, monospace)"""
+        with self._lock:
+            samples = {handler: sum(counts.values()) for handler, counts in self._stacks.items()}
+        lines = [
+            f"profiling: {'on' if self.enabled else 'off'}, {self.percent:g}% of updates, {self.mode} mode",
+            f"directory: {self.directory}",
+            "",
+            "Profiled runs",
+        ]
+        lines += [
+            f"{handler}: {count}" + (f", {samples[handler]} samples" if handler in samples else "")
+            for handler, count in self.profiled.most_common()
+        ] or ["—"]
+        threshold = f"over {self.block_threshold:g}s" if self.block_threshold > 0 else "off"
+        lines += ["", f"Event loop blocks ({threshold})"]
+        lines += list(self.blocks) or ["—"]
+        text = "\n".join(lines)
+        return f"<pre>{html.escape(text)}</pre>"
+
+
+profiler = Profiler()
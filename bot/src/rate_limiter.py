@@ -0,0 +1,194 @@
+"""
+Outbound rate limiting for Telegram Bot API calls
+
+Plugged into the Application as its rate limiter, so every bot call made by
+any handler goes through it:
+- global token bucket (config.TELEGRAM_GLOBAL_RATE requests/s)
+- per-chat token buckets (private chats and groups have different limits)
+- 429 RetryAfter: the chat (or everything, for chat-less calls) is paused
+  for retry_after and the request is retried up to config.TELEGRAM_MAX_RETRIES
+- editMessageText calls waiting for a token are coalesced: when a newer edit
+  of the same message is queued, the older one is dropped (returns True)
+Calls without chat_id (answerCallbackQuery, getFile, ...) are not throttled.
+"""
+import asyncio
+import logging
+import time
+from typing import Any, Callable, Coroutine, Dict, Optional, Tuple, Union
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+import metrics
+import tracing
+from config import config
+
+logger = logging.getLogger(__name__)
+
+REQUESTS = metrics.counter("payme_telegram_requests_total", "Outbound Bot API requests")
+THROTTLE_WAIT = metrics.histogram(
+    "payme_telegram_throttle_seconds",
+    "Time an outbound request waited for the rate limiter",
+)
+RETRY_AFTER = metrics.counter("payme_telegram_retry_after_total", "429 RetryAfter responses from Telegram")
+EDITS_COALESCED = metrics.counter(
+    "payme_telegram_edits_coalesced_total",
+    "editMessageText calls dropped because a newer edit of the same message was queued",
+)
+
+COALESCED_ENDPOINTS = {"editMessageText", "editMessageReplyMarkup"}
+
+# Idle per-chat buckets are dropped once there are more than this many
+MAX_IDLE_BUCKETS = 1000
+
+
+class TokenBucket:
+    """
+    Token bucket with reservations: each request takes a token now and
+    waits until the bucket would have had it (no lock needed in asyncio)
+    """
+    __slots__ = ("rate", "capacity", "_tokens", "_updated")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+
+    def _refill(self, now: float):
+        if now > self._updated:
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+
+    def reserve(self) -> float:
+        """Take a token, returns seconds to wait before using it"""
+        now = time.monotonic()
+        self._refill(now)
+        self._tokens -= 1
+        return max(0.0, self._updated - now) + max(0.0, -self._tokens) / self.rate
+
+    def refund(self):
+        self._tokens = min(self.capacity, self._tokens + 1)
+
+    def pause(self, seconds: float):
+        """No tokens until seconds from now (flood control)"""
+        now = time.monotonic()
+        self._refill(now)
+        self._tokens = min(self._tokens, 0)
+        self._updated = max(self._updated, now + seconds)
+
+    def is_idle(self) -> bool:
+        now = time.monotonic()
+        self._refill(now)
+        return self._tokens >= self.capacity
+
+
+class TelegramRateLimiter(BaseRateLimiter[None]):
+    """Global + per-chat throttling with RetryAfter handling and edit coalescing"""
+
+    def __init__(
+        self,
+        global_rate: float,
+        chat_rate: float,
+        chat_burst: int,
+        group_rate: float,
+        max_retries: int,
+    ):
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats: Dict[Union[int, str], TokenBucket] = {}
+        # (chat_id, message_id) -> sequence number of the newest queued edit
+        self._latest_edit: Dict[Tuple[Any, Any], int] = {}
+        self._edit_seq = 0
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        self._chats.clear()
+        self._latest_edit.clear()
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= MAX_IDLE_BUCKETS:
+                self._chats = {k: b for k, b in self._chats.items() if not b.is_idle()}
+            # Negative ids (and @channel usernames) are groups/channels
+            is_group = isinstance(chat_id, str) or int(chat_id) < 0
+            rate = self.group_rate if is_group else self.chat_rate
+            bucket = self._chats[chat_id] = TokenBucket(rate, self.chat_burst)
+        return bucket
+
+    async def _throttle(self, chat_id) -> Optional[TokenBucket]:
+        """Wait for global and chat tokens, returns the chat bucket"""
+        chat = self._chat_bucket(chat_id)
+        wait = max(self._global.reserve(), chat.reserve())
+        if wait > 0:
+            THROTTLE_WAIT.observe(wait, scope="group" if chat.rate == self.group_rate else "chat")
+            await asyncio.sleep(wait)
+        return chat
+
+    async def process_request(
+        self,
+        callback: Callable[..., Coroutine[Any, Any, Union[bool, Dict[str, Any], list]]],
+        args: Any,
+        kwargs: Dict[str, Any],
+        endpoint: str,
+        data: Dict[str, Any],
+        rate_limit_args: Optional[object],
+    ) -> Union[bool, Dict[str, Any], list]:
+        chat_id = data.get("chat_id")
+        REQUESTS.inc(endpoint=endpoint)
+
+        edit_key = None
+        if endpoint in COALESCED_ENDPOINTS and chat_id is not None and data.get("message_id") is not None:
+            edit_key = (chat_id, data["message_id"])
+            self._edit_seq += 1
+            seq = self._latest_edit[edit_key] = self._edit_seq
+
+        try:
+            for attempt in range(self.max_retries + 1):
+                chat = await self._throttle(chat_id) if chat_id is not None else None
+
+                if edit_key and self._latest_edit.get(edit_key) != seq:
+                    # A newer edit of this message is queued, it will overwrite this one anyway
+                    chat.refund()
+                    self._global.refund()
+                    EDITS_COALESCED.inc()
+                    return True
+
+                try:
+                    with tracing.span(f"telegram.{endpoint}", attempt=attempt):
+                        return await callback(*args, **kwargs)
+                except RetryAfter as e:
+                    retry_after = float(e.retry_after)
+                    RETRY_AFTER.inc(endpoint=endpoint)
+                    if attempt >= self.max_retries:
+                        raise
+                    logger.warning(
+                        f"[RateLimit] {endpoint} to chat {chat_id}: flood control, "
+                        f"retry {attempt + 1}/{self.max_retries} in {retry_after}s"
+                    )
+                    if chat is not None:
+                        chat.pause(retry_after)
+                    else:
+                        self._global.pause(retry_after)
+                        await asyncio.sleep(retry_after)
+        finally:
+            if edit_key and self._latest_edit.get(edit_key) == seq:
+                del self._latest_edit[edit_key]
+
+
+def create_rate_limiter() -> TelegramRateLimiter:
+    return TelegramRateLimiter(
+        global_rate=config.TELEGRAM_GLOBAL_RATE,
+        chat_rate=config.TELEGRAM_CHAT_RATE,
+        chat_burst=config.TELEGRAM_CHAT_BURST,
+        group_rate=config.TELEGRAM_GROUP_RATE_PER_MINUTE / 60,
+        max_retries=config.TELEGRAM_MAX_RETRIES,
+    )
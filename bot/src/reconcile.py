@@ -0,0 +1,181 @@
+"""
+Reconciliation of Dropbox links for confirmed expenses
+
+A failed upload only logs a warning when the expense is saved, leaving a
+CONFIRMED expense with a file_path and no dropbox_url. The reconciler walks
+those rows in id order (keyset pagination, config.RECONCILE_BATCH_SIZE per
+batch), uploads their files through dropbox_service.upload_batch
+(config.DROPBOX_CONCURRENCY at a time), stores the links with one UPDATE per
+batch and reports progress after each batch.
+
+It runs every config.RECONCILE_INTERVAL seconds in the bot, on /reconcile
+(admin), or from the command line:
+
+    python src/reconcile.py
+"""
+import asyncio
+import logging
+import os
+import sys
+from typing import Awaitable, Callable, Optional
+
+from sqlalchemy import update
+
+import metrics
+from catalog import get_catalog
+from config import config
+from database import Expense, ExpenseStatus
+from dropbox_service import BatchFile, dropbox_file_hash, get_access_token, upload_batch
+
+logger = logging.getLogger(__name__)
+
+RECONCILED = metrics.counter("payme_reconcile_expenses_total", "Expenses without Dropbox link handled by reconciliation")
+
+
+class ReconcileProgress:
+    """Counters of one reconciliation run"""
+
+    def __init__(self):
+        self.scanned = 0
+        self.uploaded = 0
+        self.failed = 0
+        self.missing = 0  # Local file is gone, nothing to upload
+        self.last_id = 0
+
+    def __str__(self):
+        return (
+            f"checked {self.scanned}, uploaded {self.uploaded}, failed {self.failed}, "
+            f"file missing {self.missing} (up to expense {self.last_id})"
+        )
+
+
+class DropboxReconciler:
+    """Uploads files of confirmed expenses that have no Dropbox link, one run at a time"""
+
+    def __init__(self, batch_size: int, interval: float):
+        self.batch_size = batch_size
+        self.interval = interval
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def running(self) -> bool:
+        return self._lock.locked()
+
+    async def _reconcile_batch(self, session, catalog, expenses, progress: ReconcileProgress):
+        present = [e for e in expenses if os.path.exists(e.file_path)]
+        progress.missing += len(expenses) - len(present)
+
+        hashes = {e.id: e.dropbox_hash for e in present if e.dropbox_hash}
+        unhashed = [e for e in present if not e.dropbox_hash]
+        for expense, dropbox_hash in zip(
+            unhashed, await asyncio.gather(*(dropbox_file_hash(e.file_path) for e in unhashed))
+        ):
+            hashes[expense.id] = dropbox_hash
+        files = []
+        for expense in present:
+            category = catalog.category(expense.category_id)
+            files.append(BatchFile(
+                expense.id, expense.file_path, category.code if category else "UNCATEGORIZED", hashes[expense.id]
+            ))
+        urls = await upload_batch(files, session)
+
+        if urls:
+            session.execute(update(Expense), [
+                {"id": expense_id, "dropbox_url": url, "dropbox_hash": hashes[expense_id]}
+                for expense_id, url in urls.items()
+            ])
+        session.commit()
+
+        progress.uploaded += len(urls)
+        progress.failed += len(present) - len(urls)
+        RECONCILED.inc(len(urls), outcome="uploaded")
+        RECONCILED.inc(len(present) - len(urls), outcome="failed")
+        RECONCILED.inc(len(expenses) - len(present), outcome="missing")
+
+    async def run(
+        self,
+        session_factory: Callable,
+        on_progress: Callable[[ReconcileProgress], Awaitable[None]] = None,
+    ) -> Optional[ReconcileProgress]:
+        """
+        One pass over all confirmed expenses without a link.
+        None if Dropbox isn't available (no valid token) or a run is already in progress
+        """
+        if self.running:
+            return None
+        async with self._lock:
+            if not await get_access_token():
+                logger.warning("[Reconcile] Dropbox is not available, skipped")
+                return None
+
+            progress = ReconcileProgress()
+            session = session_factory()
+            try:
+                catalog = get_catalog(session)
+                while True:
+                    # Keyset pagination: failed rows stay behind last_id, the pass always ends
+                    expenses = session.query(Expense).filter(
+                        Expense.id > progress.last_id,
+                        Expense.status == ExpenseStatus.CONFIRMED,
+                        Expense.file_path.isnot(None),
+                        Expense.dropbox_url.is_(None),
+                    ).order_by(Expense.id).limit(self.batch_size).all()
+                    if not expenses:
+                        break
+                    progress.last_id = expenses[-1].id
+                    progress.scanned += len(expenses)
+
+                    await self._reconcile_batch(session, catalog, expenses, progress)
+                    session.expunge_all()
+                    logger.info(f"[Reconcile] {progress}")
+                    if on_progress is not None:
+                        await on_progress(progress)
+            finally:
+                session.close()
+            return progress
+
+    async def _loop(self, session_factory: Callable):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.run(session_factory)
+            except Exception as e:
+                logger.error(f"[Reconcile] Run failed: {e}", exc_info=True)
+
+    def start(self, session_factory: Callable):
+        """Run periodically in the background (disabled with RECONCILE_INTERVAL=0)"""
+        if self.interval > 0 and self._task is None:
+            self._task = asyncio.create_task(self._loop(session_factory))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+reconciler = DropboxReconciler(config.RECONCILE_BATCH_SIZE, config.RECONCILE_INTERVAL)
+
+
+def main():
+    from sqlalchemy.orm import sessionmaker
+    from database import init_db
+
+    import logging_setup
+
+    logging_setup.setup(log_format="text")
+    session_factory = sessionmaker(bind=init_db(config.DATABASE_URL))
+    progress = asyncio.run(reconciler.run(session_factory))
+    if progress is None:
+        print("Dropbox is not available")
+        return 1
+    print(f"Done: {progress}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,68 @@
+"""
+Per-user frequent choices for one-tap shortcuts
+
+Most users repeat the same few subcategories (a driver logs fuel all day).
+Every confirmation bumps an exponentially decaying score of its
+(subcategory, payment type) pair, so recent habits outweigh old ones. The
+scores live in user_data: in memory, persisted write-behind with the rest of
+the bot state (see persistence.py). The top pairs become a row of shortcut
+buttons that set category, subcategory and payment type in one tap.
+"""
+import time
+from typing import List, MutableMapping, Optional, Tuple
+
+from config import config
+from database import PaymentType
+
+FREQUENT_CHOICES = "frequent_choices"
+
+# Scores kept per user, the weakest ones are dropped beyond this
+MAX_CHOICES = 20
+
+# Payment type in shortcut callback data (0 = keep the expense's own)
+PAYMENT_CODES = {PaymentType.CASH: 1, PaymentType.BANK: 2}
+PAYMENT_BY_CODE = {code: payment_type for payment_type, code in PAYMENT_CODES.items()}
+
+
+def _key(subcategory_id: int, payment_type: Optional[PaymentType]) -> str:
+    return f"{subcategory_id}:{PAYMENT_CODES.get(payment_type, 0)}"
+
+
+def _decayed(score: float, updated: float, now: float) -> float:
+    half_life = config.FREQUENT_HALF_LIFE_DAYS * 86400
+    return score * 0.5 ** (max(0.0, now - updated) / half_life)
+
+
+def record_choice(user_data: MutableMapping, subcategory_id: int, payment_type: Optional[PaymentType],
+                  now: float = None):
+    """Count a confirmed (subcategory, payment type) pair"""
+    now = now or time.time()
+    choices = user_data.setdefault(FREQUENT_CHOICES, {})
+    key = _key(subcategory_id, payment_type)
+    score, updated = choices.get(key, (0.0, now))
+    choices[key] = [_decayed(score, updated, now) + 1.0, now]
+
+    if len(choices) > MAX_CHOICES:
+        weakest = min(choices, key=lambda k: _decayed(*choices[k], now))
+        del choices[weakest]
+
+
+def top_choices(user_data: MutableMapping, limit: int, payment_type: Optional[PaymentType] = None,
+                now: float = None) -> List[Tuple[int, Optional[PaymentType]]]:
+    """
+    Most frequent recent (subcategory id, payment type) pairs with a score of at
+    least config.FREQUENT_MIN_SCORE; payment_type restricts them to that type
+    """
+    now = now or time.time()
+    scored = []
+    # list() copies in one step: media drafts read this from a worker thread
+    for key, (score, updated) in list(user_data.get(FREQUENT_CHOICES, {}).items()):
+        subcategory_id, code = (int(part) for part in key.split(":"))
+        choice_payment = PAYMENT_BY_CODE.get(code)
+        if payment_type is not None and choice_payment != payment_type:
+            continue
+        score = _decayed(score, updated, now)
+        if score >= config.FREQUENT_MIN_SCORE:
+            scored.append((score, subcategory_id, choice_payment))
+    scored.sort(key=lambda item: item[0], reverse=True)
+    return [(subcategory_id, choice_payment) for _, subcategory_id, choice_payment in scored[:limit]]
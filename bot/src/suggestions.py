@@ -0,0 +1,183 @@
+"""
+Subcategory suggestions learned from confirmed expenses
+
+A multinomial naive Bayes model over the words of an expense's text,
+labelled with its subcategory (which implies the category). The model lives
+in memory: it is trained from the confirmed rows at startup (load(), in a
+thread; until it is ready there are no suggestions) and then
+updated with every confirmation, no retraining pass needed. When it is sure
+enough (config.SUGGESTION_MIN_PROBABILITY) the suggested subcategory is
+offered as a one-tap button above the category keyboard.
+"""
+import asyncio
+import logging
+import math
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+import metrics
+from config import config
+from database import Expense, ExpenseStatus
+
+logger = logging.getLogger(__name__)
+
+SUGGESTIONS = metrics.counter("payme_suggestions_total", "Subcategory suggestions shown")
+OUTCOMES = metrics.counter(
+    "payme_suggestion_outcomes_total",
+    "Model prediction for confirmed expenses, checked before learning from them (hit/miss/none)",
+)
+INFERENCE_TIME = metrics.histogram(
+    "payme_suggestion_seconds",
+    "Time to compute a subcategory suggestion",
+    buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.05),
+)
+
+# Letters only: amounts and dates say nothing about the category
+WORD_RE = re.compile(r"[^\W\d_]{2,}")
+# Word prefixes are a cheap stemmer for Russian endings (бензин / бензина / бензином)
+PREFIX_LENGTH = 6
+
+
+def tokenize(text: str) -> List[str]:
+    return [word[:PREFIX_LENGTH] for word in WORD_RE.findall(text.lower())]
+
+
+def expense_text(expense) -> str:
+    """
+    Text the model sees for an expense (or a row with the same columns). The
+    description comes first: the message text of a multi-expense input is
+    shared by all its expenses, so it is only used without a description
+    """
+    return expense.description or expense.original_text or expense.transcription or ""
+
+
+@dataclass(frozen=True)
+class Suggestion:
+    subcategory_id: int
+    probability: float
+
+
+class CategorySuggester:
+    """Incrementally trained multinomial naive Bayes (Laplace smoothing)"""
+
+    def __init__(self, alpha: float = 1.0):
+        self.alpha = alpha
+        self.examples = 0
+        self._label_counts: Counter = Counter()
+        self._token_counts: Dict[int, Counter] = defaultdict(Counter)
+        self._token_totals: Counter = Counter()
+        self._vocabulary: set = set()
+        # Suggestions are also computed in worker threads (media drafts)
+        self._lock = threading.Lock()
+
+    def learn(self, text: str, subcategory_id: int):
+        tokens = tokenize(text)
+        if not tokens:
+            return
+        with self._lock:
+            self.examples += 1
+            self._label_counts[subcategory_id] += 1
+            self._token_counts[subcategory_id].update(tokens)
+            self._token_totals[subcategory_id] += len(tokens)
+            self._vocabulary.update(tokens)
+
+    def suggest(self, text: str) -> Optional[Suggestion]:
+        """Most likely subcategory with its posterior probability, None without known words"""
+        with self._lock:
+            tokens = [t for t in tokenize(text) if t in self._vocabulary]
+            if not tokens:
+                return None
+
+            vocabulary_size = len(self._vocabulary)
+            scores = {}
+            for label, count in self._label_counts.items():
+                counts = self._token_counts[label]
+                denominator = math.log(self._token_totals[label] + self.alpha * vocabulary_size)
+                score = math.log(count / self.examples)
+                for token in tokens:
+                    score += math.log(counts.get(token, 0) + self.alpha) - denominator
+                scores[label] = score
+
+        best = max(scores, key=scores.get)
+        top = scores[best]
+        return Suggestion(best, 1.0 / sum(math.exp(score - top) for score in scores.values()))
+
+
+def train(rows: Iterable) -> CategorySuggester:
+    """Model from rows with description, original_text, transcription and subcategory_id"""
+    suggester = CategorySuggester()
+    for row in rows:
+        suggester.learn(expense_text(row), row.subcategory_id)
+    return suggester
+
+
+_suggester: Optional[CategorySuggester] = None
+# Confirmations seen while the model is being trained, learned once it is ready
+_pending: List[Tuple[str, int]] = []
+
+
+def _train_from_db(session_factory: Callable) -> CategorySuggester:
+    session = session_factory()
+    try:
+        rows = session.query(
+            Expense.description, Expense.original_text, Expense.transcription, Expense.subcategory_id
+        ).filter(
+            Expense.status == ExpenseStatus.CONFIRMED,
+            Expense.subcategory_id.isnot(None),
+        ).order_by(Expense.id.desc()).limit(config.SUGGESTION_TRAINING_ROWS)
+        return train(rows)
+    finally:
+        session.close()
+
+
+async def load(session_factory: Callable):
+    """Train the shared model from the latest confirmed expenses (in a thread)"""
+    global _suggester
+    started = time.monotonic()
+    suggester = await asyncio.to_thread(_train_from_db, session_factory)
+    for text, subcategory_id in _pending:
+        suggester.learn(text, subcategory_id)
+    _pending.clear()
+    _suggester = suggester
+    logger.info(f"[Suggest] Trained on {suggester.examples} expenses in {time.monotonic() - started:.2f}s")
+
+
+def suggest_subcategory(catalog, expense: Expense):
+    """Suggested active subcategory (catalog entry) for an expense, None if the model isn't sure or ready"""
+    text = expense_text(expense)
+    suggester = _suggester
+    if not text or suggester is None or suggester.examples < config.SUGGESTION_MIN_EXAMPLES:
+        return None
+
+    started = time.perf_counter()
+    suggestion = suggester.suggest(text)
+    INFERENCE_TIME.observe(time.perf_counter() - started)
+    if suggestion is None or suggestion.probability < config.SUGGESTION_MIN_PROBABILITY:
+        return None
+
+    subcategory = catalog.subcategory(suggestion.subcategory_id)
+    if subcategory:
+        SUGGESTIONS.inc()
+    return subcategory
+
+
+def learn(examples: Iterable[Tuple[str, int]]):
+    """Update the model with (expense_text, subcategory_id) of confirmed expenses"""
+    suggester = _suggester
+    for text, subcategory_id in examples:
+        if not text or not subcategory_id:
+            continue
+        if suggester is None:
+            _pending.append((text, subcategory_id))
+            continue
+        # Online accuracy: what the model would have said before seeing this one
+        suggestion = suggester.suggest(text)
+        if suggestion is None:
+            OUTCOMES.inc(outcome="none")
+        else:
+            OUTCOMES.inc(outcome="hit" if suggestion.subcategory_id == subcategory_id else "miss")
+        suggester.learn(text, subcategory_id)
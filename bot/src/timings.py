@@ -0,0 +1,53 @@
+"""
+Per-step timings of a handler run
+
+Steps may overlap (asyncio.gather), so the log line shows both the sum of
+step times and the wall time: the difference is what running independent
+steps concurrently saved on the critical path. Each step is also a span of
+the update's trace (see tracing.py).
+"""
+import logging
+import time
+from typing import Awaitable, Dict, TypeVar
+
+import metrics
+import tracing
+
+logger = logging.getLogger(__name__)
+
+STEP_TIME = metrics.histogram("payme_handler_step_seconds", "Duration of handler steps")
+PIPELINE_TIME = metrics.histogram(
+    "payme_pipeline_seconds", "Wall time of a whole handler run, including work continued in the background"
+)
+
+T = TypeVar("T")
+
+
+class StepTimer:
+    """Collects step durations of one handler run and logs them as one line"""
+
+    def __init__(self, handler: str):
+        self.handler = handler
+        self.started = time.monotonic()
+        self.steps: Dict[str, float] = {}
+
+    async def run(self, step: str, awaitable: Awaitable[T]) -> T:
+        started = time.monotonic()
+        try:
+            with tracing.span(f"{self.handler}.{step}"):
+                return await awaitable
+        finally:
+            elapsed = time.monotonic() - started
+            self.steps[step] = self.steps.get(step, 0.0) + elapsed
+            STEP_TIME.observe(elapsed, handler=self.handler, step=step)
+
+    def log(self):
+        wall = time.monotonic() - self.started
+        PIPELINE_TIME.observe(wall, handler=self.handler)
+        parts = " ".join(f"{step}={elapsed:.2f}s" for step, elapsed in self.steps.items())
+        logger.info(
+            f"[Steps] {self.handler}: {parts} | sum={sum(self.steps.values()):.2f}s wall={wall:.2f}s",
+            extra={"stage": self.handler, "duration": round(wall, 3), "steps": {
+                step: round(elapsed, 3) for step, elapsed in self.steps.items()
+            }},
+        )
@@ -0,0 +1,266 @@
+"""
+Lightweight tracing of update processing
+
+Every update gets a trace (opened in concurrency.py around its handlers);
+pipeline stages open spans inside it: handler steps (timings.StepTimer),
+media queue wait and jobs, Telegram downloads, Whisper, GPT extraction,
+database statements and Dropbox calls. Spans carry the update id and the
+user, so one slow reply can be followed stage by stage.
+
+The current span lives in a ContextVar, so it follows asyncio tasks and
+asyncio.to_thread calls started from inside a span. Finished spans go to:
+- an in-memory ring buffer (config.TRACE_BUFFER_SIZE), see recent_spans()
+- a JSON lines file when config.TRACE_FILE is set (written by a background
+  thread, never on the event loop)
+- OpenTelemetry when config.TRACE_OTEL is on and the opentelemetry package
+  is installed; exporters are set up the OpenTelemetry way (SDK / env vars)
+Spans of external calls (openai.*, dropbox.*, telegram.*, pdf.*) and SQL
+statement times also feed the latency histograms in metrics.py.
+"""
+import functools
+import json
+import logging
+import os
+import queue
+import secrets
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Deque, Dict, Iterator, List, Optional
+
+import metrics
+from config import config
+
+logger = logging.getLogger(__name__)
+
+_current: ContextVar[Optional["Span"]] = ContextVar("trace_span", default=None)
+
+_recent: Deque[dict] = deque(maxlen=config.TRACE_BUFFER_SIZE)
+
+DEPENDENCY_TIME = metrics.histogram(
+    "payme_dependency_seconds", "Duration of calls to external services (OpenAI, Dropbox, Telegram, PDF parsing)"
+)
+DEPENDENCY_ERRORS = metrics.counter("payme_dependency_errors_total", "Calls to external services that raised")
+DB_TIME = metrics.histogram("payme_db_query_seconds", "Duration of SQL statements")
+
+# Span name prefixes (before the first dot) that are external calls
+DEPENDENCIES = {"openai", "dropbox", "telegram", "pdf"}
+
+_otel_tracer = None
+if config.TRACE_OTEL:
+    try:
+        from opentelemetry import trace as otel_trace
+        _otel_tracer = otel_trace.get_tracer("payme.bot")
+    except ImportError:
+        logger.warning("TRACE_OTEL is set but opentelemetry is not installed, spans stay local")
+
+
+class Span:
+    """One timed stage; children inherit trace id, update id and user"""
+    __slots__ = (
+        "trace_id", "span_id", "parent_id", "name", "update_id", "user_id",
+        "attributes", "started", "duration", "error", "_otel",
+    )
+
+    def __init__(self, name: str, parent: Optional["Span"], attributes: Dict[str, Any], started: float = None):
+        self.name = name
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent.span_id if parent else None
+        self.trace_id = parent.trace_id if parent else secrets.token_hex(16)
+        self.update_id = attributes.pop("update_id", None) or (parent.update_id if parent else None)
+        self.user_id = attributes.pop("user_id", None) or (parent.user_id if parent else None)
+        self.attributes = attributes
+        self.started = started or time.time()
+        self.duration: Optional[float] = None
+        self.error: Optional[str] = None
+        self._otel = None
+        if _otel_tracer is not None:
+            context = otel_trace.set_span_in_context(parent._otel) if parent and parent._otel else None
+            self._otel = _otel_tracer.start_span(
+                name, context=context, start_time=int(self.started * 1e9), attributes=self._otel_attributes()
+            )
+
+    def _otel_attributes(self) -> Dict[str, Any]:
+        attributes = {k: v for k, v in self.attributes.items() if isinstance(v, (str, bool, int, float))}
+        if self.update_id is not None:
+            attributes["telegram.update_id"] = self.update_id
+        if self.user_id is not None:
+            attributes["telegram.user_id"] = self.user_id
+        return attributes
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+        if self._otel is not None:
+            self._otel.set_attributes({k: v for k, v in attributes.items() if isinstance(v, (str, bool, int, float))})
+
+    def finish(self, error: BaseException = None, ended: float = None):
+        if self.duration is not None:
+            return
+        ended = ended or time.time()
+        self.duration = ended - self.started
+        if error is not None:
+            self.error = f"{type(error).__name__}: {error}"[:200]
+        if self._otel is not None:
+            if error is not None:
+                self._otel.record_exception(error)
+                self._otel.set_status(otel_trace.Status(otel_trace.StatusCode.ERROR))
+            self._otel.end(end_time=int(ended * 1e9))
+        _export(self)
+
+    def to_dict(self) -> dict:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "update_id": self.update_id,
+            "user_id": self.user_id,
+            "start": round(self.started, 6),
+            "duration": round(self.duration or 0.0, 6),
+            "error": self.error,
+            "attributes": self.attributes,
+        }
+
+
+class _FileExporter:
+    """Appends spans as JSON lines from a daemon thread"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._queue: "queue.SimpleQueue[dict]" = queue.SimpleQueue()
+        threading.Thread(target=self._write_loop, name="trace-exporter", daemon=True).start()
+
+    def export(self, span: dict):
+        self._queue.put(span)
+
+    def _write_loop(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.path, "a", encoding="utf-8") as f:
+            while True:
+                f.write(json.dumps(self._queue.get(), ensure_ascii=False, default=str) + "\n")
+                # Write everything queued meanwhile before flushing
+                while not self._queue.empty():
+                    f.write(json.dumps(self._queue.get(), ensure_ascii=False, default=str) + "\n")
+                f.flush()
+
+
+_file_exporter = _FileExporter(config.TRACE_FILE) if config.TRACE_FILE else None
+
+
+def _export(span: Span):
+    dependency, _, operation = span.name.partition(".")
+    if dependency in DEPENDENCIES:
+        DEPENDENCY_TIME.observe(span.duration, dependency=dependency, operation=operation)
+        if span.error:
+            DEPENDENCY_ERRORS.inc(dependency=dependency, operation=operation)
+
+    data = span.to_dict()
+    _recent.append(data)
+    if _file_exporter is not None:
+        _file_exporter.export(data)
+
+
+def current() -> Optional[Span]:
+    return _current.get()
+
+
+def annotate(**attributes):
+    """Add attributes to the current span (no-op outside a trace)"""
+    span = _current.get()
+    if span is not None:
+        span.set(**attributes)
+
+
+def start_span(name: str, **attributes) -> Span:
+    """
+    Span that doesn't become the current one, the caller calls finish().
+    For async generators, which must not leave a span current between yields
+    """
+    return Span(name, _current.get(), attributes)
+
+
+@contextmanager
+def span(name: str, **attributes) -> Iterator[Span]:
+    """Time the block as a child of the current span"""
+    current_span = Span(name, _current.get(), attributes)
+    token = _current.set(current_span)
+    try:
+        yield current_span
+    except BaseException as e:
+        current_span.finish(error=e)
+        raise
+    finally:
+        _current.reset(token)
+        current_span.finish()
+
+
+def record(name: str, started: float, ended: float = None, **attributes):
+    """Span for something that already happened (e.g. time spent waiting in a queue)"""
+    Span(name, _current.get(), attributes, started=started).finish(ended=ended)
+
+
+def traced(name: str):
+    """Decorator: run a coroutine function inside a span"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with span(name):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def update_attributes(update: object) -> Dict[str, Any]:
+    """update_id, user and chat of a Telegram update"""
+    attributes = {"update_id": getattr(update, "update_id", None)}
+    user = getattr(update, "effective_user", None)
+    if user is not None:
+        attributes["user_id"] = user.id
+    chat = getattr(update, "effective_chat", None)
+    if chat is not None:
+        attributes["chat_id"] = chat.id
+    return attributes
+
+
+def instrument_engine(engine):
+    """
+    Time every SQL statement (payme_db_query_seconds by statement kind),
+    statements run inside a trace also get a span (statement text only, no parameters)
+    """
+    from sqlalchemy import event
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("trace_started", []).append(time.time())
+
+    def _finish(conn, statement: str, **attributes):
+        started = conn.info.get("trace_started")
+        if not started:
+            return
+        started_at = started.pop()
+        DB_TIME.observe(time.time() - started_at, statement=statement.split(None, 1)[0].upper() if statement else "")
+        if _current.get() is not None:
+            record("db.query", started_at, statement=" ".join(statement.split())[:200], **attributes)
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        _finish(conn, statement)
+
+    @event.listens_for(engine, "handle_error")
+    def _error(exception_context):
+        if exception_context.connection is not None:
+            _finish(
+                exception_context.connection,
+                exception_context.statement or "",
+                error=str(exception_context.original_exception)[:200],
+            )
+
+
+def recent_spans(limit: int = None) -> List[dict]:
+    """Finished spans from the ring buffer, oldest first"""
+    spans = list(_recent)
+    return spans[-limit:] if limit else spans
@@ -1,14 +1,19 @@
 """
 Whisper transcription service using OpenAI API
 """
-import os
+import logging
 import tempfile
 from pathlib import Path
 from typing import Optional
-import httpx
 from config import config
+import file_store
+import openai_client
+import tracing
 
+logger = logging.getLogger(__name__)
 
+
+@tracing.traced("openai.transcribe")
 async def transcribe_audio(audio_path: str) -> Optional[str]:
     """
     Transcribe audio file using OpenAI Whisper API
@@ -29,56 +34,55 @@ async def transcribe_audio(audio_path: str) -> Optional[str]:
     }
 
     try:
-        async with httpx.AsyncClient(timeout=60.0) as client:
-            with open(audio_path, "rb") as audio_file:
-                files = {
-                    "file": (Path(audio_path).name, audio_file, "audio/ogg"),
-                }
-                data = {
-                    "model": "whisper-1",
-                    "language": "ru",  # Russian
-                    "response_format": "text",
-                }
-
-                response = await client.post(
-                    api_url,
-                    headers=headers,
-                    files=files,
-                    data=data,
-                )
-
-                if response.status_code == 200:
-                    return response.text.strip()
-                else:
-                    print(f"Whisper API error: {response.status_code} - {response.text}")
-                    return None
+        client = openai_client.get_client()
+        with open(audio_path, "rb") as audio_file:
+            files = {
+                "file": (Path(audio_path).name, audio_file, "audio/ogg"),
+            }
+            data = {
+                "model": "whisper-1",
+                "language": "ru",  # Russian
+                "response_format": "text",
+            }
+
+            response = await client.post(
+                api_url,
+                timeout=60.0,
+                headers=headers,
+                files=files,
+                data=data,
+            )
+
+            if response.status_code == 200:
+                return response.text.strip()
+            else:
+                logger.error(f"Whisper API error: {response.status_code} - {response.text[:500]}")
+                return None
 
     except Exception as e:
-        print(f"Transcription error: {e}")
+        logger.error(f"Transcription error: {e}")
         return None
 
 
-async def transcribe_telegram_voice(bot, voice_file_id: str) -> tuple[Optional[str], Optional[str]]:
+async def transcribe_telegram_voice(bot, voice_file_id: str, file=None) -> tuple[Optional[str], Optional[str]]:
     """
     Download and transcribe Telegram voice message
 
     Args:
         bot: Telegram bot instance
         voice_file_id: Telegram file ID
+        file: telegram.File if the caller already fetched it
 
     Returns:
         Tuple of (transcription, local_file_path)
     """
     try:
         # Get file info from Telegram
-        file = await bot.get_file(voice_file_id)
-
-        # Create temp file for download
-        os.makedirs(config.UPLOAD_DIR, exist_ok=True)
-        temp_path = os.path.join(config.UPLOAD_DIR, f"voice_{voice_file_id}.ogg")
+        if file is None:
+            file = await bot.get_file(voice_file_id)
 
-        # Download file
-        await file.download_to_drive(temp_path)
+        # Download file into the upload store
+        temp_path = await file_store.download(file, "voice", ".ogg")
 
         # Transcribe
         transcription = await transcribe_audio(temp_path)
@@ -86,5 +90,5 @@ async def transcribe_telegram_voice(bot, voice_file_id: str) -> tuple[Optional[s
         return transcription, temp_path
 
     except Exception as e:
-        print(f"Voice transcription error: {e}")
+        logger.error(f"Voice transcription error: {e}")
         return None, None
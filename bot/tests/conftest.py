@@ -0,0 +1,9 @@
+"""
+Tests run against the modules in bot/src, imported the way bot.py imports them
+
+    python -m pytest bot/tests
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
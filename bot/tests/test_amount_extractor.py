@@ -0,0 +1,82 @@
+"""Incremental JSON array parsing of streamed extraction responses"""
+import pytest
+
+from amount_extractor import JSONArrayStream, parse_amount
+
+RESPONSE = '```json\n[{"amount": 200, "description": "Окно \\"A\\", {1}"}, {"amount": 5.5, "meta": {"tags": ["a]", "}"]}}]\n```'
+PARSED = [
+    {"amount": 200, "description": 'Окно "A", {1}'},
+    {"amount": 5.5, "meta": {"tags": ["a]", "}"]}},
+]
+
+
+def feed_chunks(chunks):
+    stream = JSONArrayStream()
+    return [item for chunk in chunks for item in stream.feed(chunk)]
+
+
+def split_every(text: str, size: int):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7, 16, len(RESPONSE)])
+def test_any_chunk_boundaries(size):
+    assert feed_chunks(split_every(RESPONSE, size)) == PARSED
+
+
+@pytest.mark.parametrize("chunks, expected", [
+    # Boundary right after a backslash inside a string
+    (['[{"d": "a\\', '"b"}]'], [{"d": 'a"b'}]),
+    # Escaped backslash before the closing quote
+    (['[{"d": "a\\\\', '"}]'], [{"d": "a\\"}]),
+    # Brackets and braces inside strings don't count
+    (['[{"d": "]}[{"}', "]"], [{"d": "]}[{"}]),
+    # Nested objects and arrays complete only with their top-level item
+    (['[{"a": {"b": [1, {"c"', ': 2}]}}', "]"], [{"a": {"b": [1, {"c": 2}]}}]),
+    # Empty array, whitespace
+    (["  [ ] "], []),
+    (["[\n  {\"a\": 1} ,\n  {\"a\": 2}\n]"], [{"a": 1}, {"a": 2}]),
+    # Anything around the array is ignored, also a second array
+    (['Here: [{"a": 1}] and [{"a": 2}]'], [{"a": 1}]),
+    # Non-object items are skipped
+    (['[1, "x", [2], {"a": 3}]'], [{"a": 3}]),
+])
+def test_items(chunks, expected):
+    assert feed_chunks(chunks) == expected
+
+
+@pytest.mark.parametrize("chunks, expected", [
+    # Truncated: completed items are kept, the cut one is not
+    (['[{"a": 1}, {"a": 2'], [{"a": 1}]),
+    (['[{"a": 1}, {"a": "unterminated'], [{"a": 1}]),
+    # Malformed items are dropped, the rest still parse
+    (['[{"a": }, {"a": 2}]'], [{"a": 2}]),
+    (['[{"a": 1,}, {"a": 2}]'], [{"a": 2}]),
+    # No array at all
+    (['{"a": 1}'], []),
+    ([""], []),
+])
+def test_truncated_and_malformed(chunks, expected):
+    assert feed_chunks(chunks) == expected
+
+
+def test_items_arrive_as_soon_as_complete():
+    stream = JSONArrayStream()
+    assert stream.feed('[{"a": 1}') == [{"a": 1}]
+    assert stream.feed(', {"a"') == []
+    assert stream.feed(': 2}') == [{"a": 2}]
+    assert stream.feed(']{"a": 3}') == []
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("12.50", (12.5, None)),
+    ("12,5 usd", (12.5, "USD")),
+    (" €12 ", (12.0, "EUR")),
+    ("12 €", (12.0, "EUR")),
+    ("7", (7.0, None)),
+    ("такси 15", None),
+    ("1.234", None),
+    ("", None),
+])
+def test_parse_amount(text, expected):
+    assert parse_amount(text) == expected
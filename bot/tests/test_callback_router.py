@@ -0,0 +1,87 @@
+"""Callback payloads: buttons already sent must keep decoding the same way"""
+import base64
+
+import pytest
+
+from callback_router import (
+    LEGACY_PREFIXES,
+    MAX_CALLBACK_DATA,
+    PAYLOAD_VERSION,
+    CallbackTemplate,
+    InvalidCallback,
+    decode_callback,
+    encode_callback,
+)
+from config import CallbackAction, CallbackPrefix
+
+
+def raw_payload(*values: int) -> str:
+    return base64.urlsafe_b64encode(bytes(values)).rstrip(b"=").decode("ascii")
+
+
+@pytest.mark.parametrize("action", list(CallbackAction))
+@pytest.mark.parametrize("args", [(), (0,), (1, 2), (127, 128), (2 ** 32, 9_999_999_999, 5)])
+def test_round_trip(action, args):
+    assert decode_callback(encode_callback(action, *args)) == (action, list(args))
+
+
+def test_template_matches_encode():
+    template = CallbackTemplate(CallbackAction.SUBCATEGORY, 17)
+    assert template.fill(123456) == encode_callback(CallbackAction.SUBCATEGORY, 17, 123456)
+
+
+@pytest.mark.parametrize("value, encoded", [
+    (0, b"\x00"),
+    (127, b"\x7f"),
+    (128, b"\x80\x01"),
+    (300, b"\xac\x02"),
+])
+def test_varint_wire_format(value, encoded):
+    data = encode_callback(CallbackAction.CATEGORY, value)
+    assert base64.urlsafe_b64decode(data + "=" * (-len(data) % 4)) == bytes(
+        (PAYLOAD_VERSION, CallbackAction.CATEGORY)
+    ) + encoded
+
+
+def test_legacy_prefixes_are_the_pre_payload_ones():
+    assert set(LEGACY_PREFIXES) == {
+        value for name, value in vars(CallbackPrefix).items() if not name.startswith("_")
+    }
+
+
+@pytest.mark.parametrize("prefix, action", list(LEGACY_PREFIXES.items()))
+def test_legacy_prefix(prefix, action):
+    assert decode_callback(f"{prefix}:42") == (action, [42])
+    assert decode_callback(f"{prefix}:3:42") == (action, [3, 42])
+
+
+@pytest.mark.parametrize("data, error", [
+    ("", "empty"),
+    ("nope:1", "unknown legacy prefix"),
+    (f"{CallbackPrefix.CATEGORY}:x", "invalid literal"),
+    (raw_payload(PAYLOAD_VERSION), "too short"),
+    (raw_payload(PAYLOAD_VERSION, CallbackAction.CATEGORY, 0x80), "truncated varint"),
+    (raw_payload(PAYLOAD_VERSION, CallbackAction.CATEGORY, 5, 0xff, 0xff), "truncated varint"),
+    (raw_payload(PAYLOAD_VERSION + 1, CallbackAction.CATEGORY, 5), "unsupported payload version"),
+    (raw_payload(PAYLOAD_VERSION, 250, 5), "not a valid CallbackAction"),
+])
+def test_invalid(data, error):
+    with pytest.raises(InvalidCallback, match=error):
+        decode_callback(data)
+
+
+def test_ten_digit_ids_fit():
+    data = encode_callback(CallbackAction.SHORTCUT, 9_999_999_999, 2, 9_999_999_999)
+    assert len(data) <= MAX_CALLBACK_DATA
+
+
+def test_64_byte_limit():
+    # 2 header bytes + 46 one-byte varints = 48 bytes = 64 base64 characters
+    assert len(encode_callback(CallbackAction.CATEGORY, *[1] * 46)) == MAX_CALLBACK_DATA
+    with pytest.raises(ValueError, match="too long"):
+        encode_callback(CallbackAction.CATEGORY, *[1] * 47)
+
+
+def test_negative_args_rejected():
+    with pytest.raises(ValueError, match="non-negative"):
+        encode_callback(CallbackAction.CATEGORY, -1)
@@ -0,0 +1,90 @@
+"""Start order of queued media jobs: priority first, then users take turns"""
+import asyncio
+
+import pytest
+
+from media_queue import JobPriority, MediaJobQueue, QueueFull
+
+V, P, D = JobPriority.VOICE, JobPriority.PHOTO, JobPriority.DOCUMENT
+
+
+def queued_order(jobs, last_served=None, **limits):
+    """Submit (user_id, priority) jobs to a queue that starts nothing, returns _order() as (user_id, priority)"""
+    queue = MediaJobQueue(
+        max_running=0, max_pending=limits.get("max_pending", 100),
+        max_pending_per_user=limits.get("max_pending_per_user", 100),
+    )
+    queue._last_served.update(last_served or {})
+
+    async def main():
+        tasks = [
+            asyncio.create_task(queue.submit(user_id, priority, lambda: asyncio.sleep(0)))
+            for user_id, priority in jobs
+        ]
+        await asyncio.sleep(0)
+        try:
+            return [(job.user_id, job.priority) for job in queue._order()], [
+                task.exception() if task.done() else None for task in tasks
+            ]
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    return asyncio.run(main())
+
+
+@pytest.mark.parametrize("jobs, last_served, expected", [
+    # One user: submission order
+    ([(1, P), (1, P), (1, P)], None, [(1, P), (1, P), (1, P)]),
+    # Lower priority value first, whoever submitted it
+    ([(1, D), (2, P), (3, V)], None, [(3, V), (2, P), (1, D)]),
+    # Users take turns instead of the first one draining their backlog
+    ([(1, P), (1, P), (1, P), (2, P), (3, P)], None, [(1, P), (2, P), (3, P), (1, P), (1, P)]),
+    # The user served longest ago goes first
+    ([(1, P), (2, P), (3, P)], {1: 5, 2: 3, 3: 4}, [(2, P), (3, P), (1, P)]),
+    # Never served beats recently served
+    ([(1, P), (2, P)], {1: 1}, [(2, P), (1, P)]),
+    # A user's jobs stay in submission order: a voice note behind their photo waits for it,
+    # then outranks other users' photos
+    ([(1, P), (1, V), (2, P)], None, [(1, P), (1, V), (2, P)]),
+    # Turns within a priority, priority across users
+    ([(1, P), (1, P), (2, V), (3, P)], None, [(2, V), (1, P), (3, P), (1, P)]),
+])
+def test_order(jobs, last_served, expected):
+    order, _ = queued_order(jobs, last_served)
+    assert order == expected
+
+
+@pytest.mark.parametrize("limits, jobs, rejected", [
+    ({"max_pending_per_user": 2}, [(1, P), (1, P), (1, P), (2, P)], [None, None, True, None]),
+    ({"max_pending": 2}, [(1, P), (2, P), (3, P)], [None, None, False]),
+])
+def test_admission(limits, jobs, rejected):
+    order, errors = queued_order(jobs, **limits)
+    assert [e.per_user if isinstance(e, QueueFull) else e for e in errors] == rejected
+    assert len(order) == rejected.count(None)
+
+
+def test_jobs_run_in_order():
+    queue = MediaJobQueue(max_running=1, max_pending=10, max_pending_per_user=10)
+    started = []
+
+    def job(name):
+        async def run():
+            started.append(name)
+            await asyncio.sleep(0)
+            return name
+        return run
+
+    async def main():
+        return await asyncio.gather(
+            queue.submit(1, P, job("a1")),
+            queue.submit(1, P, job("a2")),
+            queue.submit(2, D, job("b1")),
+            queue.submit(3, P, job("c1")),
+        )
+
+    assert asyncio.run(main()) == ["a1", "a2", "b1", "c1"]
+    assert started == ["a1", "c1", "a2", "b1"]
+    assert queue.running == 0 and queue.depth == 0
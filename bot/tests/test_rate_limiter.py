@@ -0,0 +1,124 @@
+"""Outbound throttling: token buckets and coalescing of queued message edits"""
+import asyncio
+
+import pytest
+from telegram.error import RetryAfter
+
+import rate_limiter
+from rate_limiter import TelegramRateLimiter, TokenBucket
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(rate_limiter.time, "monotonic", clock)
+    return clock
+
+
+@pytest.mark.parametrize("rate, capacity, reservations, waits", [
+    # Burst is free, then one token per 1/rate seconds
+    (2.0, 3, 5, [0, 0, 0, 0.5, 1.0]),
+    (10.0, 1, 3, [0, 0.1, 0.2]),
+    # Less than one token of capacity still waits for whole tokens
+    (1.0, 0.5, 2, [0.5, 1.5]),
+])
+def test_reservations(clock, rate, capacity, reservations, waits):
+    bucket = TokenBucket(rate, capacity)
+    assert [bucket.reserve() for _ in range(reservations)] == pytest.approx(waits)
+
+
+def test_refill_is_capped(clock):
+    bucket = TokenBucket(1.0, 2)
+    bucket.reserve()
+    bucket.reserve()
+    clock.now += 60
+    assert [bucket.reserve() for _ in range(3)] == pytest.approx([0, 0, 1.0])
+
+
+def test_refund_returns_the_token(clock):
+    bucket = TokenBucket(1.0, 1)
+    bucket.reserve()
+    bucket.refund()
+    assert bucket.reserve() == 0
+
+
+def test_pause_delays_everything(clock):
+    bucket = TokenBucket(10.0, 5)
+    bucket.pause(3)
+    assert bucket.reserve() == pytest.approx(3.1)
+    assert not bucket.is_idle()
+    clock.now += 10
+    assert bucket.is_idle()
+
+
+def run_requests(requests, limiter=None, **limits):
+    """Send (endpoint, data) requests concurrently, returns (results, data of the calls that went out)"""
+    limiter = limiter or TelegramRateLimiter(
+        global_rate=1000, chat_rate=limits.get("chat_rate", 50), chat_burst=limits.get("chat_burst", 1),
+        group_rate=1, max_retries=limits.get("max_retries", 2),
+    )
+    sent = []
+    failures = dict(limits.get("failures", {}))
+
+    async def call(data):
+        key = data.get("text")
+        if failures.get(key):
+            failures[key] -= 1
+            raise RetryAfter(0.01)
+        sent.append(data)
+        return data
+
+    async def main():
+        return await asyncio.gather(*(
+            limiter.process_request(call, (data,), {}, endpoint, data, None)
+            for endpoint, data in requests
+        ))
+
+    return asyncio.run(main()), sent
+
+
+def edit(message_id, text, chat_id=1):
+    return "editMessageText", {"chat_id": chat_id, "message_id": message_id, "text": text}
+
+
+@pytest.mark.parametrize("requests, sent_texts", [
+    # The first edit goes out right away, of the queued ones only the newest
+    ([edit(1, "a"), edit(1, "b"), edit(1, "c")], ["a", "c"]),
+    # Different messages are not coalesced
+    ([edit(1, "a"), edit(2, "b"), edit(1, "c")], ["a", "b", "c"]),
+    ([edit(1, "a"), edit(2, "b"), edit(1, "c"), edit(2, "d")], ["a", "c", "d"]),
+    # Same message id in another chat is another message
+    ([edit(1, "a"), edit(1, "b", chat_id=2), edit(1, "c")], ["a", "b", "c"]),
+    # Sends aren't coalesced
+    ([("sendMessage", {"chat_id": 1, "text": t}) for t in "abc"], ["a", "b", "c"]),
+])
+def test_edit_coalescing(requests, sent_texts):
+    results, sent = run_requests(requests)
+    assert sorted(data["text"] for data in sent) == sent_texts
+    # Dropped edits report success
+    assert all(result is True or result in sent for result in results)
+
+
+def test_edits_after_the_last_one_went_out_are_sent():
+    limiter = TelegramRateLimiter(global_rate=1000, chat_rate=50, chat_burst=1, group_rate=1, max_retries=0)
+    _, first = run_requests([edit(1, "a"), edit(1, "b")], limiter)
+    _, second = run_requests([edit(1, "c")], limiter)
+    assert [d["text"] for d in first + second] == ["a", "b", "c"]
+
+
+def test_retry_after_is_retried():
+    _, sent = run_requests([("sendMessage", {"chat_id": 1, "text": "a"})], failures={"a": 2}, max_retries=2)
+    assert [d["text"] for d in sent] == ["a"]
+
+
+def test_retry_after_gives_up():
+    with pytest.raises(RetryAfter):
+        run_requests([("sendMessage", {"chat_id": 1, "text": "a"})], failures={"a": 3}, max_retries=2)